@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Measure the cold import time of ``sortedone2many`` modules, each in a fresh
+interpreter, and list the heavy modules they pull in::
+
+    python benchmarks/import_time.py [--runs 20] [module ...]
+
+Compare the output of two checkouts to measure an import-time change.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = ['sortedone2many', 'sortedone2many.fields', 'sortedone2many.utils']
+
+# modules only needed to render forms
+HEAVY_MODULES = ['django.forms', 'django.template.loader', 'sortedm2m.forms',
+                 'sortedone2many.forms']
+
+SCRIPT = '''
+import json, sys, time
+from django.conf import settings
+settings.configure()
+import django
+start = time.time()
+import %(module)s
+elapsed = time.time() - start
+print(json.dumps([elapsed, [name for name in %(heavy)r if name in sys.modules]]))
+'''
+
+
+def measure(module, runs):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT % {'module': module, 'heavy': HEAVY_MODULES}],
+            cwd=ROOT)
+        elapsed, loaded = json.loads(output.decode('utf8'))
+        timings.append(elapsed)
+    timings.sort()
+    return timings[len(timings) // 2], timings[0], loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        median, best, loaded = measure(module, args.runs)
+        print('%-28s median %6.1f ms  best %6.1f ms  form modules: %s' % (
+            module, median * 1000, best * 1000, ', '.join(loaded) or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,13 @@
 # -*- coding: utf-8 -*-
 
 __version__ = '0.2.2'
+
+
+def batch(using=None):
+    '''
+    Buffer the changes of ``SortedOneToManyField`` relations inside the block
+    and write them in bulk at its end (see ``sortedone2many.batching``).
+    Imported lazily: ``import sortedone2many`` doesn't import Django.
+    '''
+    from .batching import batch
+    return batch(using)
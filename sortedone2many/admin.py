@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
+import json
+
+from django.conf.urls import url
 from django.contrib import admin
+from django.contrib.admin.utils import unquote
 from django.contrib.admin.widgets import RelatedFieldWidgetWrapper
+from django.core.exceptions import FieldDoesNotExist
+from django.core.urlresolvers import NoReverseMatch, reverse
 from django.db.models.fields.related import ManyToOneRel, ManyToManyField
 from django import forms
+from django.http import JsonResponse
 from django.utils import six
 
-from .fields import OneToManyRel
+from .fields import OneToManyRel, SortedOneToManyField
+from .forms import SortedMultipleChoiceWithDisabledField
 
 from django.forms.models import ModelFormMetaclass
 
@@ -63,11 +71,22 @@ class One2ManyModelForm(six.with_metaclass(One2ManyModelFormMetaclass, forms.Mod
     the ``ModelChoiceField`` will be rendered in the Admin site as a dropdown 
     <select> list with additional "change" and "add" buttons (two small green 
     buttons just like in the widget of a ``ForeinKey`` field).
+
+    The ``SortedOneToManyField`` fields of the model get the instance as their
+    ``owner``, so that objects of other owners are rejected when cleaning.
     '''
     def __init__(self, *args, **kwargs):
         super(One2ManyModelForm, self).__init__(*args, **kwargs)
         admin_site = getattr(self, 'admin_site', admin.site)
 
+        for name, formfield in self.fields.items():
+            if isinstance(formfield, SortedMultipleChoiceWithDisabledField):
+                formfield.owner = self.instance
+                if self.instance.pk is not None:
+                    # the admin may wrap the widget in a `RelatedFieldWidgetWrapper`
+                    widget = getattr(formfield.widget, 'widget', formfield.widget)
+                    widget.move_url = self.get_move_url(admin_site, name)
+
         for field in self.related_one2manyfields:
             related_model = field.related_model
             related_name = field.name
@@ -84,6 +103,15 @@ class One2ManyModelForm(six.with_metaclass(One2ManyModelFormMetaclass, forms.Mod
                 self.fields[related_name].widget, fake_manytoone_rel,
                 admin_site, can_change_related=True)
 
+    def get_move_url(self, admin_site, field_name):
+        'the url of ``One2ManyModelAdmin.move_view`` for ``field_name``, if registered'
+        opts = self.instance._meta
+        try:
+            return reverse('%s:%s_%s_move' % (admin_site.name, opts.app_label, opts.model_name),
+                           args=[self.instance.pk, field_name])
+        except NoReverseMatch:
+            return None
+
 
 class One2ManyModelAdmin(admin.ModelAdmin):
     '''
@@ -110,6 +138,54 @@ class One2ManyModelAdmin(admin.ModelAdmin):
                 continue
             self.related_one2manyfields.append(field.name)
 
+    max_moves = 100
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urls = [
+            url(r'^(.+)/move/(\w+)/$', self.admin_site.admin_view(self.move_view),
+                name='%s_%s_move' % info),
+        ]
+        return urls + super(One2ManyModelAdmin, self).get_urls()
+
+    def move_view(self, request, object_id, field_name):
+        '''
+        Reorder the related objects of a ``SortedOneToManyField`` without
+        submitting the whole change form, as the sortable widget does after
+        each drag and drop. POST ``item`` and ``index`` (0-based), or a JSON
+        body ``{"moves": [[item, index], ...]}`` (at most ``max_moves``).
+        Respond with ``{"updated": <number of updated rows>}``.
+        '''
+        if request.method != 'POST':
+            return JsonResponse({'error': 'POST required'}, status=405)
+        try:
+            field = self.model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            field = None
+        if not isinstance(field, SortedOneToManyField) or not field.sorted:
+            return JsonResponse({'error': 'unknown field %r' % field_name}, status=404)
+        obj = self.get_object(request, unquote(object_id))
+        if obj is None:
+            return JsonResponse({'error': 'object not found'}, status=404)
+        if not self.has_change_permission(request, obj):
+            return JsonResponse({'error': 'permission denied'}, status=403)
+
+        try:
+            if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+                moves = json.loads(request.body.decode('utf-8'))['moves']
+            else:
+                moves = [(request.POST['item'], request.POST['index'])]
+            moves = [(item, int(index)) for item, index in moves]
+        except (KeyError, TypeError, ValueError):
+            return JsonResponse({'error': 'invalid moves'}, status=400)
+        if len(moves) > self.max_moves:
+            return JsonResponse({'error': 'too many moves (max %s)' % self.max_moves}, status=400)
+        try:
+            updated = getattr(obj, field.name).move_many(moves)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'updated': updated})
+
     def save_model(self, request, obj, form, change):
         super(One2ManyModelAdmin, self).save_model(request, obj, form, change)
         # save related_one2manyfields
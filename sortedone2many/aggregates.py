@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+'''
+Ordered nested aggregation: annotate owners with the values of their related
+objects in sort order, aggregated by the database as a JSON array, e.g. to
+serialise a page of categories with their items in a single query::
+
+    categories = Category.items.field.with_related_values(
+        Category.objects.all()[:20], ['pk', 'name'])
+    for category in categories:
+        category.items_values  # [(3, 'item3'), (1, 'item1'), ...]
+
+The values go through JSON, so dates and decimals come back as strings.
+Supported on SQLite (``json_group_array``, with the JSON1 extension) and
+PostgreSQL (``json_agg``).
+'''
+import json
+
+from django.db import connections, models
+from django.db.models.expressions import RawSQL
+from django.utils import six
+
+
+SQLITE_SQL = (
+    'SELECT json_group_array(%(value)s) FROM ('
+    'SELECT %(columns)s FROM %(table)s t '
+    'INNER JOIN %(model_table)s m ON m.%(model_key)s = t.%(item)s '
+    'WHERE t.%(owner)s = %(owner_key)s ORDER BY t.%(sort)s, t.%(pk)s)')
+
+POSTGRESQL_SQL = (
+    "SELECT COALESCE(json_agg(%(value)s ORDER BY t.%(sort)s, t.%(pk)s), '[]') "
+    'FROM (SELECT %(columns)s, t.%(sort)s, t.%(pk)s FROM %(table)s t '
+    'INNER JOIN %(model_table)s m ON m.%(model_key)s = t.%(item)s '
+    'WHERE t.%(owner)s = %(owner_key)s) t')
+
+JSON_ARRAY = {'sqlite': 'json_array', 'postgresql': 'json_build_array'}
+
+
+class JSONListField(models.Field):
+    '''
+    Output field of the aggregate: decode the JSON array (unless the driver
+    already did), as a list of tuples if ``tuples``.
+    '''
+    def __init__(self, tuples=False, **kwargs):
+        self.tuples = tuples
+        super(JSONListField, self).__init__(**kwargs)
+
+    def from_db_value(self, value, expression, connection, context=None):
+        if value is None:
+            return []
+        if isinstance(value, six.string_types):
+            value = json.loads(value)
+        if self.tuples:
+            value = [tuple(values) for values in value]
+        return value
+
+
+def related_values_sql(field, owner_model, connection, fields=None):
+    'the SQL of the ordered JSON array of the related ``fields`` of each owner'
+    from .utils import get_table_info
+
+    templates = {'sqlite': SQLITE_SQL, 'postgresql': POSTGRESQL_SQL}
+    if connection.vendor not in templates:
+        raise NotImplementedError(
+            'Ordered JSON aggregation is not supported on %s' % connection.vendor)
+    qn = connection.ops.quote_name
+    through = field.rel.through
+    model = field.rel.to
+    source_field = through._meta.get_field(through._from_field_name)
+    target_field = through._meta.get_field(through._to_field_name)
+
+    opts = model._meta
+    columns = [(opts.pk if name == 'pk' else opts.get_field(name)).column
+               for name in (fields or ['pk'])]
+    aliases = ['c%s' % i for i in range(len(columns))]
+    if fields:
+        value = '%s(%s)' % (JSON_ARRAY[connection.vendor], ', '.join(aliases))
+    else:
+        value = aliases[0]
+    info = dict(
+        get_table_info(field, connection),
+        value=value,
+        columns=', '.join('m.%s AS %s' % (qn(column), alias)
+                          for column, alias in zip(columns, aliases)),
+        model_table=qn(opts.db_table),
+        model_key=qn(target_field.rel.get_related_field().column),
+        owner_key='%s.%s' % (qn(owner_model._meta.db_table),
+                             qn(source_field.rel.get_related_field().column)),
+    )
+    return templates[connection.vendor] % info
+
+
+def with_related_values(field, queryset, fields=None, name=None):
+    '''
+    Annotate every owner of ``queryset`` with the list of the pks of its
+    related objects in sort order, or of value tuples of the related
+    ``fields`` if given, as the ``name`` attribute (default:
+    ``<field name>_values``).
+    '''
+    name = name or '%s_values' % field.name
+    sql = related_values_sql(field, queryset.model, connections[queryset.db], fields)
+    return queryset.annotate(**{name: RawSQL(sql, (), output_field=JSONListField(tuples=bool(fields)))})
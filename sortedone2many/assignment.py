@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+'''
+Move all the objects of a queryset to an owner with set-based statements
+(see ``SortedOneToManyField.assign_owner()``).
+
+The objects are numbered with ``ROW_NUMBER()`` in the order of the queryset,
+so the database must support window functions (SQLite 3.25, PostgreSQL,
+MySQL 8). Whatever their number, the rows are then deleted with one
+``DELETE``, or moved with one ``UPDATE`` (owner and sort value, from an offset
+past the bounds of the owner) and one ``INSERT ... SELECT``. The objects are
+only loaded one by one if their changes are needed (``prevent_cycles``,
+``m2m_changed`` or ``one2many_changed`` receivers).
+'''
+from collections import OrderedDict
+
+from django.db import connections, models, transaction
+from django.db.models import signals
+from django.db.models.expressions import OrderBy, RawSQL
+
+from .batching import get_current_batch
+from .instrumentation import instrument
+from .routing import db_for_write, mark_written
+from .signals import Change, is_listened, needs_changes, record_changes, record_counts
+from .utils import chunked, get_table_info
+
+
+RANK_ALIAS = 'sortedone2many_rank'
+
+RANKED_SQL = '''
+SELECT ranked.%(column)s AS %(item_pk)s, MIN(ranked.%(rank)s) AS %(item_rank)s
+FROM (%(sql)s) ranked
+GROUP BY ranked.%(column)s
+'''
+
+DELETE_SQL = '''
+DELETE FROM %(table)s WHERE %(item)s IN (SELECT r.%(item_pk)s FROM (%(ranked)s) r)
+'''
+
+UPDATE_SQL = '''
+UPDATE %(table)s SET %(owner)s = %%s, %(sort)s = %%s + (
+    SELECT r.%(item_rank)s FROM (%(ranked)s) r WHERE r.%(item_pk)s = %(table)s.%(item)s)
+WHERE %(item)s IN (SELECT r.%(item_pk)s FROM (%(ranked)s) r) AND %(owner)s <> %%s
+'''
+
+INSERT_SQL = '''
+INSERT INTO %(table)s (%(owner)s, %(item)s, %(sort)s)
+SELECT %%s, r.%(item_pk)s, %%s + r.%(item_rank)s FROM (%(ranked)s) r
+WHERE r.%(item_pk)s NOT IN (SELECT %(item)s FROM %(table)s)
+'''
+
+# the number of rows per owner among the rows of the objects
+OWNERS_SQL = '''
+SELECT %(owner)s, COUNT(*) FROM %(table)s
+WHERE %(item)s IN (SELECT r.%(item_pk)s FROM (%(ranked)s) r)%(other_owners)s
+GROUP BY %(owner)s
+'''
+
+
+class RowNumber(RawSQL):
+    'the position of the row in the order of the query, not a column to group by'
+    def __init__(self, order_sql, params):
+        super(RowNumber, self).__init__('ROW_NUMBER() OVER (ORDER BY %s)' % ', '.join(order_sql),
+                                        params, output_field=models.IntegerField())
+
+    def get_group_by_cols(self):
+        return []
+
+
+def get_ranked_sql(queryset, field, connection):
+    '''
+    Return the SQL (and params) selecting the distinct values of ``field``
+    (``item_pk``) of the objects of ``queryset`` and their position in its
+    order (``item_rank``, increasing, not necessarily from 1 or without gaps).
+    '''
+    values = queryset.values_list(field.attname)
+    compiler = values.query.get_compiler(connection=connection)
+    order_sql, order_params = [], []
+    for expression, (sql, params, is_ref) in compiler.pre_sql_setup()[1]:
+        if is_ref:
+            # a window can't refer to the aliases of the select list
+            sql, params = compiler.compile(OrderBy(expression.expression.source,
+                                                   descending=expression.descending))
+        order_sql.append(sql)
+        order_params.extend(params)
+    values.query.add_annotation(RowNumber(order_sql, order_params), RANK_ALIAS)
+    sql, params = values.query.get_compiler(connection=connection).as_sql()
+    qn = connection.ops.quote_name
+    return RANKED_SQL % {
+        'sql': sql, 'column': qn(field.column), 'rank': qn(RANK_ALIAS),
+        'item_pk': qn('item_pk'), 'item_rank': qn('item_rank'),
+    }, tuple(params)
+
+
+def assign_owner(field, queryset, owner, position='end'):
+    'see ``SortedOneToManyField.assign_owner()``'
+    if position not in ('end', 'start'):
+        raise ValueError("position must be 'end' or 'start', not %r" % (position,))
+    current_batch = get_current_batch()
+    if current_batch is not None:
+        # keep the order of the operations
+        current_batch.flush()
+    if not queryset.ordered:
+        queryset = queryset.order_by('pk')
+
+    through = field.rel.through
+    source_field = through._meta.get_field(through._from_field_name)
+    target_field = through._meta.get_field(through._to_field_name)
+    owner_pk_field = source_field.rel.get_related_field()
+    if isinstance(owner, models.Model):
+        owner_pk = getattr(owner, owner_pk_field.attname)
+        db = db_for_write(field, owner=owner)
+    else:
+        owner_pk = None if owner is None else owner_pk_field.get_prep_value(owner)
+        db = db_for_write(field)
+    connection = connections[db]
+    ranked, ranked_params = get_ranked_sql(queryset, target_field.rel.get_related_field(), connection)
+    qn = connection.ops.quote_name
+    info = dict(get_table_info(field, connection), ranked=ranked,
+                item_pk=qn('item_pk'), item_rank=qn('item_rank'))
+
+    send_signals = signals.m2m_changed.has_listeners(through)
+    load = field.prevent_cycles or send_signals or is_listened(field)
+    with instrument('assign_owner', field, owner) as metrics:
+        with transaction.atomic(using=db):
+            with connection.cursor() as cursor:
+                if load:
+                    cursor.execute('SELECT %(item_pk)s, %(item_rank)s FROM (%(ranked)s) r '
+                                   'ORDER BY %(item_rank)s' % info, ranked_params)
+                    ranks = OrderedDict(cursor.fetchall())
+                    count, max_rank = len(ranks), max(ranks.values()) if ranks else 0
+                    field.check_cycles(owner, list(ranks), db)
+                else:
+                    cursor.execute('SELECT COUNT(*), MAX(%(item_rank)s) FROM (%(ranked)s) r' % info,
+                                   ranked_params)
+                    count, max_rank = cursor.fetchone()
+                if not count:
+                    metrics['rows'] = 0
+                    return 0
+
+                if owner_pk is None:
+                    offset = None
+                else:
+                    cursor.execute('SELECT MIN(%(sort)s), MAX(%(sort)s) FROM %(table)s '
+                                   'WHERE %(owner)s = %%s' % info, [owner_pk])
+                    lowest, highest = cursor.fetchone()
+                    if highest is None:
+                        offset = 0
+                    elif position == 'end':
+                        offset = highest
+                    else:
+                        offset = lowest - max_rank - 1
+
+                deltas = {}
+                if load:
+                    changes = []
+                    removed_from, added_to = {}, {}
+                    manager = through._default_manager.using(db)
+                    initial = {}
+                    for chunk in chunked(list(ranks), 500):
+                        initial.update(manager.filter(**{'%s__in' % target_field.attname: chunk})
+                                       .values_list(target_field.attname, source_field.attname))
+                    for target_id, rank in ranks.items():
+                        initial_owner_pk = initial.get(target_id)
+                        if initial_owner_pk == owner_pk:
+                            continue
+                        changes.append(Change(target_id, initial_owner_pk, owner_pk,
+                                              None if owner_pk is None else offset + rank))
+                        if initial_owner_pk is not None:
+                            removed_from.setdefault(initial_owner_pk, set()).add(target_id)
+                        if owner_pk is not None:
+                            added_to.setdefault(owner_pk, set()).add(target_id)
+                    if send_signals:
+                        owners = field.model._default_manager.using(db).in_bulk(
+                            list(set(removed_from) | set(added_to)))
+                        _send_m2m_changed(field, 'pre', owners, removed_from, added_to, db)
+                elif needs_changes(field):
+                    if owner_pk is None:
+                        cursor.execute(OWNERS_SQL % dict(info, other_owners=''), ranked_params)
+                    else:
+                        cursor.execute(OWNERS_SQL % dict(info, other_owners=' AND %s <> %%s' % info['owner']),
+                                       ranked_params + (owner_pk,))
+                    deltas = dict((initial_owner_pk, -rows) for initial_owner_pk, rows in cursor.fetchall())
+
+                if owner_pk is None:
+                    cursor.execute(DELETE_SQL % info, ranked_params)
+                    rows = cursor.rowcount
+                else:
+                    cursor.execute(UPDATE_SQL % info,
+                                   (owner_pk, offset) + ranked_params + ranked_params + (owner_pk,))
+                    rows = cursor.rowcount
+                    cursor.execute(INSERT_SQL % info, (owner_pk, offset) + ranked_params)
+                    rows += cursor.rowcount
+                    if rows:
+                        deltas[owner_pk] = rows
+            mark_written(field)
+
+            if load:
+                if send_signals:
+                    _send_m2m_changed(field, 'post', owners, removed_from, added_to, db)
+                if needs_changes(field):
+                    record_changes(field, changes, db)
+            elif deltas:
+                record_counts(field, deltas, db)
+        metrics['rows'] = rows
+    return count
+
+
+def _send_m2m_changed(field, when, owners, removed_from, added_to, db):
+    for action, changes in (('remove', removed_from), ('add', added_to)):
+        for owner_pk, pk_set in changes.items():
+            signals.m2m_changed.send(sender=field.rel.through, action='%s_%s' % (when, action),
+                instance=owners.get(owner_pk), reverse=False,
+                model=field.rel.to, pk_set=pk_set, using=db)
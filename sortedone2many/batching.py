@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+'''
+Buffer the changes of ``SortedOneToManyField`` relations and write them in bulk::
+
+    import sortedone2many
+
+    with sortedone2many.batch():
+        for item, category in moves:
+            item.category = category
+        category.items.add(*new_items)
+
+Inside the block, ``add()``, ``remove()``, ``clear()`` and ``set()`` on the
+forward managers and assignments to the reverse accessor don't hit the
+database. At the end of the (outermost) block the operations are replayed in
+memory, per item, and only the net changes are written: one bulk delete, bulk
+updates and one bulk insert per field, in one transaction. Nothing is written
+if the block raises.
+
+Reads inside the block don't see the buffered changes, except for the
+related objects cached by assignments and by ``add()``, ``remove()`` and
+``set()`` of instances (e.g. ``item.category``).
+'''
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import signals
+
+from .instrumentation import instrument
+from .ordering import assign_sort_values
+from .routing import db_for_write, mark_written
+from .signals import Change, needs_changes, record_changes
+
+
+_local = threading.local()
+
+
+def get_current_batch():
+    'the active ``batch`` of this thread, if any'
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def unbatched():
+    '''
+    Flush the active ``batch`` (if any) and write the changes of the block
+    right away. A ``batch`` opened inside the block is flushed at its end.
+    '''
+    current = get_current_batch()
+    if current is None:
+        yield
+        return
+    current.flush()
+    _local.stack.append(None)
+    try:
+        yield
+    finally:
+        _local.stack.pop()
+
+
+class batch(object):
+    '''
+    Context manager buffering the relation changes (see the module docstring).
+    Nested blocks join the outermost one.
+    '''
+    def __init__(self, using=None):
+        self.using = using
+        # field -> list of (action, owner, target ids)
+        self.operations = OrderedDict()
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        outer = get_current_batch()
+        _local.stack.append(outer or self)
+        return outer or self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current = _local.stack.pop()
+        if current is self and exc_type is None:
+            self.flush()
+
+    def record(self, field, action, owner, target_ids=()):
+        '''
+        Buffer an operation: ``add``, ``remove``, ``clear`` or ``set`` of
+        ``target_ids`` on ``owner`` (an instance, or a pk for ``move``), or
+        ``move`` of targets to the end of ``owner`` (None to detach them), or
+        ``prepend`` of targets to the start of ``owner``.
+        '''
+        self.operations.setdefault(field, []).append((action, owner, list(target_ids)))
+
+    def flush(self):
+        operations, self.operations = self.operations, OrderedDict()
+        if not operations:
+            return
+        field_batches = [_FieldBatch(field, field_operations, self.using)
+                         for field, field_operations in operations.items()]
+        dbs = []
+        for field_batch in field_batches:
+            if field_batch.db not in dbs:
+                dbs.append(field_batch.db)
+        self._flush_atomic(field_batches, dbs)
+
+    def _flush_atomic(self, field_batches, dbs):
+        'flush in one transaction on each of the databases written'
+        if not dbs:
+            for field_batch in field_batches:
+                field_batch.flush()
+            return
+        with transaction.atomic(using=dbs[0]):
+            self._flush_atomic(field_batches, dbs[1:])
+
+
+class _FieldBatch(object):
+    'replay the buffered operations of one field and write the net changes'
+
+    def __init__(self, field, operations, using=None):
+        self.field = field
+        # the database of all the reads and writes (default: routed)
+        self.using = using
+        self.through = through = field.rel.through
+        self.operations = operations
+        self.source_field = through._meta.get_field(through._from_field_name)
+        self.source_attname = self.source_field.attname
+        self.target_attname = through._meta.get_field(through._to_field_name).attname
+        self.sort_field_name = through._sort_field_name
+        self.owner_pk_field = self.source_field.rel.get_related_field()
+        # owner pk -> owner instance, when known
+        self.owners = {}
+        self.db = self.get_db()
+
+    def get_db(self):
+        'the database of the owners of the operations (default: routed)'
+        if self.using is not None:
+            return self.using
+        dbs = set(db_for_write(self.field, owner=owner) for _, owner, _ in self.operations
+                  if isinstance(owner, models.Model))
+        if len(dbs) > 1:
+            # the net changes are written with bulk queries on one database
+            raise ValueError('Cannot batch the changes of %s on several databases (%s): '
+                             'use a batch per database' % (self.field, ', '.join(sorted(dbs))))
+        return dbs.pop() if dbs else db_for_write(self.field)
+
+    def owner_pk(self, owner):
+        if owner is None:
+            return None
+        if isinstance(owner, models.Model):
+            pk = getattr(owner, self.owner_pk_field.attname)
+            self.owners[pk] = owner
+            return pk
+        return self.owner_pk_field.get_prep_value(owner)
+
+    def load(self, db, owner_pks, loaded_owner_pks, target_ids):
+        'the current rows of the touched targets and of the owners to clear/set'
+        manager = self.through._default_manager.using(db)
+        columns = ('pk', self.source_attname, self.target_attname, self.sort_field_name)
+        rows = list(manager.filter(**{'%s__in' % self.target_attname: target_ids})
+                    .values_list(*columns)) if target_ids else []
+        if loaded_owner_pks:
+            rows += list(manager.filter(**{'%s__in' % self.source_attname: loaded_owner_pks})
+                         .values_list(*columns))
+        min_sort, max_sort = {}, {}
+        if owner_pks:
+            for owner_pk, lowest, highest in (
+                    manager.filter(**{'%s__in' % self.source_attname: owner_pks})
+                    .order_by().values_list(self.source_attname)
+                    .annotate(models.Min(self.sort_field_name), models.Max(self.sort_field_name))):
+                min_sort[owner_pk], max_sort[owner_pk] = lowest, highest
+        return rows, min_sort, max_sort
+
+    def flush(self):
+        from .utils import chunked
+
+        # normalize the operations and find what must be loaded
+        operations = []
+        owner_pks = set()
+        loaded_owner_pks = set()
+        target_ids = set()
+        for action, owner, ids in self.operations:
+            owner_pk = self.owner_pk(owner)
+            operations.append((action, owner_pk, ids))
+            if owner_pk is not None:
+                owner_pks.add(owner_pk)
+            if action in ('clear', 'set'):
+                loaded_owner_pks.add(owner_pk)
+            target_ids.update(ids)
+
+        db = self.db
+        # bounds of the sort values of each owner (not necessarily tight)
+        rows, min_sort, max_sort = self.load(db, owner_pks, loaded_owner_pks, target_ids)
+        initial = dict((target_id, (row_pk, owner_pk, sort_value))
+                       for row_pk, owner_pk, target_id, sort_value in rows)
+        owner_of = dict((target_id, row[1]) for target_id, row in initial.items())
+        sort_of = dict((target_id, row[2]) for target_id, row in initial.items())
+
+        def append(target_id, owner_pk):
+            max_sort[owner_pk] = max_sort.get(owner_pk) or 0
+            max_sort[owner_pk] += 1
+            min_sort.setdefault(owner_pk, max_sort[owner_pk])
+            owner_of[target_id] = owner_pk
+            sort_of[target_id] = max_sort[owner_pk]
+
+        def check_unowned(target_id, owner_pk):
+            if owner_of.get(target_id) not in (None, owner_pk):
+                raise IntegrityError(
+                    'UNIQUE constraint failed: %s is already related to another %s' % (
+                        target_id, self.field.model._meta.object_name))
+
+        # replay
+        for action, owner_pk, ids in operations:
+            if action == 'add':
+                for target_id in ids:
+                    check_unowned(target_id, owner_pk)
+                    if owner_of.get(target_id) != owner_pk:
+                        append(target_id, owner_pk)
+            elif action == 'move':
+                for target_id in ids:
+                    if owner_of.get(target_id) == owner_pk:
+                        continue
+                    owner_of[target_id] = None
+                    if owner_pk is not None:
+                        append(target_id, owner_pk)
+            elif action == 'prepend':
+                moving = [target_id for target_id in ids if owner_of.get(target_id) != owner_pk]
+                if min_sort.get(owner_pk) is None:
+                    for target_id in moving:
+                        append(target_id, owner_pk)
+                    continue
+                min_sort[owner_pk] -= len(moving)
+                for offset, target_id in enumerate(moving):
+                    owner_of[target_id] = owner_pk
+                    sort_of[target_id] = min_sort[owner_pk] + offset
+            elif action in ('remove', 'clear', 'set'):
+                members = [target_id for target_id, pk in owner_of.items() if pk == owner_pk]
+                for target_id in members:
+                    if action == 'clear' or (target_id in ids) == (action == 'remove'):
+                        owner_of[target_id] = None
+                if action == 'set':
+                    for target_id in ids:
+                        check_unowned(target_id, owner_pk)
+                    planned = assign_sort_values(ids, dict(
+                        (target_id, sort_of[target_id]) for target_id in ids
+                        if owner_of.get(target_id) == owner_pk))
+                    for target_id in ids:
+                        owner_of[target_id] = owner_pk
+                        sort_of[target_id] = planned.get(target_id, sort_of.get(target_id))
+                    max_sort[owner_pk] = max([max_sort.get(owner_pk) or 0] +
+                                             [sort_of[target_id] for target_id in ids])
+                    if ids:
+                        min_sort[owner_pk] = min([sort_of[target_id] for target_id in ids] +
+                                                 [min_sort.get(owner_pk) or 0])
+
+        if self.field.prevent_cycles:
+            # the checks of the buffered operations only saw the stored tree
+            from .trees import check_planned_cycles
+            check_planned_cycles(self.field, owner_of, db)
+
+        # net changes
+        deleted, updated, inserted, changes = [], [], [], []
+        removed_from, added_to = {}, {}
+        for target_id, owner_pk in owner_of.items():
+            row_pk, initial_owner_pk, initial_sort = initial.get(target_id, (None, None, None))
+            if owner_pk == initial_owner_pk and (owner_pk is None or sort_of[target_id] == initial_sort):
+                continue
+            changes.append(Change(target_id, initial_owner_pk, owner_pk,
+                                  sort_of[target_id] if owner_pk is not None else None))
+            if initial_owner_pk != owner_pk:
+                if initial_owner_pk is not None:
+                    removed_from.setdefault(initial_owner_pk, set()).add(target_id)
+                if owner_pk is not None:
+                    added_to.setdefault(owner_pk, set()).add(target_id)
+            if owner_pk is None:
+                deleted.append(row_pk)
+            elif row_pk is None:
+                inserted.append(self.through(**{
+                    self.source_attname: owner_pk,
+                    self.target_attname: target_id,
+                    self.sort_field_name: sort_of[target_id],
+                }))
+            else:
+                updated.append((row_pk, owner_pk, sort_of[target_id]))
+
+        send_signals = signals.m2m_changed.has_listeners(self.through)
+        if send_signals:
+            missing = set(removed_from) | set(added_to)
+            missing.difference_update(self.owners)
+            if missing:
+                self.owners.update(self.field.model._default_manager.using(db).in_bulk(list(missing)))
+            self.send_m2m_changed('pre', removed_from, added_to, db)
+
+        manager = self.through._default_manager.using(db)
+        with instrument('flush', self.field, rows=len(deleted) + len(updated) + len(inserted)):
+            for chunk in chunked(deleted, 500):
+                manager.filter(pk__in=chunk).delete()
+            for chunk in chunked(updated, 100):
+                manager.filter(pk__in=[row_pk for row_pk, _, _ in chunk]).update(**{
+                    self.source_attname: models.Case(
+                        *[models.When(pk=row_pk, then=models.Value(owner_pk))
+                          for row_pk, owner_pk, _ in chunk],
+                        output_field=self.source_field),
+                    self.sort_field_name: models.Case(
+                        *[models.When(pk=row_pk, then=models.Value(sort_value))
+                          for row_pk, _, sort_value in chunk],
+                        output_field=models.IntegerField()),
+                })
+            manager.bulk_create(inserted)
+        mark_written(self.field)
+
+        if send_signals:
+            self.send_m2m_changed('post', removed_from, added_to, db)
+        if needs_changes(self.field):
+            record_changes(self.field, changes, db)
+
+    def send_m2m_changed(self, when, removed_from, added_to, db):
+        for action, changes in (('remove', removed_from), ('add', added_to)):
+            for owner_pk, pk_set in changes.items():
+                signals.m2m_changed.send(sender=self.through, action='%s_%s' % (when, action),
+                    instance=self.owners.get(owner_pk), reverse=False,
+                    model=self.field.rel.to, pk_set=pk_set, using=db)
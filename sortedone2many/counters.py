@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+'''
+Denormalised counters of related objects, enabled with the ``count_field``
+option::
+
+    class Category(models.Model):
+        items_count = models.IntegerField(default=0)
+        items = SortedOneToManyField(Item, count_field='items_count')
+
+Every operation on the relation (manager operations, ``item.category = ...``,
+``sortedone2many.batch()``, ``detach()``) updates the counters of the owners
+it changed with ``F()`` expressions, in the same transaction. Counters of
+instances already loaded in memory are not refreshed.
+
+``recount()`` (or the ``recount_sortedone2many`` management command)
+recomputes them in bulk, e.g. after raw SQL changes.
+'''
+from collections import defaultdict
+
+from django.db import connections, router, transaction
+from django.db.models import F
+
+
+def update_counters(field, changes, using):
+    'apply the owner changes of ``changes`` (``signals.Change``) to the counters'
+    deltas = defaultdict(int)
+    for change in changes:
+        if change.old_owner == change.new_owner:
+            continue
+        if change.old_owner is not None:
+            deltas[change.old_owner] -= 1
+        if change.new_owner is not None:
+            deltas[change.new_owner] += 1
+    add_to_counters(field, deltas, using)
+
+
+def add_to_counters(field, deltas, using):
+    'add the ``deltas`` (owner pk -> number of related objects) to the counters'
+    from .utils import chunked
+
+    owners_by_delta = defaultdict(list)
+    for owner_pk, delta in deltas.items():
+        if delta:
+            owners_by_delta[delta].append(owner_pk)
+    manager = field.model._base_manager.using(using)
+    for delta, owner_pks in owners_by_delta.items():
+        for chunk in chunked(owner_pks, 500):
+            manager.filter(pk__in=chunk).update(**{field.count_field: F(field.count_field) + delta})
+
+
+def recount(field, owners=None, using=None, batch_size=500):
+    '''
+    Recompute the ``count_field`` of ``owners`` (pks; default: all the owners)
+    with a correlated ``UPDATE`` over ``batch_size`` owners per statement.
+    Return the number of owners.
+    '''
+    from .utils import chunked
+
+    model = field.model
+    through = field.rel.through
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    if owners is None:
+        owners = model._base_manager.using(using).order_by('pk').values_list('pk', flat=True).iterator()
+
+    sql = ('UPDATE %(owner_table)s SET %(count)s = (SELECT COUNT(*) FROM %(table)s '
+           'WHERE %(table)s.%(owner)s = %(owner_table)s.%(owner_pk)s) '
+           'WHERE %(owner_table)s.%(owner_pk)s IN (%%s)' % {
+               'owner_table': qn(model._meta.db_table),
+               'owner_pk': qn(model._meta.pk.column),
+               'count': qn(model._meta.get_field(field.count_field).column),
+               'table': qn(through._meta.db_table),
+               'owner': qn(through._meta.get_field(through._from_field_name).column),
+           })
+    count = 0
+    for batch in chunked(owners, batch_size):
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute(sql % ', '.join(['%s'] * len(batch)), batch)
+        count += len(batch)
+    return count
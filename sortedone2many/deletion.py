@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+Fast removal of the relations of many owners, e.g. before deleting categories
+with huge item lists.
+
+Django's deletion ``Collector`` only deletes the intermediary rows with one
+query when no ``pre_delete``/``post_delete``/``m2m_changed`` receivers apply to
+the ``through`` model (receivers connected without a ``sender`` apply to all
+models); otherwise it loads every row, even though it never sends these signals
+for auto-created ``through`` models. ``detach()`` picks the cheapest strategy
+sending the same signals as usual:
+
++ by default: one set-based ``DELETE``
++ ``m2m_changed`` receivers: ``clear()`` of each owner, which sends
+  ``pre_clear``/``post_clear``
++ custom ``through`` models with ``pre_delete``/``post_delete`` receivers:
+  ``delete()`` in batches of ``batch_size`` rows
+
+Inside a ``sortedone2many.batch()``, the buffered changes are written first
+and the relations are removed right away.
+'''
+from django.db import router, transaction
+from django.db.models import Count, signals
+
+from .batching import unbatched
+from .fields import SortedOneToManyField
+from .instrumentation import instrument
+from .signals import Change, is_listened, needs_changes, record_changes, record_counts
+from .utils import chunked
+
+
+def detach(field, owners, using=None, batch_size=1000):
+    '''
+    Remove all the related objects of ``owners`` (a queryset, or a list of
+    instances or pks) from the relation of ``field``, leaving the objects in
+    place. Return the number of deleted intermediary rows.
+    '''
+    through = field.rel.through
+    using = using or router.db_for_write(through)
+    rows = through._default_manager.using(using).filter(**{
+        '%s__in' % through._from_field_name: owners})
+
+    with unbatched(), instrument('detach', field) as metrics:
+        with transaction.atomic(using=using):
+            if signals.m2m_changed.has_listeners(through):
+                owner_pks = rows.order_by().values_list(
+                    through._meta.get_field(through._from_field_name).attname, flat=True).distinct()
+                deleted = rows.count()
+                for chunk in chunked(owner_pks, batch_size):
+                    for owner in field.model._default_manager.using(using).filter(pk__in=chunk):
+                        getattr(owner, field.name).clear()
+            elif not through._meta.auto_created and (
+                    signals.pre_delete.has_listeners(through) or
+                    signals.post_delete.has_listeners(through)):
+                deleted = 0
+                while True:
+                    pks = list(rows.values_list('pk', flat=True)[:batch_size])
+                    if not pks:
+                        break
+                    through._default_manager.using(using).filter(pk__in=pks).delete()
+                    deleted += len(pks)
+            else:
+                owner_attname = through._meta.get_field(through._from_field_name).attname
+                if is_listened(field):
+                    changes = [Change(item, owner, None, None) for item, owner in rows.values_list(
+                        through._meta.get_field(through._to_field_name).attname, owner_attname)]
+                elif needs_changes(field):
+                    # only the number of rows of each owner is needed
+                    deltas = dict((owner, -count) for owner, count in rows.order_by()
+                                  .values_list(owner_attname).annotate(Count('pk')))
+                deleted = rows._raw_delete(using)
+                if is_listened(field):
+                    record_changes(field, changes, using)
+                elif needs_changes(field):
+                    record_counts(field, deltas, using)
+        metrics['rows'] = deleted
+    return deleted
+
+
+def delete_owners(queryset, batch_size=1000):
+    '''
+    Delete the objects of ``queryset`` after detaching their related objects
+    from every ``SortedOneToManyField`` of the model with ``detach()``, so the
+    deletion ``Collector`` finds no intermediary rows to load. ``queryset``
+    must not filter on these relations, as it is evaluated again afterwards.
+    Return the result of ``queryset.delete()``.
+    '''
+    model = queryset.model
+    using = queryset.db
+    fields = [field for field in model._meta.many_to_many
+              if isinstance(field, SortedOneToManyField) and field.rel.through._meta.auto_created]
+    with transaction.atomic(using=using):
+        for field in fields:
+            detach(field, queryset, using, batch_size)
+        return queryset.delete()
@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
+
 import django
+from django.core import checks
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.db import models, router, transaction
+from django.db.models import signals
+from django.db.models.query import prefetch_related_objects
 from django.db.models.fields.related import (ManyToManyField, ManyToManyRel,
     RECURSIVE_RELATIONSHIP_CONSTANT)
 if django.VERSION >= (1, 9):
@@ -9,13 +17,22 @@ else:
     from django.db.models.fields.related import ManyRelatedObjectsDescriptor
     
 from django.utils import six
-from django.utils.functional import curry
+from django.utils.functional import cached_property, curry
 from django.utils.translation import ugettext_lazy as _
 
-from sortedm2m.fields import SortedManyToManyField, SORT_VALUE_FIELD_NAME
+from sortedm2m.fields import (SortedManyToManyField, SortedManyToManyDescriptor,
+    SORT_VALUE_FIELD_NAME)
 from sortedm2m.compat import get_foreignkey_field_kwargs
 
-from .forms import SortedMultipleChoiceWithDisabledField
+from .batching import get_current_batch
+from .instrumentation import instrument
+from .nplusone import enable_if_configured, record_load
+from .ordering import assign_sort_values
+from .positions import OneToManyPositionDescriptor, next_in_owner, previous_in_owner, with_position
+from .prefetch import get_limit, limit_per_owner, prefetch_top
+from .resultsets import get_result_set, track_result_sets
+from .routing import db_for_read, db_for_write, mark_written
+from .signals import Change, is_listened, needs_changes, record_changes, record_counts, track_changes
 
 
 class OneToManyRel(ManyToManyRel):
@@ -50,6 +67,7 @@ class OneToManyRelatedObjectDescriptor(ManyRelatedObjectsDescriptor):
     def __init__(self, related):
         self.related = self.rel = related
         self.cache_name = related.get_cache_name()
+        self.id_cache_name = '_%s_id_cache' % related.get_accessor_name()
         self.sup = super(OneToManyRelatedObjectDescriptor, self)
         if django.VERSION >= (1, 9):
             self.reverse = True # always True
@@ -61,40 +79,104 @@ class OneToManyRelatedObjectDescriptor(ManyRelatedObjectsDescriptor):
         # get the manager using ManyRelatedObjectsDescriptor
         return self.sup.__get__(instance)
 
+    def get_read_manager(self, instance):
+        'the manager, routed explicitly for reading'
+        db = db_for_read(self.related.field, self.related.related_model, instance, item=instance)
+        return self.get_manager(instance).db_manager(db)
+
     def get_prefetch_queryset(self, instances, queryset=None):
         instance = instances[0]
-        manager = self.get_manager(instance)
-        (queryset, rel_obj_attr, instance_attr, single, cache_name) = manager.get_prefetch_queryset(instances, queryset)
+        manager = self.get_read_manager(instance)
+        with instrument('prefetch', self.related.field, batch_size=len(instances)):
+            (queryset, rel_obj_attr, instance_attr, single, cache_name) = manager.get_prefetch_queryset(instances, queryset)
         single = True
         cache_name = self.cache_name
         return (queryset, rel_obj_attr, instance_attr, single, cache_name)
 
+    def prefetch_siblings(self, instance):
+        '''
+        Load the related objects of ``instance`` and all its uncached siblings
+        (loaded by the same queryset) in one query, as ``prefetch_related`` does.
+        Return False if ``instance`` has no siblings.
+        '''
+        result_set = get_result_set(instance)
+        if result_set is None:
+            return False
+        instances = [obj for obj in result_set.instances() if not self.is_cached(obj)]
+        if len(instances) < 2:
+            return False
+        lookup = self.related.get_accessor_name()
+        if django.VERSION >= (1, 10):
+            prefetch_related_objects(instances, lookup)
+        else:
+            prefetch_related_objects(instances, [lookup])
+        return True
+
     def __get__(self, instance, instance_type=None):
         if instance is None:
             return self
+        with instrument('get', self.related.field, instance) as metrics:
+            try:
+                rel_obj = getattr(instance, self.cache_name)
+                metrics['hit'] = True
+            except AttributeError:
+                metrics['hit'] = False
+                record_load(instance, self.related.get_accessor_name())
+                if self.related.field.auto_prefetch and self.prefetch_siblings(instance):
+                    return getattr(instance, self.cache_name)
+                manager = self.get_read_manager(instance)
+#                 manager = ManyRelatedObjectsDescriptor.__get__(self, instance, instance_type)
+                rel_obj_all = manager.all()
+                count = rel_obj_all.count()
+                if count == 0:
+                    return None
+                elif count > 1:
+                    raise Exception('Multiple (%s) instances found for OneToMany field' % count)
+                rel_obj = rel_obj_all[0]
+                setattr(instance, self.cache_name, rel_obj)
+
+        # a cached None (set by `__set__` or by prefetching) means no related object
+        return rel_obj
+
+    def get_owner_pk(self, value):
+        'the pk of the owner ``value`` (an instance or a pk), as stored in the intermediary table'
+        through = self.related.field.rel.through
+        pk_field = through._meta.get_field(through._from_field_name).rel.get_related_field()
+        if isinstance(value, models.Model):
+            return getattr(value, pk_field.attname)
         try:
-            rel_obj = getattr(instance, self.cache_name)
-        except AttributeError:
-            manager = self.get_manager(instance)
-#             manager = ManyRelatedObjectsDescriptor.__get__(self, instance, instance_type)
-            rel_obj_all = manager.all()
-            count = rel_obj_all.count()
-            if count == 0:
-                return None
-            elif count > 1:
-                raise Exception('Multiple (%s) instances found for OneToMany field' % count)
-            rel_obj = rel_obj_all[0]
-            setattr(instance, self.cache_name, rel_obj)
-
-        if rel_obj is None:
-            raise self.RelatedObjectDoesNotExist(
-                "%s has no %s." % (
-                    instance.__class__.__name__,
-                    self.related.get_accessor_name()
-                )
-            )
+            return pk_field.to_python(value)
+        except ValidationError:
+            raise ValueError('Cannot assign "%r": it is not a valid pk of a "%s" instance.' % (
+                value, self.related.related_model._meta.object_name))
+
+    def get_row_db(self, instance, db):
+        '''
+        The database to delete the intermediary row of ``instance`` from (None
+        if it has none): the one routed for writes with its current owner,
+        cached or (if routers may have put the row elsewhere than ``db``, the
+        one routed with ``instance``) read, or else ``db``.
+        '''
+        field = self.related.field
+        if self.is_cached(instance):
+            owner = getattr(instance, self.cache_name)
+        elif router.routers:
+            # without routers, relations across databases are not allowed
+            owner = self.get_read_manager(instance).first()
         else:
-            return rel_obj
+            return db
+        return db if owner is None else db_for_write(field, owner=owner, item=instance)
+
+    def clear_row(self, instance, using):
+        'delete the intermediary row of ``instance`` on ``using``, as ``manager.clear()`` does'
+        through = self.related.field.rel.through
+        target_attname = through._meta.get_field(through._to_field_name).attname
+        with transaction.atomic(using=using, savepoint=False):
+            signals.m2m_changed.send(sender=through, action='pre_clear', instance=instance,
+                reverse=True, model=self.related.related_model, pk_set=None, using=using)
+            through._default_manager.using(using).filter(**{target_attname: instance.pk}).delete()
+            signals.m2m_changed.send(sender=through, action='post_clear', instance=instance,
+                reverse=True, model=self.related.related_model, pk_set=None, using=using)
 
     def __set__(self, instance, value):
         if not self.related.field.rel.through._meta.auto_created:
@@ -132,6 +214,9 @@ class OneToManyRelatedObjectDescriptor(ManyRelatedObjectsDescriptor):
                 )
             elif value is None:
                 set_cache = True
+            else:
+                # a bare pk, e.g. from `item.category_id = '5'`
+                value = self.get_owner_pk(value)
 #                 try:
 #                     print(manager.all(), value)
 #                     value = manager.get(pk=value)
@@ -143,11 +228,38 @@ class OneToManyRelatedObjectDescriptor(ManyRelatedObjectsDescriptor):
 #                         )
 #                     )
 
-        db = router.db_for_write(manager.through, instance=manager.instance)
-        with transaction.atomic(using=db, savepoint=False):
-            manager.clear()
-            if value is not None:
-                manager.add(value)
+        current_batch = get_current_batch()
+        if current_batch is not None:
+            # the cycles are checked against the buffered changes on flush
+            current_batch.record(self.related.field, 'move', value, [instance.pk])
+        else:
+            field = self.related.field
+            field.check_cycles(value, [instance.pk])
+            db = db_for_write(field, item=instance)
+            source_db = self.get_row_db(instance, db)
+            if value is None:
+                target_db = None
+            elif set_cache:
+                target_db = db_for_write(field, owner=value, item=instance)
+            else:
+                target_db = db
+            with instrument('set', field, instance, rows=int(value is not None)):
+                if source_db is not None and source_db != target_db:
+                    # the row leaves its database (shard), or is deleted
+                    with transaction.atomic(using=source_db, savepoint=False):
+                        with track_changes(field, (), [instance.pk], source_db):
+                            self.clear_row(instance, source_db)
+                if target_db is not None:
+                    with transaction.atomic(using=target_db, savepoint=False):
+                        with track_changes(field, (), [instance.pk], target_db):
+                            if source_db == target_db:
+                                self.clear_row(instance, target_db)
+                            if target_db == db:
+                                manager.add(value)
+                            else:
+                                # the manager of the owner writes on its database
+                                getattr(value, field.name).add(instance)
+            mark_written(field)
 
         if set_cache:
             # Since we already know what the related object is, seed the related
@@ -158,6 +270,500 @@ class OneToManyRelatedObjectDescriptor(ManyRelatedObjectsDescriptor):
             # simply delete the cache, and it will be cached next time accessing it
             if hasattr(instance, self.cache_name):
                 delattr(instance, self.cache_name)
+        # the pk is known either way (see `OneToManyRelatedIdDescriptor`)
+        setattr(instance, self.id_cache_name, None if value is None else self.get_owner_pk(value))
+
+
+class OneToManyRelatedIdDescriptor(object):
+    '''
+    Accessor to the pk of the related object on the reverse side of a
+    one-to-many relation, e.g. ``item.category_id``.
+
+    The pk is read from the intermediary table, without loading the related
+    object, and not at all if ``item.category`` is cached (e.g. prefetched).
+    With ``auto_prefetch``, the pks of the uncached siblings of ``item`` are
+    read with the same query. Assigning a pk (or an instance, or None) is the
+    same as assigning ``item.category``, without fetching the related object.
+    '''
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+        self.field = descriptor.related.field
+        self.name = '%s_id' % descriptor.related.get_accessor_name()
+
+    def is_cached(self, instance):
+        return (self.descriptor.is_cached(instance) or
+                hasattr(instance, self.descriptor.id_cache_name))
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self
+        if self.descriptor.is_cached(instance):
+            owner = getattr(instance, self.descriptor.cache_name)
+            return None if owner is None else owner.pk
+        with instrument('get', self.field, instance) as metrics:
+            try:
+                owner_pk = getattr(instance, self.descriptor.id_cache_name)
+                metrics['hit'] = True
+            except AttributeError:
+                metrics['hit'] = False
+                record_load(instance, self.name)
+                instances = [instance]
+                result_set = get_result_set(instance) if self.field.auto_prefetch else None
+                if result_set is not None:
+                    instances += [obj for obj in result_set.instances()
+                                  if obj is not instance and not self.is_cached(obj)]
+                self.prefetch(instances)
+                owner_pk = getattr(instance, self.descriptor.id_cache_name)
+        return owner_pk
+
+    def __set__(self, instance, value):
+        self.descriptor.__set__(instance, value)
+
+    def prefetch(self, instances):
+        'cache the related pks of ``instances`` with one query (per 500 instances)'
+        from .utils import chunked
+
+        through = self.field.rel.through
+        source_attname = through._meta.get_field(through._from_field_name).attname
+        target_field = through._meta.get_field(through._to_field_name)
+        related_attname = target_field.rel.get_related_field().attname
+        manager = through._default_manager.using(
+            db_for_read(self.field, through, instances[0], item=instances[0]))
+        for chunk in chunked(instances, 500):
+            owner_pks = dict(manager.filter(**{
+                '%s__in' % target_field.attname: [getattr(obj, related_attname) for obj in chunk]
+            }).order_by().values_list(target_field.attname, source_attname))
+            for obj in chunk:
+                setattr(obj, self.descriptor.id_cache_name, owner_pks.get(getattr(obj, related_attname)))
+
+
+def set_default_attr(cls, name, value):
+    'set the attribute ``name`` of the model ``cls``, unless it has a field or attribute of that name'
+    if hasattr(cls, name) or any(name in (f.name, f.attname) for f in cls._meta.local_fields):
+        return
+    setattr(cls, name, value)
+
+
+def create_sorted_one2many_related_manager(superclass, field):
+    '''
+    Subclass the ``SortedRelatedManager`` of django-sortedm2m (used on the
+    forward side of the relation, e.g. ``category.items``) to instrument its
+    operations.
+    '''
+    class SortedOneToManyRelatedManager(superclass):
+        @property
+        def _queryset_class(self):
+            # the one of the default manager, if it tags the loaded instances
+            # (see ``resultsets.track_result_sets()``)
+            return self.model._default_manager._queryset_class
+
+        def _read_manager(self):
+            'this manager, routed explicitly for reading unless a db was chosen'
+            if self._db is not None:
+                return self
+            return self.db_manager(db_for_read(field, self.model, self.instance, owner=self.instance))
+
+        def get_queryset(self):
+            prefetched = getattr(self.instance, '_prefetched_objects_cache', {})
+            if self._db is None and self.prefetch_cache_name not in prefetched:
+                return self._read_manager().get_queryset()
+            return super(SortedOneToManyRelatedManager, self).get_queryset()
+
+        def get_prefetch_queryset(self, instances, queryset=None):
+            limit = get_limit(queryset)
+            with instrument('prefetch', field, batch_size=len(instances)):
+                result = super(SortedOneToManyRelatedManager, self._read_manager()).get_prefetch_queryset(
+                    instances, queryset)
+            if limit is not None:
+                # set by `prefetch_top()`
+                result = (limit_per_owner(field, result[0], instances, limit, queryset),) + result[1:]
+            return result
+
+        def _record(self, action, objs=()):
+            'buffer the operation in the active ``batch``, if any'
+            current_batch = get_current_batch()
+            if current_batch is None:
+                return False
+            current_batch.record(field, action, self.instance, self._get_target_ids(objs))
+            return True
+
+        def _check_cycles(self, objs):
+            if field.prevent_cycles:
+                field.check_cycles(self.instance, self._get_target_ids(objs),
+                                   db_for_read(field, self.through, self.instance, owner=self.instance))
+
+        def _track_changes(self, objs=(), owner=False):
+            'record the changes of ``objs`` (and of the objects of this owner)'
+            target_ids = self._get_target_ids(objs) if objs and needs_changes(field) else ()
+            return track_changes(field, [self._fk_val] if owner else (), target_ids,
+                                 db_for_write(field, owner=self.instance))
+
+        def add(self, *objs):
+            if self._record('add', objs):
+                self._seed_owner_caches(objs)
+                return
+            self._check_cycles(objs)
+            with instrument('add', field, self.instance, rows=len(objs)):
+                with self._track_changes(objs):
+                    super(SortedOneToManyRelatedManager, self).add(*objs)
+            mark_written(field)
+            self._seed_owner_caches(objs)
+        add.alters_data = True
+
+        def remove(self, *objs):
+            if self._record('remove', objs):
+                self._forget_owner_caches(objs)
+                return
+            with instrument('remove', field, self.instance, rows=len(objs)):
+                with self._track_changes(objs):
+                    super(SortedOneToManyRelatedManager, self).remove(*objs)
+            mark_written(field)
+            self._forget_owner_caches(objs)
+        remove.alters_data = True
+
+        def clear(self):
+            if self._record('clear'):
+                return
+            with instrument('clear', field, self.instance):
+                with self._track_changes(owner=True) as deltas:
+                    if deltas is not None:
+                        # only the number of related objects is needed
+                        count = (self.through._default_manager
+                                 .using(db_for_write(field, owner=self.instance))
+                                 .filter(**{self.source_field_name: self._fk_val}).count())
+                        if count:
+                            deltas[self._fk_val] = -count
+                    super(SortedOneToManyRelatedManager, self).clear()
+            mark_written(field)
+        clear.alters_data = True
+
+        def set(self, objs, **kwargs):
+            # Force evaluation of `objs` in case it's a queryset whose value
+            # could be affected by the changes.
+            objs = tuple(objs)
+            if self._record('set', objs):
+                self._seed_owner_caches(objs)
+                return
+            self._check_cycles(objs)
+            with instrument('set_items', field, self.instance, rows=len(objs)) as metrics:
+                if kwargs.get('clear'):
+                    # replace the relation wholesale, as ``SortedManyToManyField`` does
+                    # (``clear()`` and ``add()`` record their changes)
+                    super(SortedOneToManyRelatedManager, self).set(objs, **kwargs)
+                else:
+                    metrics['rows'] = self._set_items(objs)
+            mark_written(field)
+            self._seed_owner_caches(objs)
+        set.alters_data = True
+
+        def _update_sort_values(self, manager, updated):
+            'write the ``(row_pk, sort_value)`` pairs of ``updated`` with CASE updates'
+            from .utils import chunked
+
+            sort_field_name = self.through._sort_field_name
+            for chunk in chunked(updated, 100):
+                manager.filter(pk__in=[row_pk for row_pk, _ in chunk]).update(**{
+                    sort_field_name: models.Case(
+                        *[models.When(pk=row_pk, then=models.Value(sort_value))
+                          for row_pk, sort_value in chunk],
+                        output_field=models.IntegerField())})
+
+        def move(self, obj, index):
+            '''
+            Move the related object ``obj`` (an instance or a pk) to the 0-based
+            ``index`` of the list (as ``list.insert()`` does). Return the number
+            of updated rows: usually only the row of ``obj``.
+            '''
+            return self.move_many([(obj, index)])
+        move.alters_data = True
+
+        def move_many(self, moves):
+            '''
+            Apply the ``(obj, index)`` moves of ``moves`` in order, like
+            ``move()``, reading the list once and writing only the rows whose
+            sort value must change. Raise ``ValueError`` if an object is not
+            related to this owner.
+            '''
+            current_batch = get_current_batch()
+            if current_batch is not None:
+                current_batch.flush()
+            moves = [(self._get_target_ids([obj])[0], index) for obj, index in moves]
+            db = db_for_write(field, owner=self.instance)
+            manager = self.through._default_manager.using(db)
+            sort_field_name = self.through._sort_field_name
+            target_attname = self.through._meta.get_field(self.target_field_name).attname
+
+            with instrument('move', field, self.instance, rows=len(moves)) as metrics:
+                with transaction.atomic(using=db):
+                    rows = (manager.filter(**{self.source_field_name: self._fk_val})
+                            .order_by(sort_field_name, 'pk')
+                            .values_list('pk', target_attname, sort_field_name))
+                    row_pks = {}
+                    current = {}
+                    order = []
+                    for row_pk, target_id, sort_value in rows:
+                        row_pks[target_id] = row_pk
+                        current[target_id] = sort_value
+                        order.append(target_id)
+                    for target_id, index in moves:
+                        if target_id not in current:
+                            raise ValueError('%r is not related to %r' % (target_id, self.instance))
+                        order.remove(target_id)
+                        order.insert(index, target_id)
+                    planned = assign_sort_values(order, current)
+                    updated = [(row_pks[target_id], sort_value) for target_id, sort_value in planned.items()]
+                    self._update_sort_values(manager, updated)
+                    if updated and needs_changes(field):
+                        record_changes(field, [Change(target_id, self._fk_val, self._fk_val, sort_value)
+                                               for target_id, sort_value in planned.items()], db)
+                metrics['rows'] = len(updated)
+            mark_written(field)
+            return len(updated)
+        move_many.alters_data = True
+
+        def merge_into(self, other, position='end'):
+            '''
+            Move all the related objects of this owner to ``other`` (an instance
+            or a pk), at the ``'end'`` or the ``'start'`` of its list, keeping
+            their order. Return the number of moved objects.
+
+            The sort values are shifted by a constant offset, so whatever the
+            number of objects, this takes two queries: the bounds of both lists,
+            then a single ``UPDATE``.
+            '''
+            return self._move_rows(other, position, 'merge')
+        merge_into.alters_data = True
+
+        def split(self, at_index, new_owner):
+            '''
+            Move the related objects of this owner from the 0-based position
+            ``at_index`` onwards to the end of the list of ``new_owner`` (an
+            instance or a pk), keeping their order, as ``merge_into()`` does.
+            Return the number of moved objects.
+            '''
+            if at_index < 0:
+                raise ValueError('at_index must not be negative, got %r' % (at_index,))
+            current_batch = get_current_batch()
+            if current_batch is not None:
+                # the position is read from the rows written so far
+                current_batch.flush()
+            db = db_for_write(field, owner=self.instance)
+            sort_field_name = self.through._sort_field_name
+            first = list(self.through._default_manager.using(db)
+                         .filter(**{self.source_field_name: self._fk_val})
+                         .order_by(sort_field_name, 'pk')
+                         .values_list(sort_field_name, 'pk')[at_index:at_index + 1])
+            if not first:
+                return 0
+            sort_value, row_pk = first[0]
+            condition = (models.Q(**{'%s__gt' % sort_field_name: sort_value}) |
+                         models.Q(**{sort_field_name: sort_value, 'pk__gte': row_pk}))
+            return self._move_rows(new_owner, 'end', 'split', condition)
+        split.alters_data = True
+
+        def _move_rows(self, owner, position, operation, condition=None):
+            'move the rows of this owner (matching ``condition``) to ``owner``'
+            if position not in ('end', 'start'):
+                raise ValueError("position must be 'end' or 'start', not %r" % (position,))
+            current_batch = get_current_batch()
+            if current_batch is not None:
+                # keep the order of the operations
+                current_batch.flush()
+
+            source_field = self.through._meta.get_field(self.source_field_name)
+            owner_pk_field = source_field.rel.get_related_field()
+            if isinstance(owner, models.Model):
+                owner_pk = getattr(owner, owner_pk_field.attname)
+            else:
+                owner_pk = owner_pk_field.get_prep_value(owner)
+            db = db_for_write(field, owner=self.instance)
+            if isinstance(owner, models.Model) and db_for_write(field, owner=owner) != db:
+                # the rows are moved with a single UPDATE
+                raise ValueError('Cannot move the related objects of %r to %r: their rows are '
+                                 'on different databases' % (self.instance, owner))
+            if owner_pk == self._fk_val:
+                return 0
+            sort_field_name = self.through._sort_field_name
+            manager = self.through._default_manager.using(db)
+            condition = models.Q(**{self.source_field_name: self._fk_val}) & (condition or models.Q())
+            rows = manager.filter(condition)
+            target_attname = self.through._meta.get_field(self.target_field_name).attname
+            send_signals = signals.m2m_changed.has_listeners(self.through)
+            if field.prevent_cycles or send_signals or is_listened(field):
+                # the sort values are needed for the ``one2many_changed`` changes
+                sort_values = OrderedDict(rows.order_by(sort_field_name, 'pk')
+                                          .values_list(target_attname, sort_field_name))
+                target_ids = set(sort_values)
+                if field.prevent_cycles:
+                    field.check_cycles(owner, target_ids, db)
+
+            with instrument(operation, field, self.instance) as metrics:
+                with transaction.atomic(using=db):
+                    bounds = dict(
+                        (pk, (lowest, highest)) for pk, lowest, highest in
+                        manager.filter(condition | models.Q(**{self.source_field_name: owner_pk}))
+                        .order_by().values_list(source_field.attname)
+                        .annotate(models.Min(sort_field_name), models.Max(sort_field_name)))
+                    if self._fk_val not in bounds:
+                        metrics['rows'] = 0
+                        return 0
+                    lowest, highest = bounds[self._fk_val]
+                    if owner_pk not in bounds:
+                        offset = 0
+                    elif position == 'end':
+                        offset = bounds[owner_pk][1] - lowest + 1
+                    else:
+                        offset = bounds[owner_pk][0] - highest - 1
+
+                    if send_signals:
+                        if not isinstance(owner, models.Model):
+                            owner = field.model._default_manager.using(db).get(pk=owner_pk)
+                        new_manager = getattr(owner, field.name)
+                        self._send_m2m_changed('pre_remove', target_ids, db)
+                        new_manager._send_m2m_changed('pre_add', target_ids, db)
+                    moved = rows.update(**{
+                        self.source_field_name: owner_pk,
+                        sort_field_name: models.F(sort_field_name) + offset,
+                    })
+                    if send_signals:
+                        self._send_m2m_changed('post_remove', target_ids, db)
+                        new_manager._send_m2m_changed('post_add', target_ids, db)
+                    if moved and is_listened(field):
+                        record_changes(field, [Change(target_id, self._fk_val, owner_pk, sort_value + offset)
+                                               for target_id, sort_value in sort_values.items()], db)
+                    elif moved and needs_changes(field):
+                        record_counts(field, {self._fk_val: -moved, owner_pk: moved}, db)
+                metrics['rows'] = moved
+            mark_written(field)
+            return moved
+
+        def _seed_owner_caches(self, objs):
+            '''
+            Cache this owner as the related object of the given instances, e.g.
+            the items cleaned by a form, so ``item.category`` needs no query.
+            '''
+            descriptor = getattr(self.model, field.rel.get_accessor_name())
+            for obj in objs:
+                if isinstance(obj, self.model):
+                    setattr(obj, descriptor.cache_name, self.instance)
+                    setattr(obj, descriptor.id_cache_name, self._fk_val)
+
+        def _forget_owner_caches(self, objs):
+            'uncache this owner as the related object of the given (removed) instances'
+            descriptor = getattr(self.model, field.rel.get_accessor_name())
+            for obj in objs:
+                if not isinstance(obj, self.model):
+                    continue
+                owner = getattr(obj, descriptor.cache_name, None)
+                if ((owner is not None and descriptor.get_owner_pk(owner) == self._fk_val) or
+                        getattr(obj, descriptor.id_cache_name, None) == self._fk_val):
+                    setattr(obj, descriptor.cache_name, None)
+                    setattr(obj, descriptor.id_cache_name, None)
+
+        def _send_m2m_changed(self, action, pk_set, using):
+            signals.m2m_changed.send(sender=self.through, action=action,
+                instance=self.instance, reverse=self.reverse,
+                model=self.model, pk_set=pk_set, using=using)
+
+        def _get_target_ids(self, objs):
+            'the pks of ``objs`` (instances or pks) in order, without duplicates'
+            target_field = self.through._meta.get_field(self.target_field_name)
+            related_field = target_field.rel.get_related_field()
+            target_ids = []
+            for obj in objs:
+                if isinstance(obj, self.model):
+                    if not router.allow_relation(obj, self.instance):
+                        raise ValueError(
+                            'Cannot add "%r": instance is on database "%s", value is on database "%s"' %
+                            (obj, self.instance._state.db, obj._state.db)
+                        )
+                    target_id = getattr(obj, related_field.attname)
+                    if target_id is None:
+                        raise ValueError('Cannot add "%r": the value for field "%s" is None' %
+                                         (obj, self.target_field_name))
+                elif isinstance(obj, models.Model):
+                    raise TypeError("'%s' instance expected, got %r" %
+                                    (self.model._meta.object_name, obj))
+                else:
+                    target_id = related_field.get_prep_value(obj)
+                target_ids.append(target_id)
+            return list(OrderedDict.fromkeys(target_ids))
+
+        def _set_items(self, objs):
+            '''
+            Store exactly ``objs`` in this order with a minimal diff: delete the
+            rows of the removed objects, insert the new ones and only update the
+            sort values of the rows that are not on a longest increasing
+            subsequence of the current order. Return the number of written rows.
+            '''
+            from .utils import chunked
+
+            new_ids = self._get_target_ids(objs)
+            db = db_for_write(field, owner=self.instance)
+            manager = self.through._default_manager.using(db)
+            sort_field_name = self.through._sort_field_name
+            target_attname = '%s_id' % self.target_field_name
+
+            with transaction.atomic(using=db, savepoint=False):
+                rows = (manager.filter(**{self.source_field_name: self._fk_val})
+                        .order_by(sort_field_name, 'pk')
+                        .values_list('pk', target_attname, sort_field_name))
+                new_ids_set = set(new_ids)
+                row_pks = {}
+                current = {}
+                removed = {}
+                for row_pk, target_id, sort_value in rows:
+                    if target_id in new_ids_set:
+                        row_pks[target_id] = row_pk
+                        current[target_id] = sort_value
+                    else:
+                        removed[target_id] = row_pk
+                planned = assign_sort_values(new_ids, current)
+                updated = [(row_pks[target_id], sort_value)
+                           for target_id, sort_value in planned.items() if target_id in current]
+                added = [target_id for target_id in new_ids if target_id not in current]
+
+                if removed:
+                    self._send_m2m_changed('pre_remove', set(removed), db)
+                    for chunk in chunked(removed.values(), 500):
+                        manager.filter(pk__in=chunk).delete()
+                    self._send_m2m_changed('post_remove', set(removed), db)
+
+                self._update_sort_values(manager, updated)
+
+                if added:
+                    self._send_m2m_changed('pre_add', set(added), db)
+                    manager.bulk_create([
+                        self.through(**{
+                            '%s_id' % self.source_field_name: self._fk_val,
+                            target_attname: target_id,
+                            sort_field_name: planned[target_id],
+                        })
+                        for target_id in added
+                    ])
+                    self._send_m2m_changed('post_add', set(added), db)
+
+                if needs_changes(field):
+                    changes = [Change(target_id, self._fk_val, None, None) for target_id in removed]
+                    changes += [Change(target_id, self._fk_val if target_id in current else None,
+                                       self._fk_val, sort_value) for target_id, sort_value in planned.items()]
+                    record_changes(field, changes, db)
+
+            return len(removed) + len(updated) + len(added)
+
+    return SortedOneToManyRelatedManager
+
+
+class SortedOneToManyDescriptor(SortedManyToManyDescriptor):
+    '''
+    Accessor to the related objects manager on the forward side of a
+    one-to-many relation, i.e. ``category.items``.
+    '''
+    @cached_property
+    def related_manager_cls(self):
+        return create_sorted_one2many_related_manager(
+            super(SortedOneToManyDescriptor, self).related_manager_cls,
+            self.field)
 
 
 class SortedOneToManyField(SortedManyToManyField):
@@ -195,8 +801,21 @@ class SortedOneToManyField(SortedManyToManyField):
 
     description = _("One-to-many relationship")
 
-    def __init__(self, to, sorted=True, **kwargs):  # through_app_label=None,
+    def __init__(self, to, sorted=True, auto_prefetch=False, prevent_cycles=False,
+                 count_field=None, version_field=None, **kwargs):  # through_app_label=None,
         self.sorted = sorted
+        # load the related objects of all instances from the same queryset
+        # together on the first access of the reverse accessor (e.g. `item.category`)
+        self.auto_prefetch = auto_prefetch
+        # self-referential fields: refuse to relate an object to itself or to
+        # one of its descendants
+        self.prevent_cycles = prevent_cycles
+        # name of an integer field of the owner model counting the related
+        # objects, maintained by every operation (see `sortedone2many.counters`)
+        self.count_field = count_field
+        # name of an integer field of the owner model incremented whenever
+        # its list of related objects changes (see `sortedone2many.versions`)
+        self.version_field = version_field
         self.sort_value_field_name = kwargs.pop(
             'sort_value_field_name',
             SORT_VALUE_FIELD_NAME)
@@ -244,7 +863,56 @@ class SortedOneToManyField(SortedManyToManyField):
         if self.sorted:
             self.help_text = kwargs.get('help_text', None)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(SortedOneToManyField, self).deconstruct()
+        if self.auto_prefetch:
+            kwargs['auto_prefetch'] = True
+        if self.prevent_cycles:
+            kwargs['prevent_cycles'] = True
+        if self.count_field:
+            kwargs['count_field'] = self.count_field
+        if self.version_field:
+            kwargs['version_field'] = self.version_field
+        return name, path, args, kwargs
+
+    def check(self, **kwargs):
+        errors = super(SortedOneToManyField, self).check(**kwargs)
+        errors.extend(self._check_count_field())
+        errors.extend(self._check_version_field())
+        return errors
+
+    def _check_integer_field(self, option, error_id):
+        name = getattr(self, option)
+        if not name:
+            return []
+        try:
+            field = self.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            field = None
+        if not isinstance(field, models.IntegerField):
+            return [checks.Error(
+                "'%s' refers to '%s', which is not an integer field of '%s'." % (
+                    option, name, self.model._meta.object_name),
+                hint=None, obj=self, id=error_id)]
+        return []
+
+    def _check_count_field(self):
+        return self._check_integer_field('count_field', 'sortedone2many.E001')
+
+    def _check_version_field(self):
+        return self._check_integer_field('version_field', 'sortedone2many.E002')
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(SortedOneToManyField, self).contribute_to_class(cls, name, **kwargs)
+        if self.sorted:
+            # !! changed to `SortedOneToManyDescriptor`
+            setattr(cls, self.name, SortedOneToManyDescriptor(self))
+
     def formfield(self, **kwargs):
+        # imported here to keep the form and template machinery out of
+        # processes that never render forms (workers, management commands)
+        from .forms import SortedMultipleChoiceWithDisabledField
+
         defaults = {}
         if self.sorted:
             defaults['form_class'] = SortedMultipleChoiceWithDisabledField
@@ -254,6 +922,128 @@ class SortedOneToManyField(SortedManyToManyField):
         defaults.update(kwargs)
         return super(SortedManyToManyField, self).formfield(**defaults)
 
+    def iter_related(self, fields=None, owners=None, using=None):
+        '''
+        Stream ``(owner_pk, related)`` tuples for every owner of this field
+        (ordered by ``owner_pk``) with a single query, without instantiating
+        any model. ``related`` is the list of related pks in sort order, or a
+        list of value tuples of the related ``fields`` if given::
+
+            field = Category._meta.get_field('items')
+            for category_pk, items in field.iter_related(['pk', 'name']):
+                ...
+
+        The rows are fetched with ``QuerySet.iterator()`` (in chunks, or with a
+        server-side cursor where the backend supports it) and grouped on the fly.
+        ``owners`` optionally restricts the owners (a queryset or list of pks).
+        '''
+        through = self.rel.through
+        source_name = through._from_field_name
+        target_name = through._to_field_name
+        source_attname = through._meta.get_field(source_name).attname
+        if fields:
+            columns = ['%s__%s' % (target_name, name) for name in fields]
+        else:
+            columns = [through._meta.get_field(target_name).attname]
+
+        db = using or db_for_read(self, through)
+        queryset = through._default_manager.using(db)
+        if owners is not None:
+            queryset = queryset.filter(**{'%s__in' % source_name: owners})
+        rows = (queryset.order_by(source_attname, through._sort_field_name, 'pk')
+                .values_list(source_attname, *columns).iterator())
+
+        for owner_pk, group in groupby(rows, itemgetter(0)):
+            if fields:
+                yield owner_pk, [row[1:] for row in group]
+            else:
+                yield owner_pk, [row[1] for row in group]
+
+    def assign_owner(self, queryset, owner, position='end'):
+        '''
+        Move all the related objects of ``queryset`` (e.g. items) to ``owner``
+        (None to detach them), at the ``'end'`` or the ``'start'`` of its list,
+        in the order of ``queryset`` (by pk if unordered). Objects already
+        related to ``owner`` keep their place. Return the number of objects.
+
+        The rows are written with set-based statements, whatever their number
+        (see ``sortedone2many.assignment``). An active ``batch()`` is flushed
+        first.
+        '''
+        from .assignment import assign_owner
+        return assign_owner(self, queryset, owner, position)
+    assign_owner.alters_data = True
+
+    def get_etag(self, owner, using=None):
+        '''
+        Return the ETag of the list of related objects of ``owner``, from its
+        ``version_field``. See ``sortedone2many.versions``.
+        '''
+        from .versions import get_etag
+
+        return get_etag(self, owner, using)
+
+    def get_etags(self, owners, using=None):
+        'Return the ETags of the lists of ``owners`` by pk, with one query.'
+        from .versions import get_etags
+
+        return get_etags(self, owners, using)
+
+    def prefetch_top(self, limit, queryset=None, to_attr=None, lookup=None):
+        '''
+        Return a ``Prefetch`` of the first ``limit`` related objects of each
+        owner, limited in the database. See ``sortedone2many.prefetch``.
+        '''
+        return prefetch_top(self, limit, queryset, to_attr, lookup)
+
+    def with_related_values(self, queryset, fields=None, name=None):
+        '''
+        Annotate the owners of ``queryset`` with the ordered values of their
+        related objects (e.g. ``category.items_values``), aggregated by the
+        database. See ``sortedone2many.aggregates``.
+        '''
+        from .aggregates import with_related_values
+
+        return with_related_values(self, queryset, fields, name)
+
+    def with_position(self, queryset, name=None):
+        '''
+        Annotate the related objects of ``queryset`` with their position in
+        the list of their owner (e.g. ``item.category_position``).
+        See ``sortedone2many.positions``.
+        '''
+        return with_position(self, queryset, name)
+
+    def descendants(self, node, using=None):
+        '''
+        Self-referential fields only: the descendants of ``node`` in depth-first
+        order, with a single recursive query. See ``sortedone2many.trees``.
+        '''
+        from .trees import descendants
+        return descendants(self, node, using)
+
+    def ancestors(self, node, using=None):
+        'Self-referential fields only: the ancestors of ``node``, nearest first.'
+        from .trees import ancestors
+        return ancestors(self, node, using)
+
+    def subtree_ordered(self, node, using=None):
+        '''
+        Self-referential fields only: ``node`` and its descendants as
+        ``(instance, depth)`` tuples in depth-first order.
+        '''
+        from .trees import subtree_ordered
+        return subtree_ordered(self, node, using)
+
+    def check_cycles(self, owner, target_ids, using=None):
+        '''
+        With ``prevent_cycles``, raise ``ValueError`` if relating ``target_ids``
+        to ``owner`` would create a cycle. See ``sortedone2many.trees``.
+        '''
+        if self.prevent_cycles and owner is not None and target_ids:
+            from .trees import check_cycles
+            check_cycles(self, owner, target_ids, using)
+
     def get_intermediate_model_to_field(self, klass):
         name = self.get_intermediate_model_name(klass)
 
@@ -275,7 +1065,19 @@ class SortedOneToManyField(SortedManyToManyField):
         # and swapped models don't get a related descriptor.
         # !! changed to `OneToManyRelatedObjectDescriptor`
         if not self.rel.is_hidden() and not related.related_model._meta.swapped:
-            setattr(cls, related.get_accessor_name(), OneToManyRelatedObjectDescriptor(related))
+            accessor_name = related.get_accessor_name()
+            descriptor = OneToManyRelatedObjectDescriptor(related)
+            setattr(cls, accessor_name, descriptor)
+            # e.g. `item.category_id`, `item.category_position`,
+            # `item.next_in_category()`, unless the model defines them
+            set_default_attr(cls, '%s_id' % accessor_name, OneToManyRelatedIdDescriptor(descriptor))
+            set_default_attr(cls, '%s_position' % accessor_name, OneToManyPositionDescriptor(self))
+            set_default_attr(cls, 'next_in_%s' % accessor_name, curry(next_in_owner, field=self))
+            set_default_attr(cls, 'previous_in_%s' % accessor_name, curry(previous_in_owner, field=self))
+            # the instances of `cls` remember their result set if needed
+            enable_if_configured(cls)
+            if self.auto_prefetch:
+                track_result_sets(cls)
 
         # Set up the accessors for the column names on the m2m table
         self.m2m_column_name = curry(self._get_m2m_attr, related, 'column')
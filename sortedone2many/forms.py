@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 from itertools import chain
 from django import forms
+from django.core.exceptions import ValidationError
+from django.db.models import F
 from django.template.loader import render_to_string
 from django.utils.encoding import force_text
 from django.utils.html import conditional_escape
 from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext_lazy as _
 
 from sortedm2m.forms import SortedCheckboxSelectMultiple, SortedMultipleChoiceField
 
@@ -13,7 +17,15 @@ class SortedCheckboxSelectMultipleWithDisabled(SortedCheckboxSelectMultiple):
     '''
     Render a list of ``choices`` as checkboxes that can be sorted using drag & drop.
     Some checkboxes are rendered as "disabled" according to the ``disabled_value``.
+
+    If ``move_url`` is set (see ``One2ManyModelAdmin.move_view``), each drag and
+    drop of a related object is saved immediately.
     '''
+    move_url = None
+
+    class Media:
+        js = ('sortedone2many/widget.js',)
+
     # override render()
     def render(self, name, value, attrs=None, choices=()):
         disabled_value = getattr(self, 'disabled_value', [])
@@ -62,6 +74,9 @@ class SortedCheckboxSelectMultipleWithDisabled(SortedCheckboxSelectMultiple):
         html = render_to_string(
             'sortedm2m/sorted_checkbox_select_multiple_widget.html',
             {'selected': selected, 'unselected': unselected})
+        if self.move_url:
+            html = '<div class="sortedone2many-container" data-move-url="%s">%s</div>' % (
+                conditional_escape(self.move_url), html)
         return mark_safe(html)
 
 
@@ -81,14 +96,73 @@ class SortedMultipleChoiceWithDisabledField(SortedMultipleChoiceField):
 
     Pass a list of ``disabled_value`` to the widget so that the widget can decide
     whether to render a checkbox as "disabled".
+
+    The same rule is enforced when cleaning: if ``owner`` (the instance being
+    edited, set by ``One2ManyModelForm``) is given, objects that already belong
+    to another owner are rejected.
     '''
 
     widget = SortedCheckboxSelectMultipleWithDisabled
+    default_error_messages = {
+        'owned': _('Select a valid choice. %(value)s already belongs to another object.'),
+    }
+    owner_attname = '_sortedone2many_owner_pk'
 
     def __init__(self, related_query_name, *args, **kwargs):
         super(SortedMultipleChoiceWithDisabledField, self).__init__(*args, **kwargs)
+        self.related_query_name = related_query_name
+        self.owner = None
         # find all items that have an non-null category
         disabled_value = self.queryset.filter(**{related_query_name + '__isnull':False}
                                                 ).values_list('pk', flat=True)
         self.widget.disabled_value = disabled_value
 
+    def clean(self, value):
+        '''
+        Return the selected objects in the submitted order. Unlike
+        ``ModelMultipleChoiceField``, the pks are converted in Python and the
+        objects fetched together with their current owner in a single query,
+        however many are submitted.
+        '''
+        if self.required and not value:
+            raise ValidationError(self.error_messages['required'], code='required')
+        elif not self.required and not value:
+            return self.queryset.none()
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError(self.error_messages['list'], code='list')
+
+        key = self.to_field_name or 'pk'
+        opts = self.queryset.model._meta
+        key_field = opts.pk if key == 'pk' else opts.get_field(key)
+        values = OrderedDict()  # python value -> submitted value
+        for val in value:
+            try:
+                values.setdefault(key_field.to_python(val), val)
+            except (ValidationError, TypeError):
+                raise ValidationError(
+                    self.error_messages['invalid_pk_value'],
+                    code='invalid_pk_value',
+                    params={'pk': val},
+                )
+
+        queryset = (self.queryset.filter(**{'%s__in' % key: list(values)})
+                    .annotate(**{self.owner_attname: F(self.related_query_name)}))
+        objects = dict((getattr(obj, key_field.attname), obj) for obj in queryset)
+        owner_pk = getattr(self.owner, 'pk', None)
+        for python_value, val in values.items():
+            obj = objects.get(python_value)
+            if obj is None:
+                raise ValidationError(
+                    self.error_messages['invalid_choice'],
+                    code='invalid_choice',
+                    params={'value': val},
+                )
+            obj_owner_pk = getattr(obj, self.owner_attname)
+            if self.owner is not None and obj_owner_pk is not None and obj_owner_pk != owner_pk:
+                raise ValidationError(
+                    self.error_messages['owned'],
+                    code='owned',
+                    params={'value': val},
+                )
+        self.run_validators(value)
+        return [objects[python_value] for python_value in values]
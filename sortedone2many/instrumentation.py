@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+'''
+Optional instrumentation of the operations performed by ``SortedOneToManyField``.
+
+Every instrumented operation sends the ``operation_performed`` signal (with the
+intermediary ``through`` model as the sender) once it has finished. Nothing is
+measured unless at least one receiver is connected, so the hooks cost next to
+nothing in production.
+
+Operations and their extra metrics:
+
++ ``get``: ``item.category`` was read; ``hit`` tells whether the cache was used
++ ``set``: ``item.category = ...`` was assigned
++ ``add``, ``remove``, ``clear``, ``set_items``: ``category.items`` was changed
++ ``prefetch``: a ``prefetch_related()`` batch of ``batch_size`` instances
++ ``detach``: ``sortedone2many.deletion.detach()`` removed the related objects
+  of many owners
++ ``flush``: the buffered changes of a ``sortedone2many.batch()`` were written
++ ``move``: ``category.items.move()`` or ``move_many()`` reordered the list
++ ``merge``, ``split``: ``category.items.merge_into()`` or
+  ``category.items.split()`` moved related objects to another owner
+
+All operations report ``queries`` (number of executed queries), ``elapsed``
+(seconds) and ``rows`` (number of related objects written, ``None`` if unknown).
+'''
+import time
+from contextlib import contextmanager
+
+from django.db import connections
+from django.dispatch import Signal
+
+
+operation_performed = Signal(providing_args=[
+    'operation', 'field', 'instance', 'hit', 'batch_size', 'rows',
+    'queries', 'elapsed'])
+
+
+class _CountingCursor(object):
+    'cursor wrapper counting the executed queries in ``counter``'
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def execute(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def callproc(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.callproc(*args, **kwargs)
+
+
+class _QueryCounter(object):
+    '''
+    Count the queries executed inside the block by wrapping the cursors made
+    by the connections of the current thread (the query log is left alone).
+    '''
+    methods = ('make_cursor', 'make_debug_cursor')
+
+    def __init__(self):
+        self.count = 0
+        self.saved = []
+
+    def wrap(self, make_cursor):
+        def wrapper(cursor):
+            return _CountingCursor(make_cursor(cursor), self)
+        return wrapper
+
+    def __enter__(self):
+        for alias in connections:
+            connection = connections[alias]
+            for name in self.methods:
+                self.saved.append((connection, name, connection.__dict__.get(name)))
+                setattr(connection, name, self.wrap(getattr(connection, name)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for connection, name, method in reversed(self.saved):
+            if method is None:
+                del connection.__dict__[name]
+            else:
+                setattr(connection, name, method)
+
+
+@contextmanager
+def instrument(operation, field, instance=None, **metrics):
+    '''
+    Measure the wrapped block and send ``operation_performed`` afterwards.
+
+    Yield a dict of metrics that the block may update (e.g. ``hit`` or ``rows``).
+    '''
+    sender = field.rel.through
+    if not operation_performed.has_listeners(sender):
+        yield metrics
+        return
+
+    start = time.time()
+    with _QueryCounter() as counter:
+        yield metrics
+    elapsed = time.time() - start
+
+    metrics.setdefault('rows', None)
+    operation_performed.send(sender=sender, operation=operation, field=field,
+                             instance=instance, queries=counter.count,
+                             elapsed=elapsed, **metrics)
+
+
+class MetricsCollector(object):
+    '''
+    In-memory receiver of ``operation_performed``, mostly useful in tests::
+
+        with MetricsCollector() as collector:
+            category.items.add(item)
+        collector.filter('add')[0]['queries']
+
+    Pass a ``sender`` (the ``through`` model of a field) to only collect the
+    operations of that field.
+    '''
+    def __init__(self, sender=None):
+        self.sender = sender
+        self.records = []
+
+    def receive(self, sender, **kwargs):
+        kwargs.pop('signal', None)
+        kwargs['sender'] = sender
+        self.records.append(kwargs)
+
+    def start(self):
+        operation_performed.connect(self.receive, sender=self.sender, weak=False)
+
+    def stop(self):
+        operation_performed.disconnect(self.receive, sender=self.sender)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def filter(self, operation=None):
+        return [record for record in self.records
+                if operation is None or record['operation'] == operation]
+
+    def summary(self):
+        'aggregate the collected records per operation'
+        summary = {}
+        for record in self.records:
+            stats = summary.setdefault(record['operation'], {
+                'count': 0, 'queries': 0, 'rows': 0, 'elapsed': 0.0,
+                'hits': 0, 'misses': 0})
+            stats['count'] += 1
+            stats['queries'] += record['queries']
+            stats['rows'] += record['rows'] or 0
+            stats['elapsed'] += record['elapsed']
+            if record.get('hit') is True:
+                stats['hits'] += 1
+            elif record.get('hit') is False:
+                stats['misses'] += 1
+        return summary
+
+
+@contextmanager
+def assert_max_queries(max_queries, operation=None, sender=None):
+    '''
+    Fail with an ``AssertionError`` if any (matching) operation performed inside
+    the block executes more than ``max_queries`` queries::
+
+        with assert_max_queries(2, 'set'):
+            self.client.post(url, data)
+    '''
+    with MetricsCollector(sender) as collector:
+        yield collector
+    for record in collector.filter(operation):
+        if record['queries'] > max_queries:
+            raise AssertionError(
+                '%s on %s executed %s queries (max %s allowed)' % (
+                    record['operation'], record['field'], record['queries'],
+                    max_queries))
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+'''
+Check and repair the intermediary tables of ``SortedOneToManyField``.
+
+Anomalies are found with set-based queries (no per-row python):
+
++ ``duplicates``: owners having several rows with the same sort value
++ ``missing_owners``: rows pointing at a deleted owner
++ ``missing_items``: rows pointing at a deleted related object
++ ``gaps`` (only on request): owners whose sort values are not exactly
+  ``1..n``. This is not an anomaly: removals, ``move()``, ``merge_into()``
+  and prepending leave gaps, zero or negative values on purpose, but
+  renumbering may be wanted for readability.
+
+Repairs run in batches to keep lock times short on big tables.
+'''
+from django.db import connections, router, transaction
+
+from .utils import chunked, get_table_info
+
+
+def _fetch_column(connection, sql, params=()):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _orphans(field, using, side):
+    'queryset of the rows whose owner (or related object) no longer exists'
+    through = field.rel.through
+    name = through._from_field_name if side == 'owner' else through._to_field_name
+    model = through._meta.get_field(name).rel.to
+    # the base manager sees all the rows, even if the default manager filters some out
+    return (through._default_manager.using(using)
+            .exclude(**{'%s__in' % name: model._base_manager.using(using).all()}))
+
+
+def find_anomalies(field, using=None, gaps=False):
+    '''
+    Return a dict with the owner pks having ``duplicates`` in their sort
+    values, and the numbers of rows with ``missing_owners`` or
+    ``missing_items``; plus the owner pks with ``gaps`` if requested.
+    '''
+    through = field.rel.through
+    using = using or router.db_for_read(through)
+    connection = connections[using]
+    info = get_table_info(field, connection)
+
+    duplicates = _fetch_column(connection, (
+        'SELECT DISTINCT %(owner)s FROM %(table)s '
+        'GROUP BY %(owner)s, %(sort)s HAVING COUNT(*) > 1' % info))
+    anomalies = {
+        'duplicates': sorted(duplicates),
+        'missing_owners': _orphans(field, using, 'owner').count(),
+        'missing_items': _orphans(field, using, 'item').count(),
+    }
+    if gaps:
+        owners = _fetch_column(connection, (
+            'SELECT %(owner)s FROM %(table)s GROUP BY %(owner)s '
+            'HAVING MIN(%(sort)s) <> 1 OR MAX(%(sort)s) <> COUNT(*)' % info))
+        anomalies['gaps'] = sorted(set(owners) - set(duplicates))
+    return anomalies
+
+
+def delete_orphans(field, using=None, batch_size=1000):
+    'delete the rows pointing at deleted objects; return the number of rows'
+    through = field.rel.through
+    using = using or router.db_for_write(through)
+    deleted = 0
+    for side in ('owner', 'item'):
+        while True:
+            pks = list(_orphans(field, using, side).values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            with transaction.atomic(using=using):
+                through._default_manager.using(using).filter(pk__in=pks).delete()
+            deleted += len(pks)
+    return deleted
+
+
+def renumber(field, owners=None, using=None, batch_size=100, gaps=False):
+    '''
+    Renumber the sort values of ``owners`` (default: the owners with
+    ``duplicates``, and with ``gaps`` if ``gaps``) to ``1..n``, keeping their
+    current order, with a window function over ``batch_size`` owners per
+    statement. Return the number of renumbered owners.
+    '''
+    through = field.rel.through
+    using = using or router.db_for_write(through)
+    if owners is None:
+        anomalies = find_anomalies(field, using, gaps)
+        owners = anomalies['duplicates'] + anomalies.get('gaps', [])
+    owners = list(owners)
+
+    connection = connections[using]
+    info = get_table_info(field, connection)
+    ranked = ('SELECT %(pk)s AS row_pk, ROW_NUMBER() OVER (PARTITION BY %(owner)s '
+              'ORDER BY %(sort)s, %(pk)s) AS new_sort '
+              'FROM %(table)s WHERE %(owner)s IN (%%(owners)s)' % info)
+    if connection.vendor == 'postgresql':
+        sql = ('UPDATE %(table)s SET %(sort)s = ranked.new_sort FROM (%(ranked)s) ranked '
+               'WHERE %(table)s.%(pk)s = ranked.row_pk AND %(table)s.%(sort)s <> ranked.new_sort')
+    elif connection.vendor == 'mysql':
+        sql = ('UPDATE %(table)s INNER JOIN (%(ranked)s) ranked ON %(table)s.%(pk)s = ranked.row_pk '
+               'SET %(table)s.%(sort)s = ranked.new_sort')
+    else:
+        sql = ('UPDATE %(table)s SET %(sort)s = (SELECT ranked.new_sort FROM (%(ranked)s) ranked '
+               'WHERE ranked.row_pk = %(table)s.%(pk)s) WHERE %(owner)s IN (%%(owners)s)')
+    sql = sql % dict(info, ranked=ranked)
+
+    for batch in chunked(owners, batch_size):
+        placeholders = ', '.join(['%s'] * len(batch))
+        params = list(batch) * sql.count('%(owners)s')
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute(sql % {'owners': placeholders}, params)
+    return len(owners)
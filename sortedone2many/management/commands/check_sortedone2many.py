@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from sortedone2many.integrity import delete_orphans, find_anomalies, renumber
+from sortedone2many.utils import get_sorted_one2many_fields
+
+
+class Command(BaseCommand):
+    help = ('Check the intermediary tables of SortedOneToManyField for duplicate '
+            'sort values and rows pointing at deleted objects (and optionally '
+            'non-contiguous sort values), and optionally repair them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label', nargs='*',
+            help='Only check the fields of models in these apps.')
+        parser.add_argument('--repair', action='store_true', default=False,
+            help='Delete the orphan rows and renumber the sort values.')
+        parser.add_argument('--gaps', action='store_true', default=False,
+            help='Also report (and renumber with --repair) the owners whose sort values '
+                 'are not exactly 1..n, which is not an error.')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of orphan rows (or of owners when renumbering) per statement.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+            help='Database to check. Defaults to the "default" database.')
+
+    def handle(self, *args, **options):
+        app_labels = options['app_label']
+        using = options['database']
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer.')
+
+        for field in get_sorted_one2many_fields(app_labels):
+            opts = field.model._meta
+            label = '%s.%s.%s' % (opts.app_label, opts.object_name, field.name)
+            anomalies = find_anomalies(field, using, options['gaps'])
+            self.stdout.write(
+                '%s: %s owners with duplicate sort values, '
+                '%s rows with a missing owner, %s rows with a missing item' % (
+                    label, len(anomalies['duplicates']),
+                    anomalies['missing_owners'], anomalies['missing_items']))
+            if options['gaps']:
+                self.stdout.write('%s: %s owners with gaps' % (label, len(anomalies['gaps'])))
+
+            if not options['repair']:
+                continue
+            deleted = 0
+            if anomalies['missing_owners'] or anomalies['missing_items']:
+                deleted = delete_orphans(field, using, batch_size)
+            renumbered = renumber(field, using=using, batch_size=batch_size, gaps=options['gaps'])
+            self.stdout.write('%s: deleted %s orphan rows, renumbered %s owners' % (
+                label, deleted, renumbered))
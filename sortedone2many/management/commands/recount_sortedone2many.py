@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from sortedone2many.counters import recount
+from sortedone2many.utils import get_sorted_one2many_fields
+
+
+class Command(BaseCommand):
+    help = ('Recompute the counters (count_field) of the related objects of '
+            'SortedOneToManyField.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label', nargs='*',
+            help='Only recount the fields of models in these apps.')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Number of owners per statement.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+            help='Database to update. Defaults to the "default" database.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive integer.')
+
+        for field in get_sorted_one2many_fields(options['app_label']):
+            if not field.count_field:
+                continue
+            opts = field.model._meta
+            count = recount(field, using=options['database'], batch_size=batch_size)
+            self.stdout.write('%s.%s.%s: recounted %s owners' % (
+                opts.app_label, opts.object_name, field.name, count))
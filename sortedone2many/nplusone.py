@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+'''
+Detect N+1 access patterns on the reverse side of a ``SortedOneToManyField``,
+e.g. a template iterating ``items`` and touching ``item.category`` of each one
+without ``prefetch_related('category')``.
+
+Enable it with the ``SORTEDONE2MANY_N_PLUS_ONE`` setting (``'warn'`` or
+``'raise'``, typically only when ``DEBUG`` is on) or, in tests, with the
+``detect_n_plus_one()`` context manager. A report is issued once per queryset
+result when ``SORTEDONE2MANY_N_PLUS_ONE_THRESHOLD`` (default 2) instances of it
+have loaded their related object one by one.
+'''
+import os
+import threading
+import traceback
+import warnings
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+
+from .resultsets import get_result_set, track_result_sets
+
+
+DEFAULT_THRESHOLD = 2
+
+_local = threading.local()
+# the models with the reverse accessor of a ``SortedOneToManyField``
+_models = set()
+_package_dir = os.path.dirname(os.path.abspath(__file__))
+_django_dir = os.path.dirname(os.path.abspath(django.__file__))
+
+
+class NPlusOneWarning(RuntimeWarning):
+    pass
+
+
+class NPlusOneError(Exception):
+    pass
+
+
+def get_config():
+    'return ``(action, threshold)``; ``action`` is None if detection is off'
+    override = getattr(_local, 'config', None)
+    if override is not None:
+        return override
+    return (getattr(settings, 'SORTEDONE2MANY_N_PLUS_ONE', None),
+            getattr(settings, 'SORTEDONE2MANY_N_PLUS_ONE_THRESHOLD', DEFAULT_THRESHOLD))
+
+
+def enable_if_configured(model):
+    'track the result sets of ``model`` (see ``resultsets``) if the detector is on'
+    _models.add(model)
+    if get_config()[0]:
+        track_result_sets(model)
+
+
+@contextmanager
+def detect_n_plus_one(action='raise', threshold=DEFAULT_THRESHOLD):
+    'enable the detector inside the block, e.g. in a test case'
+    for model in list(_models):
+        track_result_sets(model)
+    previous = getattr(_local, 'config', None)
+    _local.config = (action, threshold)
+    try:
+        yield
+    finally:
+        _local.config = previous
+
+
+def _get_call_site():
+    'the innermost frame outside of this package and django'
+    stack = traceback.extract_stack()
+    for frame in reversed(stack):
+        filename = os.path.abspath(frame[0])
+        if filename.startswith(_package_dir + os.sep) or filename.startswith(_django_dir + os.sep):
+            continue
+        return frame[0], frame[1], frame[2]
+    return stack[0][0], stack[0][1], stack[0][2]
+
+
+def record_load(instance, accessor_name):
+    '''
+    Count an uncached load of ``instance.<accessor_name>`` and report it once
+    the threshold is hit for instances of the same queryset result.
+    '''
+    action, threshold = get_config()
+    if not action:
+        return
+    result_set = get_result_set(instance)
+    if result_set is None:
+        return
+    loads = result_set.loads[accessor_name] = result_set.loads.get(accessor_name, 0) + 1
+    if loads != threshold:
+        return
+
+    filename, lineno, function = _get_call_site()
+    message = (
+        'N+1 queries: "%s.%s" was loaded one by one for %s of %s instances from '
+        'the same queryset (%s:%s in %s). Use prefetch_related(%r).' % (
+            instance.__class__.__name__, accessor_name, loads, len(result_set),
+            filename, lineno, function, accessor_name))
+    if action == 'raise':
+        raise NPlusOneError(message)
+    warnings.warn_explicit(message, NPlusOneWarning, filename, lineno)
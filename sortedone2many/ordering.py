@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''
+Plan the sort values of an ordered list with as few row writes as possible.
+'''
+from bisect import bisect_left
+
+
+def longest_increasing_subsequence(values):
+    '''
+    Return the indices of a longest strictly increasing subsequence of
+    ``values`` in O(n log n). ``None`` values are skipped.
+    '''
+    tails = []  # smallest tail value of an increasing subsequence of each length
+    tail_indices = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        if value is None:
+            continue
+        pos = bisect_left(tails, value)
+        if pos == len(tails):
+            tails.append(value)
+            tail_indices.append(i)
+        else:
+            tails[pos] = value
+            tail_indices[pos] = i
+        previous[i] = tail_indices[pos - 1] if pos else None
+
+    indices = []
+    i = tail_indices[-1] if tail_indices else None
+    while i is not None:
+        indices.append(i)
+        i = previous[i]
+    indices.reverse()
+    return indices
+
+
+def assign_sort_values(keys, current):
+    '''
+    Plan the sort values to store ``keys`` in this order, given the ``current``
+    sort values (a dict) of the keys that are already stored.
+
+    The keys on a longest increasing subsequence of current sort values keep
+    them; the other keys get consecutive values between their neighbours,
+    releasing neighbours when there isn't enough room. Return a dict of the
+    keys whose sort value must be written (new keys included).
+    '''
+    values = [current.get(key) for key in keys]
+    anchors = longest_increasing_subsequence(values)
+    planned = {}
+
+    start = 0  # first index of the segment of keys to place
+    lower = None  # sort value before the segment (None: unbounded)
+    j = 0
+    while True:
+        # extend the segment over the next anchors until its keys fit
+        while j < len(anchors):
+            upper = values[anchors[j]]
+            if lower is None or upper - lower - 1 >= anchors[j] - start:
+                break
+            j += 1
+
+        end = anchors[j] if j < len(anchors) else len(keys)
+        if j < len(anchors) and lower is None:
+            first = values[anchors[j]] - (end - start)
+        else:
+            first = lower + 1 if lower is not None else 1
+        for offset, i in enumerate(range(start, end)):
+            if values[i] != first + offset:
+                planned[keys[i]] = first + offset
+
+        if j == len(anchors):
+            return planned
+        lower = values[anchors[j]]
+        start = anchors[j] + 1
+        j += 1
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+'''
+Position and neighbours of an object within the ordered list of its owner.
+
+In the example::
+
+    class Category(models.Model):
+        items = SortedOneToManyField(Item, related_name='category')
+
+``item.category_position`` is the 1-based position of ``item`` in
+``category.items.all()``, and ``item.next_in_category()`` /
+``item.previous_in_category()`` its neighbours (``None`` at the ends, or without
+a category). Each is a single query comparing sort values on the intermediary
+table (ties are ordered by row pk, as in ``category.items.all()``), without
+loading the list. ``field.with_position(queryset)`` annotates the positions of
+a whole queryset.
+'''
+from django.db import connections
+
+from .routing import db_for_read
+
+
+POSITION_SQL = (
+    'SELECT COUNT(*) FROM %(table)s t INNER JOIN %(table)s cur ON t.%(owner)s = cur.%(owner)s '
+    'WHERE cur.%(item)s = %(item_pk)s AND (t.%(sort)s < cur.%(sort)s OR '
+    '(t.%(sort)s = cur.%(sort)s AND t.%(pk)s <= cur.%(pk)s))')
+
+NEIGHBOUR_SQL = (
+    'SELECT m.* FROM %(model_table)s m '
+    'INNER JOIN %(table)s t ON m.%(model_pk)s = t.%(item)s '
+    'INNER JOIN %(table)s cur ON t.%(owner)s = cur.%(owner)s '
+    'WHERE cur.%(item)s = %%s AND (t.%(sort)s %(op)s cur.%(sort)s OR '
+    '(t.%(sort)s = cur.%(sort)s AND t.%(pk)s %(op)s cur.%(pk)s)) '
+    'ORDER BY t.%(sort)s %(order)s, t.%(pk)s %(order)s LIMIT 1')
+
+
+def _sql_info(field, connection):
+    from .utils import get_table_info
+    model = field.rel.to
+    qn = connection.ops.quote_name
+    info = get_table_info(field, connection)
+    info.update(model_table=qn(model._meta.db_table), model_pk=qn(model._meta.pk.column))
+    return info
+
+
+def get_position(field, instance, using=None):
+    'the 1-based position of ``instance`` in the list of its owner, or None'
+    using = using or db_for_read(field, field.rel.through, instance, item=instance)
+    connection = connections[using]
+    sql = POSITION_SQL % dict(_sql_info(field, connection), item_pk='%s')
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [instance.pk])
+        position = cursor.fetchone()[0]
+    return position or None
+
+
+def get_neighbour(field, instance, is_next=True, using=None):
+    'the next (or previous) object in the list of the owner of ``instance``, or None'
+    model = field.rel.to
+    using = using or db_for_read(field, model, instance, item=instance)
+    info = dict(_sql_info(field, connections[using]),
+                op='>' if is_next else '<', order='ASC' if is_next else 'DESC')
+    for neighbour in model._default_manager.db_manager(using).raw(NEIGHBOUR_SQL % info, [instance.pk]):
+        return neighbour
+    return None
+
+
+def with_position(field, queryset, name=None):
+    '''
+    Annotate every object of ``queryset`` with its position in the list of its
+    owner (None without owner) as the ``name`` attribute (default: the
+    ``<accessor>_position`` attribute itself, which then needs no query).
+    '''
+    name = name or '%s_position' % field.rel.get_accessor_name()
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    info = _sql_info(field, connection)
+    item_pk = '%s.%s' % (qn(queryset.model._meta.db_table), info['model_pk'])
+    sql = 'NULLIF((%s), 0)' % (POSITION_SQL % dict(info, item_pk=item_pk))
+    return queryset.extra(select={name: sql})
+
+
+class OneToManyPositionDescriptor(object):
+    '''
+    ``item.category_position``: see the module docstring. A non-data descriptor,
+    so the value annotated by ``with_position()`` takes precedence.
+    '''
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self
+        if instance.pk is None:
+            return None
+        return get_position(self.field, instance)
+
+
+def next_in_owner(self, field):
+    return get_neighbour(field, self, is_next=True)
+
+
+def previous_in_owner(self, field):
+    return get_neighbour(field, self, is_next=False)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''
+Prefetching of the first objects of each owner only, e.g. the first 10 items
+of each category on a home page::
+
+    Category.objects.prefetch_related(Category.items.field.prefetch_top(10))
+
+``prefetch_related('items')`` would load all the items of every category. The
+rows are limited in the database by a window function
+(``ROW_NUMBER() OVER (PARTITION BY owner ORDER BY sort_value)``, SQLite 3.25+,
+PostgreSQL, MySQL 8), in the same single query.
+'''
+from django.db import connections
+from django.db.models import Prefetch
+
+
+LIMIT_ATTR = '_sortedone2many_limit'
+
+TOP_SQL = (
+    '%(table)s.%(pk)s IN (SELECT r.%(pk)s FROM ('
+    'SELECT %(pk)s, ROW_NUMBER() OVER (PARTITION BY %(owner)s ORDER BY %(sort)s, %(pk)s) AS rn '
+    'FROM %(table)s WHERE %(owner)s IN (%(owners)s)%(items)s) r WHERE r.rn <= %%s)')
+
+
+def prefetch_top(field, limit, queryset=None, to_attr=None, lookup=None):
+    '''
+    Return a ``Prefetch`` of the first ``limit`` related objects of each owner
+    through ``field`` (``lookup`` defaults to the field name), optionally
+    filtered by ``queryset`` (the limit applies to the filtered objects).
+    Without ``to_attr``, ``category.items.all()``
+    then returns the truncated list.
+    '''
+    if limit < 0:
+        raise ValueError('limit must not be negative, got %r' % (limit,))
+    if queryset is None:
+        queryset = field.rel.to._default_manager.all()
+    else:
+        queryset = queryset.all()
+    setattr(queryset, LIMIT_ATTR, limit)
+    return Prefetch(lookup or field.name, queryset=queryset, to_attr=to_attr)
+
+
+def get_limit(queryset):
+    'the limit set by ``prefetch_top()`` on ``queryset``, or None'
+    return getattr(queryset, LIMIT_ATTR, None)
+
+
+def limit_per_owner(field, queryset, instances, limit, filtered=None):
+    '''
+    Restrict the prefetch ``queryset`` to the first ``limit`` rows of each of
+    ``instances``, counting only the related objects of the ``filtered``
+    queryset if given.
+    '''
+    from .utils import get_table_info
+
+    through = field.rel.through
+    source_field = through._meta.get_field(through._from_field_name)
+    target_field = through._meta.get_field(through._to_field_name)
+    owner_attname = source_field.rel.get_related_field().attname
+    owner_pks = [getattr(instance, owner_attname) for instance in instances]
+    info = get_table_info(field, connections[queryset.db])
+    items_sql, items_params = '', []
+    if filtered is not None and filtered.query.where:
+        subquery = filtered.order_by().values_list(
+            target_field.rel.get_related_field().attname, flat=True).query
+        items_sql, items_params = subquery.get_compiler(queryset.db).as_sql()
+        items_sql = ' AND %s IN (%s)' % (info['item'], items_sql)
+    sql = TOP_SQL % dict(info, owners=', '.join(['%s'] * len(owner_pks)), items=items_sql)
+    return queryset.extra(where=[sql], params=owner_pks + list(items_params) + [limit])
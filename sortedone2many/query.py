@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.db import models
+from django.utils import six
+
+
+class One2ManyQuerySet(models.QuerySet):
+    '''
+    QuerySet of the related model of a ``SortedOneToManyField`` (e.g. ``Item``)
+    with bulk operations on the relation::
+
+        class Item(models.Model):
+            objects = One2ManyQuerySet.as_manager()
+
+        Item.objects.filter(name__startswith='a').assign_owner('category', category)
+    '''
+    def assign_owner(self, field, owner, position='end'):
+        '''
+        Move all the objects of this queryset to ``owner`` (None to detach
+        them). ``field`` is the ``SortedOneToManyField`` or the name of its
+        accessor on this model (e.g. ``'category'``).
+        See ``SortedOneToManyField.assign_owner()``.
+        '''
+        if isinstance(field, six.string_types):
+            field = getattr(self.model, field).related.field
+        return field.assign_owner(self, owner, position)
+    assign_owner.alters_data = True
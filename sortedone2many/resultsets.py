@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+'''
+Remember which model instances were loaded together by the same queryset.
+
+Once ``track_result_sets(model)`` is called, the managers of ``model`` build
+their querysets from a subclass of their queryset class, so that every
+instance of a multi-row result references a shared ``ResultSet`` (holding weak
+references to its siblings). The querysets of other models are left alone.
+The reverse accessor of ``SortedOneToManyField`` uses it to detect N+1 access
+patterns and to batch-load the owners of sibling instances.
+'''
+import weakref
+
+from django.db.models import Model
+
+
+RESULT_SET_ATTR = '_sortedone2many_result_set'
+
+
+class ResultSet(object):
+    'the model instances loaded by one queryset evaluation'
+    def __init__(self, instances=()):
+        self.refs = [weakref.ref(obj) for obj in instances]
+        # number of uncached loads per accessor name
+        self.loads = {}
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __reduce__(self):
+        # weak references can't be pickled; unpickled instances have no siblings
+        return (ResultSet, ())
+
+    def instances(self):
+        'the siblings that are still alive'
+        return [obj for obj in (ref() for ref in self.refs) if obj is not None]
+
+
+def get_result_set(instance):
+    'the ``ResultSet`` that ``instance`` was loaded with (or None)'
+    return instance.__dict__.get(RESULT_SET_ATTR)
+
+
+def _tag_result_set(result_cache):
+    if len(result_cache) < 2 or not isinstance(result_cache[0], Model):
+        return
+    result_set = ResultSet(result_cache)
+    for obj in result_cache:
+        obj.__dict__[RESULT_SET_ATTR] = result_set
+
+
+class ResultSetQuerySetMixin(object):
+    'tag the model instances loaded by the queryset'
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super(ResultSetQuerySetMixin, self)._fetch_all()
+        if not fetched:
+            _tag_result_set(self._result_cache)
+
+    def __reduce__(self):
+        # the class is created at runtime: pickle as the original queryset class
+        return (_new_queryset, (self.__class__.__bases__[1],), self.__getstate__())
+
+
+def _new_queryset(queryset_class):
+    return queryset_class.__new__(queryset_class)
+
+
+_queryset_classes = {}
+
+
+def get_queryset_class(queryset_class):
+    'the subclass of ``queryset_class`` tagging the loaded instances'
+    if issubclass(queryset_class, ResultSetQuerySetMixin):
+        return queryset_class
+    if queryset_class not in _queryset_classes:
+        _queryset_classes[queryset_class] = type(
+            queryset_class.__name__, (ResultSetQuerySetMixin, queryset_class), {})
+    return _queryset_classes[queryset_class]
+
+
+def track_result_sets(model):
+    'make the managers of ``model`` tag the instances they load (idempotent)'
+    managers = [manager for _, _, manager in
+                model._meta.concrete_managers + model._meta.abstract_managers]
+    managers += [model._default_manager, model._base_manager]
+    for manager in managers:
+        manager._queryset_class = get_queryset_class(manager._queryset_class)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''
+Database routing of ``SortedOneToManyField`` relations.
+
+Reads (``item.category``, ``category.items.all()``, prefetching) are explicitly
+routed with ``router.db_for_read``, so they can be offloaded to replicas.
+Routers get the ``owner`` (e.g. the category) and/or the ``item`` as hints, on
+reads and writes of the intermediary rows alike, besides the usual ``instance``
+hint (the owner if known, else the item), so a sharding router can keep the
+rows on the database of their owner. To
+avoid reading a stale owner right after a move, enable "sticky reads" for the
+current request (``StickyReadsMiddleware``) or block (``sticky_reads()``): after
+a write to a relation, its reads are routed with ``router.db_for_write``
+instead, for ``SORTEDONE2MANY_STICKY_READS_WINDOW`` seconds (default: until the
+end of the request or block).
+'''
+import threading
+import time
+
+from django.conf import settings
+from django.db import router
+
+
+_local = threading.local()
+
+
+def _get_scope():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+class sticky_reads(object):
+    '''
+    Context manager routing the reads of a relation to the database used for
+    writing to it, after it has been written to inside the block. ``window``
+    (seconds) limits how long after the last write; ``None`` (the default,
+    unless the setting is defined) means until the end of the block.
+    '''
+    def __init__(self, window=None):
+        if window is None:
+            window = getattr(settings, 'SORTEDONE2MANY_STICKY_READS_WINDOW', None)
+        self.window = window
+        self.writes = {}  # through model -> time of the last write
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self in _local.stack:
+            _local.stack.remove(self)
+
+    def is_sticky(self, through):
+        written = self.writes.get(through)
+        if written is None:
+            return False
+        return self.window is None or time.time() - written < self.window
+
+
+def mark_written(field):
+    'record a write to the relation of ``field`` in the active sticky scope'
+    scope = _get_scope()
+    if scope is not None:
+        scope.writes[field.rel.through] = time.time()
+
+
+def _hints(owner, item):
+    hints = {}
+    if owner is not None:
+        hints['owner'] = owner
+    if item is not None:
+        hints['item'] = item
+    return hints
+
+
+def db_for_read(field, model, instance=None, owner=None, item=None):
+    'the database to read ``model`` through the relation of ``field``'
+    hints = _hints(owner, item)
+    scope = _get_scope()
+    if scope is not None and scope.is_sticky(field.rel.through):
+        return router.db_for_write(model, instance=instance, **hints)
+    return router.db_for_read(model, instance=instance, **hints)
+
+
+def db_for_write(field, owner=None, item=None):
+    '''
+    The database to write the intermediary rows of the relation of ``field``
+    of ``owner`` and/or ``item`` (instances).
+    '''
+    instance = owner if owner is not None else item
+    return router.db_for_write(field.rel.through, instance=instance, **_hints(owner, item))
+
+
+class StickyReadsMiddleware(object):
+    '''
+    Enable ``sticky_reads()`` for each request. Works both in
+    ``MIDDLEWARE_CLASSES`` and in the new-style ``MIDDLEWARE`` setting.
+    '''
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with sticky_reads():
+            return self.get_response(request)
+
+    def process_request(self, request):
+        # a previous request of this thread may have failed before its response
+        _local.stack = []
+        sticky_reads().__enter__()
+
+    def process_response(self, request, response):
+        _local.stack = []
+        return response
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+'''
+The ``one2many_changed`` signal: a bulk alternative to ``m2m_changed``.
+
+It is sent with the intermediary ``through`` model as the sender and a list of
+``changes``, one ``Change(item, old_owner, new_owner, sort_value)`` per related
+object (pks; ``None`` owner when detached, ``None`` sort value then), once per
+transaction: the changes are buffered and sent when the outermost transaction
+commits (``transaction.on_commit``), and discarded if it rolls back. Changes
+made inside a savepoint (a nested ``atomic()`` block) are buffered and sent
+apart, in order, so that they are discarded if the savepoint rolls back. On
+Django 1.8, and outside transactions, they are sent after each operation.
+
+A ``sortedone2many.batch()`` sends all its net changes at once. Moving an item
+with ``item.category = other`` sends a single change instead of the
+``clear`` and ``add`` pairs of ``m2m_changed``.
+
+Nothing is computed unless a receiver is connected (or the field has a
+``count_field`` or a ``version_field``, which are maintained from the same
+changes). Most operations know their changes already; ``add()``, ``remove()``
+and assignments read the rows of the given objects before and after, and
+``clear()`` reads the list of the owner only if a receiver is connected (its
+size otherwise).
+'''
+import threading
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+import django
+from django.db import models, transaction
+from django.dispatch import Signal
+
+from .counters import add_to_counters, update_counters
+from .versions import bump_owner_versions, bump_versions
+
+
+one2many_changed = Signal(providing_args=['changes', 'using'])
+
+Change = namedtuple('Change', ['item', 'old_owner', 'new_owner', 'sort_value'])
+
+_local = threading.local()
+
+
+def is_listened(field):
+    return one2many_changed.has_listeners(field.rel.through)
+
+
+def needs_changes(field):
+    'whether the changes of ``field`` must be computed'
+    return (bool(getattr(field, 'count_field', None) or getattr(field, 'version_field', None)) or
+            is_listened(field))
+
+
+def record_changes(field, changes, using):
+    'update the counters and versions of ``field`` (if any) and send ``changes`` (if listened)'
+    if getattr(field, 'count_field', None):
+        update_counters(field, changes, using)
+    if getattr(field, 'version_field', None):
+        bump_versions(field, changes, using)
+    if is_listened(field):
+        send_changes(field, changes, using)
+
+
+def record_counts(field, deltas, using):
+    '''
+    Update the counters and versions of ``field`` (if any) from ``deltas``,
+    the change of the number of related objects by owner pk (0 if they were
+    only reordered), when the changes of each object are not needed.
+    '''
+    if getattr(field, 'count_field', None):
+        add_to_counters(field, deltas, using)
+    if getattr(field, 'version_field', None):
+        bump_owner_versions(field, deltas, using)
+
+
+def _is_pending(connection, callback):
+    return any(func is callback for _, func in connection.run_on_commit)
+
+
+def _buffer(buffers, sender, changes):
+    'merge ``changes`` into ``buffers``, keeping the first old owner of each item'
+    buffered = buffers.setdefault(sender, OrderedDict())
+    for change in changes:
+        previous = buffered.get(change.item)
+        if previous is not None:
+            change = change._replace(old_owner=previous.old_owner)
+        buffered[change.item] = change
+
+
+def send_changes(field, changes, using):
+    '''
+    Send ``changes`` when the current transaction commits (now if none).
+
+    The changes are buffered in segments, each sent by its own
+    ``transaction.on_commit`` callback, registered in the savepoint in which
+    the changes were made, so Django discards them with the savepoint if it
+    rolls back. Once a savepoint is released, its segment is merged into the
+    enclosing one, so the changes are sent once per transaction unless
+    savepoints were rolled back.
+    '''
+    if not changes:
+        return
+    through = field.rel.through
+    connection = transaction.get_connection(using)
+    if django.VERSION < (1, 9) or not connection.in_atomic_block:
+        one2many_changed.send(sender=through, changes=list(changes), using=using)
+        return
+
+    if not hasattr(_local, 'pending'):
+        _local.pending = {}
+    # None stands for the blocks without savepoint (``atomic(savepoint=False)``)
+    savepoint_ids = [sid for sid in connection.savepoint_ids if sid is not None]
+    # [callback, buffers, savepoint ids] in order; the others were sent or discarded
+    segments = []
+    for segment in _local.pending.get(using, []):
+        if not _is_pending(connection, segment[0]):
+            continue
+        if segment[2][:len(savepoint_ids)] == savepoint_ids:
+            # its inner savepoints were released (or it would have been discarded)
+            segment[2] = savepoint_ids
+        if segments and segments[-1][2] == segment[2]:
+            for sender, sender_changes in segment[1].items():
+                _buffer(segments[-1][1], sender, sender_changes.values())
+            segment[1].clear()
+        else:
+            segments.append(segment)
+
+    if not segments or segments[-1][2] != savepoint_ids:
+        buffers = OrderedDict()
+
+        def callback():
+            _local.pending[using] = [segment for segment in _local.pending.get(using, [])
+                                     if segment[0] is not callback]
+            for sender, sender_changes in buffers.items():
+                one2many_changed.send(sender=sender, changes=list(sender_changes.values()),
+                                      using=using)
+        segments.append([callback, buffers, savepoint_ids])
+        transaction.on_commit(callback, using=using)
+    _local.pending[using] = segments
+    _buffer(segments[-1][1], through, changes)
+
+
+def _snapshot(field, owner_pks, target_ids, using):
+    'item pk -> (owner pk, sort value) of the rows of ``owner_pks`` and ``target_ids``'
+    through = field.rel.through
+    source_attname = through._meta.get_field(through._from_field_name).attname
+    target_attname = through._meta.get_field(through._to_field_name).attname
+    condition = models.Q()
+    if owner_pks:
+        condition |= models.Q(**{'%s__in' % source_attname: list(owner_pks)})
+    if target_ids:
+        condition |= models.Q(**{'%s__in' % target_attname: list(target_ids)})
+    rows = (through._default_manager.using(using).filter(condition)
+            .values_list(target_attname, source_attname, through._sort_field_name))
+    return OrderedDict((row[0], row[1:]) for row in rows)
+
+
+@contextmanager
+def _no_transaction():
+    yield
+
+
+@contextmanager
+def track_changes(field, owner_pks=(), target_ids=(), using=None):
+    '''
+    Record the changes made inside the block to ``target_ids`` and to the
+    related objects of ``owner_pks``, comparing their rows before and after.
+
+    The lists of ``owner_pks`` are only read if ``one2many_changed`` is
+    listened. Otherwise the block is given a dict to which it must add the
+    change of the number of related objects of each of ``owner_pks`` (None if
+    nothing is recorded). With a ``count_field`` or a ``version_field``, the
+    block and their updates run in one transaction. Nested blocks of the same
+    field are ignored.
+    '''
+    tracking = getattr(_local, 'tracking', None)
+    if tracking is None:
+        tracking = _local.tracking = set()
+    if field in tracking or not needs_changes(field) or not (owner_pks or target_ids):
+        yield None
+        return
+
+    deltas = None
+    if not is_listened(field):
+        deltas = {}
+        owner_pks = ()
+    if getattr(field, 'count_field', None) or getattr(field, 'version_field', None):
+        atomic = transaction.atomic(using=using, savepoint=False)
+    else:
+        atomic = _no_transaction()
+    tracking.add(field)
+    try:
+        with atomic:
+            before = _snapshot(field, owner_pks, target_ids, using) if owner_pks or target_ids else {}
+            yield deltas
+            after = _snapshot(field, owner_pks, target_ids, using) if owner_pks or target_ids else {}
+            tracking.discard(field)
+
+            changes = []
+            for item in list(before) + [item for item in after if item not in before]:
+                old_owner, _ = before.get(item, (None, None))
+                new_owner, sort_value = after.get(item, (None, None))
+                if before.get(item) != after.get(item):
+                    changes.append(Change(item, old_owner, new_owner, sort_value))
+            record_changes(field, changes, using)
+            if deltas:
+                record_counts(field, deltas, using)
+    finally:
+        tracking.discard(field)
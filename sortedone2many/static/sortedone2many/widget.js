@@ -0,0 +1,46 @@
+/*
+ * Save each drag and drop of the sortable checkbox widget immediately, by
+ * posting the moved item and its new index to One2ManyModelAdmin.move_view.
+ * Only the saved selection can be reordered this way: once a checkbox has
+ * been changed, the order is saved with the form as usual.
+ */
+if (typeof jQuery === 'undefined') {
+    var jQuery = django.jQuery;
+}
+
+(function ($) {
+    function getCookie(name) {
+        var match = document.cookie.match(new RegExp('(?:^|; )' + name + '=([^;]*)'));
+        return match ? decodeURIComponent(match[1]) : null;
+    }
+
+    $(function () {
+        $('.sortedone2many-container').each(function () {
+            var container = $(this);
+            var url = container.data('move-url');
+            var ul = container.find('.sortedm2m-items');
+            var changed = false;
+
+            ul.on('change', 'input[type=checkbox]', function () {
+                changed = true;
+            });
+            ul.on('sortupdate', function (event, ui) {
+                var checkbox = ui.item.find('input[type=checkbox]');
+                if (changed || !checkbox.is(':checked')) {
+                    return;
+                }
+                var checked = ul.find('input[type=checkbox]:checked');
+                $.ajax({
+                    url: url,
+                    type: 'POST',
+                    data: {item: checkbox.val(), index: checked.index(checkbox)},
+                    headers: {'X-CSRFToken': getCookie('csrftoken')},
+                    error: function () {
+                        // fall back to saving the order with the form
+                        changed = true;
+                    }
+                });
+            });
+        });
+    });
+})(jQuery);
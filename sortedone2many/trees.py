@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+'''
+Tree queries for self-referential ``SortedOneToManyField``::
+
+    class Node(models.Model):
+        children = SortedOneToManyField('self', related_name='parent')
+
+Each object has at most one owner, so the relation forms an ordered forest.
+The nodes of a whole subtree (or all the ancestors of a node) are loaded with a
+single recursive CTE on the intermediary table joined to the model table; the
+depth-first order is then rebuilt in python from the sort values. The CTEs use
+``UNION`` (not ``UNION ALL``), so they terminate even on cyclic data.
+
+With ``prevent_cycles=True``, the field checks every new relation against the
+ancestors of the owner (one recursive query) and refuses to create a cycle;
+``batch()`` checks the net changes again when it writes them.
+
+Requires ``WITH RECURSIVE`` support (SQLite 3.8.3+, PostgreSQL, MySQL 8).
+'''
+from django.db import connections, router
+
+from .utils import chunked, get_table_info
+
+
+DESCENDANTS_SQL = '''
+WITH RECURSIVE tree (row_pk, owner_pk, item_pk, sort_value) AS (
+    SELECT %(pk)s, %(owner)s, %(item)s, %(sort)s FROM %(table)s WHERE %(owner)s = %%s
+    UNION
+    SELECT t.%(pk)s, t.%(owner)s, t.%(item)s, t.%(sort)s FROM %(table)s t
+    INNER JOIN tree ON t.%(owner)s = tree.item_pk
+)
+SELECT m.*, tree.row_pk AS _tree_row_pk, tree.owner_pk AS _tree_owner_pk,
+    tree.sort_value AS _tree_sort_value
+FROM %(model_table)s m INNER JOIN tree ON m.%(model_pk)s = tree.item_pk
+'''
+
+ANCESTORS_SQL = '''
+WITH RECURSIVE tree (item_pk, owner_pk) AS (
+    SELECT %(item)s, %(owner)s FROM %(table)s WHERE %(item)s = %%s
+    UNION
+    SELECT t.%(item)s, t.%(owner)s FROM %(table)s t
+    INNER JOIN tree ON t.%(item)s = tree.owner_pk
+)
+SELECT m.*, tree.item_pk AS _tree_item_pk
+FROM %(model_table)s m INNER JOIN tree ON m.%(model_pk)s = tree.owner_pk
+'''
+
+ANCESTOR_PKS_SQL = '''
+WITH RECURSIVE chain (item_pk, owner_pk) AS (
+    SELECT %(item)s, %(owner)s FROM %(table)s WHERE %(item)s = %%s
+    UNION
+    SELECT t.%(item)s, t.%(owner)s FROM %(table)s t
+    INNER JOIN chain ON t.%(item)s = chain.owner_pk
+)
+SELECT owner_pk FROM chain
+'''
+
+CHAINS_SQL = '''
+WITH RECURSIVE chain (item_pk, owner_pk) AS (
+    SELECT %(item)s, %(owner)s FROM %(table)s WHERE %(item)s IN (%%s)
+    UNION
+    SELECT t.%(item)s, t.%(owner)s FROM %(table)s t
+    INNER JOIN chain ON t.%(item)s = chain.owner_pk
+)
+SELECT item_pk, owner_pk FROM chain
+'''
+
+TREE_ATTRS = ('_tree_row_pk', '_tree_owner_pk', '_tree_sort_value', '_tree_item_pk')
+
+
+def _check_field(field):
+    if field.rel.to is not field.model:
+        raise ValueError('%s.%s is not a self-referential SortedOneToManyField' % (
+            field.model._meta.object_name, field.name))
+
+
+def _raw(field, sql, node_pk, using):
+    'run a tree query; return the instances (with the ``_tree_*`` attributes)'
+    model = field.model
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    info = get_table_info(field, connection)
+    info.update(model_table=qn(model._meta.db_table), model_pk=qn(model._meta.pk.column))
+    return list(model._default_manager.db_manager(using).raw(sql % info, [node_pk]))
+
+
+def _pop_tree_attrs(instance):
+    values = dict((name, instance.__dict__.pop(name)) for name in TREE_ATTRS
+                  if name in instance.__dict__)
+    return values
+
+
+def _node_pk(node):
+    return node.pk if hasattr(node, '_meta') else node
+
+
+def subtree_ordered(field, node, using=None):
+    '''
+    Return the subtree of ``node`` (an instance or a pk) as a list of
+    ``(instance, depth)`` tuples in depth-first order, children in sort order.
+    ``node`` itself comes first with depth 0 (it is fetched if a pk is given).
+    '''
+    _check_field(field)
+    model = field.model
+    node_pk = _node_pk(node)
+    using = using or router.db_for_read(model, instance=node if hasattr(node, '_meta') else None)
+
+    children = {}
+    for instance in _raw(field, DESCENDANTS_SQL, node_pk, using):
+        values = _pop_tree_attrs(instance)
+        children.setdefault(values['_tree_owner_pk'], []).append(
+            (values['_tree_sort_value'], values['_tree_row_pk'], instance))
+    for siblings in children.values():
+        siblings.sort(key=lambda child: child[:2])
+
+    if not hasattr(node, '_meta'):
+        node = model._default_manager.db_manager(using).get(pk=node_pk)
+    result = [(node, 0)]
+    visited = set([node_pk])
+    stack = [(child, 1) for _, _, child in reversed(children.get(node_pk, []))]
+    while stack:
+        instance, depth = stack.pop()
+        if instance.pk in visited:
+            continue
+        visited.add(instance.pk)
+        result.append((instance, depth))
+        stack.extend((child, depth + 1) for _, _, child in reversed(children.get(instance.pk, [])))
+    return result
+
+
+def descendants(field, node, using=None):
+    '''
+    Return the descendants of ``node`` (an instance or a pk) in depth-first
+    order, children in sort order, with a single query.
+    '''
+    _check_field(field)
+    # the root is only needed to start the walk; avoid fetching it
+    root = node if hasattr(node, '_meta') else field.model(pk=node)
+    return [instance for instance, depth in subtree_ordered(field, root, using)[1:]]
+
+
+def ancestors(field, node, using=None):
+    '''
+    Return the ancestors of ``node`` (an instance or a pk), from its owner up
+    to the root, with a single query.
+    '''
+    _check_field(field)
+    node_pk = _node_pk(node)
+    using = using or router.db_for_read(field.model, instance=node if hasattr(node, '_meta') else None)
+
+    owners = {}
+    for instance in _raw(field, ANCESTORS_SQL, node_pk, using):
+        owners[_pop_tree_attrs(instance)['_tree_item_pk']] = instance
+
+    result = []
+    visited = set([node_pk])
+    owner = owners.get(node_pk)
+    while owner is not None and owner.pk not in visited:
+        visited.add(owner.pk)
+        result.append(owner)
+        owner = owners.get(owner.pk)
+    return result
+
+
+def check_cycles(field, owner, target_ids, using=None):
+    '''
+    Raise ``ValueError`` if relating ``target_ids`` to ``owner`` (an instance
+    or a pk) would create a cycle, i.e. if one of them is ``owner`` itself or
+    one of its ancestors. The ancestors are fetched with a single query.
+    '''
+    _check_field(field)
+    owner_pk = _node_pk(owner)
+    target_ids = set(target_ids)
+    if owner_pk in target_ids:
+        cycle = [owner_pk]
+    else:
+        using = using or router.db_for_read(field.model, instance=owner if hasattr(owner, '_meta') else None)
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            cursor.execute(ANCESTOR_PKS_SQL % get_table_info(field, connection), [owner_pk])
+            cycle = [row[0] for row in cursor.fetchall() if row[0] in target_ids]
+    if cycle:
+        raise ValueError('Cannot relate %s %r to %r: it would create a cycle' % (
+            field.model._meta.object_name, cycle[0], owner))
+
+
+def check_planned_cycles(field, owners, using):
+    '''
+    Raise ``ValueError`` if giving their planned ``owners`` (a dict of owner
+    pks, or None, by object pk) to some objects would create a cycle, with
+    the other objects keeping their stored owners. The stored ancestors of
+    the planned owners are fetched with one query (per 500 owners).
+    '''
+    _check_field(field)
+    connection = connections[using]
+    sql = CHAINS_SQL % get_table_info(field, connection)
+    stored = {}
+    starts = set(owner_pk for owner_pk in owners.values() if owner_pk is not None)
+    for chunk in chunked(sorted(starts), 500):
+        with connection.cursor() as cursor:
+            cursor.execute(sql % ', '.join(['%s'] * len(chunk)), chunk)
+            stored.update(cursor.fetchall())
+
+    for item_pk, owner_pk in owners.items():
+        visited = set()
+        while owner_pk is not None and owner_pk not in visited:
+            if owner_pk == item_pk:
+                raise ValueError('Cannot relate %s %r to %r: it would create a cycle' % (
+                    field.model._meta.object_name, item_pk, owners[item_pk]))
+            visited.add(owner_pk)
+            owner_pk = owners[owner_pk] if owner_pk in owners else stored.get(owner_pk)
@@ -1,35 +1,116 @@
 # -*- coding: utf-8 -*-
+from functools import partial
 
+import django
+from django.apps import apps
 from django.utils import six
 from sortedone2many.fields import SortedOneToManyField
 
 
-def inject_extra_field_to_model(from_model, field_name, field):
-    if not isinstance(from_model, six.string_types):
-        field.contribute_to_class(from_model, field_name)
+def get_model_key(model):
+    '''
+    Return the ``(app_label, model_name)`` of ``model``, a model class or an
+    ``"app_label.ModelName"`` string.
+    '''
+    if isinstance(model, six.string_types):
+        try:
+            app_label, model_name = model.split('.')
+        except ValueError:
+            raise ValueError('%r must be of the form "app_label.ModelName"' % model)
+        return app_label, model_name.lower()
+    return model._meta.app_label, model._meta.model_name
+
+
+def lazy_model_operation(function, *models):
+    '''
+    Call ``function`` with the classes of ``models`` (model classes or
+    ``"app_label.ModelName"`` strings) as soon as they are all registered,
+    i.e. immediately if they already are.
+    '''
+    model_keys = [get_model_key(model) for model in models]
+    if django.VERSION >= (1, 9):
+        apps.lazy_model_operation(function, *model_keys)
         return
-    raise Exception('from_model must be a Model Class')
-
-#     app_label, model_name = from_model.split('.')
-#     from django.apps import apps
-#     try:
-#         from_model_cls = apps.get_registered_model(app_label, model_name)
-#         field.contribute_to_class(from_model_cls, field_name)
-#     except:
-#         from django.db.models.signals import class_prepared
-#         def add_field(sender, **kwargs):
-#             if sender.__name__ == model_name and sender._meta.app_label == app_label:
-#                 field.contribute_to_class(sender, field_name)
-#         # TODO: `add_field` is never called. `class_prepared` already fired or never fire??
-#         class_prepared.connect(add_field)
+
+    # Django 1.8: chain the pending lookups of the app registry, one model at a time
+    model_key, more_models = model_keys[0], models[1:]
+
+    def apply(model):
+        if more_models:
+            lazy_model_operation(partial(function, model), *more_models)
+        else:
+            function(model)
+    try:
+        model_class = apps.get_registered_model(*model_key)
+    except LookupError:
+        apps._pending_lookups.setdefault(model_key, []).append(
+            (None, None, lambda field, model, cls: apply(model)))
+    else:
+        apply(model_class)
+
+
+def inject_extra_field_to_model(from_model, field_name, field):
+    '''
+    Add ``field`` to ``from_model`` (a model class or an ``"app_label.ModelName"``
+    string, in which case the field is added once that model is registered).
+    '''
+    lazy_model_operation(lambda model: field.contribute_to_class(model, field_name), from_model)
 
 
 def add_sorted_one2many_relation(model_one,
                                  model_many,
                                  field_name_on_model_one=None,
                                  related_name_on_model_many=None):
-    field_name = field_name_on_model_one or model_many._meta.model_name + '_set'
-    related_name = related_name_on_model_many or model_one._meta.model_name
+    '''
+    Add a ``SortedOneToManyField`` from ``model_one`` to ``model_many`` (model
+    classes or ``"app_label.ModelName"`` strings, resolved lazily).
+    '''
+    field_name = field_name_on_model_one or get_model_key(model_many)[1] + '_set'
+    related_name = related_name_on_model_many or get_model_key(model_one)[1]
     field = SortedOneToManyField(model_many, related_name=related_name)
-    field.contribute_to_class(model_one, field_name)
+    inject_extra_field_to_model(model_one, field_name, field)
+
+
+def get_sorted_one2many_fields(app_labels=None):
+    '''
+    Return all the sorted ``SortedOneToManyField`` fields (with an auto-created
+    intermediary model) of the installed models, optionally restricted to
+    ``app_labels``.
+    '''
+    fields = []
+    for model in apps.get_models():
+        if app_labels and model._meta.app_label not in app_labels:
+            continue
+        for field in model._meta.local_many_to_many:
+            if (isinstance(field, SortedOneToManyField) and field.sorted and
+                    field.rel.through._meta.auto_created):
+                fields.append(field)
+    return fields
+
+
+def get_table_info(field, connection):
+    '''
+    Return the quoted names of the intermediary table of ``field`` and of its
+    columns (``table``, ``pk``, ``owner``, ``item``, ``sort``), to build raw SQL.
+    '''
+    through = field.rel.through
+    qn = connection.ops.quote_name
+    return {
+        'table': qn(through._meta.db_table),
+        'pk': qn(through._meta.pk.column),
+        'owner': qn(through._meta.get_field(through._from_field_name).column),
+        'item': qn(through._meta.get_field(through._to_field_name).column),
+        'sort': qn(through._meta.get_field(through._sort_field_name).column),
+    }
+
 
+def chunked(iterable, size):
+    'split ``iterable`` into lists of (at most) ``size`` elements'
+    chunk = []
+    for element in iterable:
+        chunk.append(element)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
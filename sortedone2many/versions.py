@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+'''
+Version stamps of the related objects lists, enabled with the ``version_field``
+option, e.g. to answer conditional GET requests with ``304 Not Modified``
+without loading the items::
+
+    class Category(models.Model):
+        items_version = models.IntegerField(default=0)
+        items = SortedOneToManyField(Item, version_field='items_version')
+
+Every operation on the relation increments the version of the owners whose
+list changed (objects added, removed or reordered), with ``F()`` expressions
+in the same transaction, as for ``count_field``. ``get_etag()`` and
+``get_etags()`` read the versions with one query on the owner pks::
+
+    from django.views.decorators.http import etag
+
+    @etag(etag_func(Category._meta.get_field('items')))
+    def category_detail(request, pk):
+        ...
+'''
+from django.db import router
+from django.db.models import F, QuerySet
+
+
+def bump_versions(field, changes, using):
+    'increment the version of every owner in ``changes`` (``signals.Change``)'
+    owner_pks = set()
+    for change in changes:
+        owner_pks.update([change.old_owner, change.new_owner])
+    bump_owner_versions(field, owner_pks, using)
+
+
+def bump_owner_versions(field, owner_pks, using):
+    'increment the version of every owner of ``owner_pks``'
+    from .utils import chunked
+
+    owner_pks = set(owner_pks)
+    owner_pks.discard(None)
+    manager = field.model._base_manager.using(using)
+    for chunk in chunked(sorted(owner_pks), 500):
+        manager.filter(pk__in=chunk).update(**{field.version_field: F(field.version_field) + 1})
+
+
+def _make_etag(field, owner_pk, version):
+    return '%s-%s-%s' % (field.name, owner_pk, version)
+
+
+def get_etags(field, owners, using=None):
+    '''
+    Return a dict of the ETag (unquoted, as expected by Django's ``etag``
+    decorator) of the list of each of ``owners`` (instances, pks or a
+    queryset) by owner pk, from a single query. Unknown owners are omitted.
+    '''
+    if not field.version_field:
+        raise ValueError('%s has no version_field' % field)
+    if isinstance(owners, QuerySet):
+        owner_pks = owners.values('pk')  # a subquery
+    else:
+        owner_pks = [getattr(owner, 'pk', owner) for owner in owners]
+    using = using or router.db_for_read(field.model)
+    versions = (field.model._base_manager.using(using).filter(pk__in=owner_pks)
+                .values_list('pk', field.version_field))
+    return dict((pk, _make_etag(field, pk, version)) for pk, version in versions)
+
+
+def get_etag(field, owner, using=None):
+    'the ETag of the list of ``owner`` (an instance or a pk), or None if it does not exist'
+    owner_pk = getattr(owner, 'pk', owner)
+    return get_etags(field, [owner_pk], using).get(owner_pk)
+
+
+def etag_func(field, url_kwarg='pk'):
+    '''
+    Return a function computing the ETag of the owner whose pk is the
+    ``url_kwarg`` argument of a view, for ``django.views.decorators.http.etag``.
+    '''
+    def func(request, *args, **kwargs):
+        return get_etag(field, kwargs[url_kwarg])
+    return func
@@ -16,6 +16,11 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(PROJECT_ROOT, 'db.sqlite'),
     },
+    # second shard, used by the sharding tests only (see `tests.tests.ShardRouter`)
+    'shard2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(PROJECT_ROOT, 'db_shard2.sqlite'),
+    },
 }
 
 # Local time zone for this installation. Choices can be found here:
@@ -71,7 +76,7 @@ INSTALLED_APPS = (
 
     'sortedm2m',  # dependency
 
-##     'sortedone2many', # no model/static files; no need to add
+    'sortedone2many',  # no models; only needed for the management commands
 
     'test_app',
  
@@ -2,7 +2,8 @@
 
 from django.db import models
 from sortedone2many.fields import SortedOneToManyField
-from sortedone2many.utils import inject_extra_field_to_model
+from sortedone2many.query import One2ManyQuerySet
+from sortedone2many.utils import add_sorted_one2many_relation, inject_extra_field_to_model
 
 
 class Item(models.Model):
@@ -49,3 +50,73 @@ inject_extra_field_to_model(M1, 'items',
 
 
 
+
+
+class ItemAutoPrefetch(models.Model):
+    name = models.CharField(max_length=50)
+
+
+class CategoryAutoPrefetch(models.Model):
+    name = models.CharField(max_length=50)
+    items = SortedOneToManyField(ItemAutoPrefetch, related_name='category', auto_prefetch=True)
+
+
+class Node(models.Model):
+    name = models.CharField(max_length=50)
+    children = SortedOneToManyField('self', related_name='parent', prevent_cycles=True, blank=True)
+
+
+# declared before the models exist: added once they are registered
+inject_extra_field_to_model('tests.CategoryLazy', 'items',
+    SortedOneToManyField('ItemLazy', sorted=True, related_name='category', blank=True))
+add_sorted_one2many_relation('tests.CategoryLazy', 'app2.M2', 'm2_items', 'lazy_category')
+
+
+class ItemLazy(models.Model):
+    name = models.CharField(max_length=50)
+
+
+class CategoryLazy(models.Model):
+    name = models.CharField(max_length=50)
+
+
+class PublishedManager(models.Manager):
+    def get_queryset(self):
+        return super(PublishedManager, self).get_queryset().filter(published=True)
+
+
+class ItemPublished(models.Model):
+    published = models.BooleanField(default=True)
+
+    objects = PublishedManager()
+
+
+class CategoryPublished(models.Model):
+    items = SortedOneToManyField(ItemPublished, related_name='category')
+
+
+class ItemCustomPosition(models.Model):
+    name = models.CharField(max_length=50)
+    category_position = models.IntegerField(default=0)
+    category_id = models.IntegerField(default=0)
+
+    def next_in_category(self):
+        return 'custom'
+
+
+class CategoryCustomPosition(models.Model):
+    items = SortedOneToManyField(ItemCustomPosition, related_name='category')
+
+
+class ItemCounted(models.Model):
+    name = models.CharField(max_length=50)
+
+    objects = One2ManyQuerySet.as_manager()
+
+
+class CategoryCounted(models.Model):
+    name = models.CharField(max_length=50)
+    items_count = models.IntegerField(default=0)
+    items_version = models.IntegerField(default=0)
+    items = SortedOneToManyField(ItemCounted, related_name='category', count_field='items_count',
+                                 version_field='items_version')
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 from django.db import models
 
-from django.db import connection
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import signals
+from django.db.models.query import QuerySet
 from django.db.models.fields import FieldDoesNotExist
 from django.test.utils import override_settings
 from django.utils import six
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.db.utils import IntegrityError
 
+import json
+import pickle
 import re
+import warnings
 
 import sys, os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -17,6 +23,16 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from .models import *
 from .app2.models import M1, M2
 
+import sortedone2many
+from sortedone2many.instrumentation import MetricsCollector, assert_max_queries
+from sortedone2many.nplusone import NPlusOneError, NPlusOneWarning, detect_n_plus_one
+from sortedone2many.deletion import delete_owners, detach
+from sortedone2many.integrity import delete_orphans, find_anomalies, renumber
+from sortedone2many.ordering import assign_sort_values
+from sortedone2many.resultsets import get_result_set
+from sortedone2many.signals import Change, one2many_changed
+from sortedone2many.routing import StickyReadsMiddleware, sticky_reads
+
 
 str_ = six.text_type
 
@@ -326,3 +342,1487 @@ class TestAddExtraField(TestSortedOneToManyField):
     M_Cat = M1
     M_Item = M2
 
+
+class TestAddExtraFieldLazily(TestSortedOneToManyField):
+    M_Cat = CategoryLazy
+    M_Item = ItemLazy
+
+    def test_add_sorted_one2many_relation(self):
+        cat = CategoryLazy.objects.create(name='cat')
+        m2 = M2.objects.create(name='m2')
+        cat.m2_items.add(m2)
+        self.assertEqual(M2.objects.get(pk=m2.pk).lazy_category, cat)
+
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        self.cat = Category.objects.create(name="cat")
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(3)]
+
+    def test_collect_manager_operations(self):
+        with MetricsCollector(Category.items.through) as collector:
+            self.cat.items.add(self.items[0], self.items[1])
+            self.cat.items.remove(self.items[0])
+            self.cat.items.clear()
+
+        self.assertEqual([r['operation'] for r in collector.records],
+                         ['add', 'remove', 'clear'])
+        add = collector.filter('add')[0]
+        self.assertEqual(add['instance'], self.cat)
+        self.assertEqual(add['rows'], 2)
+        self.assertTrue(add['queries'] > 0)
+        self.assertEqual(collector.summary()['clear']['count'], 1)
+
+        # disconnected after the block
+        self.cat.items.add(self.items[2])
+        self.assertEqual(len(collector.records), 3)
+
+    def test_query_count_exact(self):
+        with MetricsCollector() as collector:
+            with self.assertNumQueries(5):  # current rows, savepoint, max, insert, release
+                self.cat.items.add(self.items[0])
+            # a full query log (of the debug cursor) doesn't matter
+            connection.queries_log.extend([{}] * connection.queries_log.maxlen)
+            try:
+                self.cat.items.add(self.items[1])
+            finally:
+                connection.queries_log.clear()
+        self.assertEqual([r['queries'] for r in collector.filter('add')], [5, 5])
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_collect_descriptor_hit_and_miss(self):
+        self.cat.items.add(self.items[0])
+        item = Item.objects.get(pk=self.items[0].pk)
+        with MetricsCollector() as collector:
+            self.assertEqual(item.category, self.cat)
+            self.assertEqual(item.category, self.cat)
+        summary = collector.summary()['get']
+        self.assertEqual((summary['hits'], summary['misses']), (1, 1))
+        self.assertEqual([r['queries'] > 0 for r in collector.filter('get')],
+                         [True, False])
+
+    def test_collect_prefetch_batch_size(self):
+        with MetricsCollector() as collector:
+            list(Item.objects.prefetch_related('category'))
+        self.assertEqual(collector.filter('prefetch')[0]['batch_size'], 3)
+
+    def test_assert_max_queries(self):
+        with assert_max_queries(10, 'set'):
+            self.items[0].category = self.cat
+
+        def move():
+            with assert_max_queries(0, 'set'):
+                self.items[0].category = None
+        self.assertRaises(AssertionError, move)
+
+
+class TestNPlusOneDetection(TestCase):
+
+    def setUp(self):
+        self.cat = Category.objects.create(name="cat")
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(3)]
+        self.cat.items = self.items
+
+    def test_raise_on_threshold(self):
+        with detect_n_plus_one('raise', threshold=2):
+            items = list(Item.objects.all())
+            self.assertEqual(items[0].category, self.cat)
+            self.assertRaisesMessage(NPlusOneError, "prefetch_related('category')",
+                                     lambda: items[1].category)
+
+    def test_warn_once_with_call_site(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with detect_n_plus_one('warn', threshold=2):
+                for item in Item.objects.all():
+                    item.category
+        caught = [w for w in caught if issubclass(w.category, NPlusOneWarning)]
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(caught[0].filename, os.path.abspath(__file__.replace('.pyc', '.py')))
+
+    def test_no_report_when_prefetched_or_unrelated(self):
+        with detect_n_plus_one('raise', threshold=2):
+            for item in Item.objects.prefetch_related('category'):
+                item.category
+            for item in self.items:
+                item.category
+
+
+class TestAutoPrefetch(TestCase):
+
+    def setUp(self):
+        self.cats = [CategoryAutoPrefetch.objects.create(name="cat%s" % i) for i in range(2)]
+        self.items = [ItemAutoPrefetch.objects.create(name="item%s" % i) for i in range(5)]
+        self.cats[0].items = self.items[:2]
+        self.cats[1].items = self.items[2:4]
+
+    def test_siblings_loaded_in_one_query(self):
+        items = list(ItemAutoPrefetch.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            categories = [item.category for item in items]
+        self.assertEqual(categories, [self.cats[0]] * 2 + [self.cats[1]] * 2 + [None])
+
+    def test_single_instance_not_prefetched(self):
+        item = ItemAutoPrefetch.objects.get(pk=self.items[0].pk)
+        self.assertEqual(item.category, self.cats[0])
+
+    def test_not_enabled_by_default(self):
+        Item.objects.create(name="item0")
+        Item.objects.create(name="item1")
+        items = list(Item.objects.all())
+        for item in items:
+            self.assertEqual(item.category, None)
+            self.assertFalse(Item.category.is_cached(item))
+
+
+    def test_owner_ids_loaded_in_one_query(self):
+        items = list(ItemAutoPrefetch.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            owner_pks = [item.category_id for item in items]
+        self.assertEqual(owner_pks, [self.cats[0].pk] * 2 + [self.cats[1].pk] * 2 + [None])
+
+    def test_siblings_from_owner_manager(self):
+        items = list(self.cats[0].items.all())
+        with self.assertNumQueries(1):
+            categories = [item.category for item in items]
+        self.assertEqual(categories, [self.cats[0]] * 2)
+
+    def test_only_related_model_tracked(self):
+        # no global patch
+        self.assertEqual(QuerySet.__dict__['_fetch_all'].__module__, 'django.db.models.query')
+        cats = list(CategoryAutoPrefetch.objects.all())
+        self.assertIsNone(get_result_set(cats[0]))
+        self.assertIsNotNone(get_result_set(list(ItemAutoPrefetch.objects.all())[0]))
+
+    def test_pickle_queryset(self):
+        queryset = pickle.loads(pickle.dumps(ItemAutoPrefetch.objects.order_by('pk')))
+        self.assertEqual(list(queryset), self.items)
+
+
+class TestOwnerId(TestCase):
+
+    def setUp(self):
+        self.cats = [Category.objects.create(name="cat%s" % i) for i in range(2)]
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(3)]
+        self.cats[0].items = self.items[:2]
+
+    def test_get(self):
+        item = Item.objects.get(pk=self.items[0].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(item.category_id, self.cats[0].pk)
+            self.assertEqual(item.category_id, self.cats[0].pk)
+        item = Item.objects.get(pk=self.items[2].pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(item.category_id, None)
+
+    def test_cached_owner(self):
+        items = list(Item.objects.prefetch_related('category'))
+        with self.assertNumQueries(0):
+            self.assertEqual([item.category_id for item in items],
+                             [self.cats[0].pk, self.cats[0].pk, None])
+
+    def test_set(self):
+        item = Item.objects.get(pk=self.items[0].pk)
+        item.category_id = self.cats[1].pk
+        with self.assertNumQueries(0):
+            self.assertEqual(item.category_id, self.cats[1].pk)
+        self.assertEqual(list(self.cats[1].items.all()), [item])
+        self.assertEqual(item.category, self.cats[1])
+
+        item.category_id = str(self.cats[0].pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(item.category_id, self.cats[0].pk)
+        self.assertEqual(item.category, self.cats[0])
+        with self.assertRaises(ValueError):
+            item.category_id = 'abc'
+
+        item.category_id = None
+        self.assertEqual(item.category_id, None)
+        self.assertEqual(list(self.cats[1].items.all()), [])
+        item.category = self.cats[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(item.category_id, self.cats[0].pk)
+
+
+class TestIterRelated(TestCase):
+
+    def setUp(self):
+        self.cats = [Category.objects.create(name="cat%s" % i) for i in range(3)]
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(5)]
+        self.cats[0].items = [self.items[3], self.items[0]]
+        self.cats[1].items = [self.items[1], self.items[4], self.items[2]]
+        self.field = Category._meta.get_field('items')
+
+    def test_iter_pks(self):
+        with self.assertNumQueries(1):
+            result = list(self.field.iter_related())
+        self.assertEqual(result, [
+            (self.cats[0].pk, [self.items[3].pk, self.items[0].pk]),
+            (self.cats[1].pk, [self.items[1].pk, self.items[4].pk, self.items[2].pk]),
+        ])
+
+    def test_iter_values(self):
+        result = list(self.field.iter_related(['name'], owners=[self.cats[1].pk]))
+        self.assertEqual(result, [
+            (self.cats[1].pk, [('item1',), ('item4',), ('item2',)]),
+        ])
+
+
+class TestIntegrity(TestCase):
+
+    def setUp(self):
+        self.cats = [Category.objects.create(name="cat%s" % i) for i in range(3)]
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(8)]
+        self.cats[0].items = self.items[:3]
+        self.cats[1].items = self.items[3:6]
+        self.cats[2].items = self.items[6:7]
+        self.field = Category._meta.get_field('items')
+        self.through = self.field.rel.through
+
+    def make_anomalies(self):
+        # duplicates in cats[0], a gap in cats[1]
+        self.through.objects.filter(category=self.cats[0], item=self.items[2]).update(sort_value=1)
+        self.through.objects.filter(category=self.cats[1], item=self.items[4]).delete()
+        # a row whose owner was deleted (sqlite does not enforce the foreign keys)
+        self.through.objects.create(category_id=self.cats[2].pk + 100, item=self.items[7], sort_value=1)
+
+    def test_find_and_repair(self):
+        self.assertEqual(find_anomalies(self.field, gaps=True), {
+            'duplicates': [], 'gaps': [], 'missing_owners': 0, 'missing_items': 0})
+        self.make_anomalies()
+        self.assertEqual(find_anomalies(self.field), {
+            'duplicates': [self.cats[0].pk], 'missing_owners': 1, 'missing_items': 0})
+        self.assertEqual(find_anomalies(self.field, gaps=True)['gaps'], [self.cats[1].pk])
+
+        self.assertEqual(delete_orphans(self.field, batch_size=1), 1)
+        self.assertEqual(renumber(self.field, batch_size=1), 1)
+        self.assertEqual(renumber(self.field, batch_size=1, gaps=True), 1)
+        self.assertEqual(find_anomalies(self.field, gaps=True), {
+            'duplicates': [], 'gaps': [], 'missing_owners': 0, 'missing_items': 0})
+        # ties are broken by the row pk
+        self.assertEqual(list(self.cats[0].items.all()),
+                         [self.items[0], self.items[2], self.items[1]])
+        self.assertEqual(list(self.cats[1].items.all()), [self.items[3], self.items[5]])
+        self.assertEqual(list(self.through.objects.filter(category=self.cats[1])
+                              .values_list('sort_value', flat=True)), [1, 2])
+
+    def test_filtering_default_manager(self):
+        field = CategoryPublished._meta.get_field('items')
+        cat = CategoryPublished.objects.create()
+        cat.items = [ItemPublished.objects.create(), ItemPublished.objects.create(published=False)]
+        self.assertEqual(find_anomalies(field)['missing_items'], 0)
+        self.assertEqual(delete_orphans(field), 0)
+        self.assertEqual(field.rel.through.objects.count(), 2)
+
+    def test_command(self):
+        self.make_anomalies()
+        out = six.StringIO()
+        call_command('check_sortedone2many', 'tests', stdout=out)
+        self.assertIn('tests.Category.items: 1 owners with duplicate sort values, '
+                      '1 rows with a missing owner', out.getvalue())
+        self.assertNotIn('gaps', out.getvalue())
+
+        call_command('check_sortedone2many', 'tests', repair=True, stdout=out)
+        self.assertIn('tests.Category.items: deleted 1 orphan rows, renumbered 1 owners',
+                      out.getvalue())
+        self.assertEqual(find_anomalies(self.field)['duplicates'], [])
+
+        call_command('check_sortedone2many', 'tests', gaps=True, repair=True, stdout=out)
+        self.assertIn('tests.Category.items: 1 owners with gaps', out.getvalue())
+        self.assertEqual(find_anomalies(self.field, gaps=True)['gaps'], [])
+
+    def test_normal_operations_are_not_anomalies(self):
+        self.cats[0].items.remove(self.items[1])
+        self.cats[1].items.merge_into(self.cats[2], position='start')
+        self.assertEqual(find_anomalies(self.field), {
+            'duplicates': [], 'missing_owners': 0, 'missing_items': 0})
+
+
+class TestMinimalDiffSet(TestCase):
+
+    def setUp(self):
+        self.cat = Category.objects.create(name="cat")
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(20)]
+        self.cat.items = self.items
+        self.through = Category.items.through
+
+    def get_sort_values(self):
+        return dict(self.through.objects.filter(category=self.cat)
+                    .values_list('item_id', 'sort_value'))
+
+    def test_assign_sort_values(self):
+        current = {'a': 1, 'b': 2, 'c': 3, 'd': 4}
+        self.assertEqual(assign_sort_values(list('abcd'), current), {})
+        self.assertEqual(assign_sort_values(list('bcda'), current), {'a': 5})
+        self.assertEqual(assign_sort_values(list('dabc'), current), {'d': 0})
+        self.assertEqual(assign_sort_values(list('abxcd'), current), {'x': 3, 'c': 4, 'd': 5})
+        self.assertEqual(assign_sort_values(list('xy'), {}), {'x': 1, 'y': 2})
+
+    def test_move_one_item_updates_one_row(self):
+        before = self.get_sort_values()
+        items = self.items[1:] + self.items[:1]
+        with self.assertNumQueries(2):  # select + update
+            self.cat.items.set(items)
+        self.assertEqual(list(self.cat.items.all()), items)
+        after = self.get_sort_values()
+        changed = [pk for pk in after if after[pk] != before[pk]]
+        self.assertEqual(changed, [self.items[0].pk])
+
+    def test_add_remove_and_reorder(self):
+        received = []
+
+        def receiver(sender, action, pk_set, **kwargs):
+            received.append((action, pk_set))
+        signals.m2m_changed.connect(receiver, sender=self.through)
+        try:
+            items = [self.items[5], self.items[3]] + self.items[10:15]
+            self.cat.items.set([str_(item.pk) for item in items])
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=self.through)
+
+        self.assertEqual(list(self.cat.items.all()), items)
+        self.assertEqual([action for action, _ in received],
+                         ['pre_remove', 'post_remove'])
+        self.assertEqual(len(received[0][1]), 13)
+
+    def test_clear_keeps_wholesale_replacement(self):
+        self.cat.items.set(self.items[:2], clear=True)
+        self.assertEqual(list(self.cat.items.all()), self.items[:2])
+
+
+class TestBatch(TestCase):
+    assertRaisesUniqueFailed = TestSortedOneToManyField.__dict__['assertRaisesUniqueFailed']
+
+    def setUp(self):
+        self.cats = [Category.objects.create(name="cat%s" % i) for i in range(3)]
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(10)]
+        self.cats[0].items = self.items[:4]
+
+    def test_no_queries_until_exit(self):
+        with sortedone2many.batch():
+            with self.assertNumQueries(0):
+                self.cats[1].items.add(self.items[5], self.items[6])
+                self.items[7].category = self.cats[1]
+                self.items[0].category = self.cats[2]
+                self.cats[0].items.remove(self.items[1])
+        self.assertEqual(list(self.cats[0].items.all()), [self.items[2], self.items[3]])
+        self.assertEqual(list(self.cats[1].items.all()), self.items[5:8])
+        self.assertEqual(list(self.cats[2].items.all()), [self.items[0]])
+
+    def test_manager_operations_update_caches(self):
+        item = self.items[0]
+        self.assertEqual(item.category, self.cats[0])
+        with sortedone2many.batch():
+            with self.assertNumQueries(0):
+                self.cats[0].items.remove(item)
+                self.assertIsNone(item.category)
+                self.assertIsNone(item.category_id)
+                self.cats[1].items.add(item)
+                self.assertEqual(item.category, self.cats[1])
+                self.assertEqual(item.category_id, self.cats[1].pk)
+                self.cats[2].items.set([self.items[5]])
+                self.assertEqual(self.items[5].category, self.cats[2])
+        self.assertEqual(Item.objects.get(pk=item.pk).category, self.cats[1])
+
+    def test_coalesce_per_item(self):
+        with MetricsCollector() as collector:
+            with sortedone2many.batch():
+                for cat in self.cats:
+                    self.items[5].category = cat
+                self.items[6].category = self.cats[1]
+                self.items[6].category = None
+                self.cats[0].items.clear()
+                self.cats[0].items.add(self.items[3], self.items[8])
+                # cache kept consistent
+                self.assertEqual(self.items[5].category, self.cats[2])
+        self.assertEqual(list(self.cats[0].items.all()), [self.items[3], self.items[8]])
+        self.assertEqual(list(self.cats[1].items.all()), [])
+        self.assertEqual(list(self.cats[2].items.all()), [self.items[5]])
+        # delete items 0-2, update item 3 (re-appended), insert items 5 and 8
+        self.assertEqual(collector.filter('flush')[0]['rows'], 6)
+
+    def test_set_and_nested(self):
+        with sortedone2many.batch():
+            with sortedone2many.batch():
+                self.cats[0].items = [self.items[3], self.items[0], self.items[9]]
+            self.assertEqual(list(self.cats[0].items.all()), self.items[:4])
+        self.assertEqual(list(self.cats[0].items.all()),
+                         [self.items[3], self.items[0], self.items[9]])
+
+    def test_nothing_written_on_error(self):
+        def fail():
+            with sortedone2many.batch():
+                self.cats[0].items.clear()
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(list(self.cats[0].items.all()), self.items[:4])
+
+    def test_unique_constraint(self):
+        def add():
+            with sortedone2many.batch():
+                self.cats[1].items.add(self.items[0])
+        self.assertRaisesUniqueFailed(add)
+
+
+class TestTrees(TestCase):
+
+    def setUp(self):
+        self.field = CategorySelf._meta.get_field('items')
+        # root -> [a -> [a1, a2 -> [a21]], b]
+        names = ['root', 'a', 'a1', 'a2', 'a21', 'b']
+        self.nodes = dict((name, CategorySelf.objects.create(name=name)) for name in names)
+        nodes = self.nodes
+        nodes['root'].items = [nodes['a'], nodes['b']]
+        nodes['a'].items = [nodes['a2'], nodes['a1']]
+        nodes['a'].items.set([nodes['a1'], nodes['a2']])  # moves a1 before a2
+        nodes['a2'].items.add(nodes['a21'])
+
+    def names(self, instances):
+        return [instance.name for instance in instances]
+
+    def test_descendants(self):
+        with self.assertNumQueries(1):
+            descendants = self.field.descendants(self.nodes['root'])
+        self.assertEqual(self.names(descendants), ['a', 'a1', 'a2', 'a21', 'b'])
+        self.assertEqual(self.names(self.field.descendants(self.nodes['a'].pk)), ['a1', 'a2', 'a21'])
+        self.assertEqual(self.field.descendants(self.nodes['b']), [])
+
+    def test_subtree_ordered(self):
+        subtree = self.field.subtree_ordered(self.nodes['a'])
+        self.assertEqual([(node.name, depth) for node, depth in subtree],
+                         [('a', 0), ('a1', 1), ('a2', 1), ('a21', 2)])
+
+    def test_ancestors(self):
+        with self.assertNumQueries(1):
+            ancestors = self.field.ancestors(self.nodes['a21'])
+        self.assertEqual(self.names(ancestors), ['a2', 'a', 'root'])
+        self.assertEqual(self.field.ancestors(self.nodes['root']), [])
+
+    def test_cycles_terminate(self):
+        self.nodes['a21'].items.add(self.nodes['root'])
+        self.assertEqual(self.names(self.field.descendants(self.nodes['root'])),
+                         ['a', 'a1', 'a2', 'a21', 'b'])
+        self.assertEqual(self.names(self.field.ancestors(self.nodes['a'])), ['root', 'a21', 'a2'])
+        loop = CategorySelf.objects.create(name='loop')
+        loop.items.add(loop)
+        self.assertEqual(self.field.descendants(loop), [])
+        self.assertEqual(self.field.ancestors(loop), [])
+
+    def test_not_self_referential(self):
+        self.assertRaises(ValueError, Category._meta.get_field('items').descendants, 1)
+
+
+class TestPreventCycles(TestCase):
+
+    def setUp(self):
+        self.a, self.b, self.c, self.d = [Node.objects.create(name=name) for name in 'abcd']
+        self.a.children = [self.b]
+        self.b.children = [self.c]
+
+    def test_assignment(self):
+        self.assertRaises(ValueError, setattr, self.a, 'parent', self.c)
+        self.assertRaises(ValueError, setattr, self.a, 'parent', self.a)
+        self.assertIsNone(Node.objects.get(pk=self.a.pk).parent)
+        with self.assertNumQueries(1):
+            self.assertRaises(ValueError, setattr, self.b, 'parent', self.c)
+        self.d.parent = self.c
+        self.assertEqual(self.field_ancestors(self.d), [self.c, self.b, self.a])
+
+    def test_manager(self):
+        self.assertRaises(ValueError, self.c.children.add, self.d, self.a)
+        self.assertRaises(ValueError, self.c.children.set, [self.d, self.a.pk])
+        self.assertRaises(ValueError, self.b.children.add, self.b)
+        self.assertEqual(list(self.c.children.all()), [])
+        self.c.children.add(self.d)
+        self.assertEqual(list(self.c.children.all()), [self.d])
+
+    def test_batch_checks_on_flush(self):
+        def move():
+            with sortedone2many.batch():
+                self.a.parent = self.c
+        self.assertRaises(ValueError, move)
+
+    def test_batch_checks_buffered_changes(self):
+        def assign():
+            with sortedone2many.batch():
+                self.c.parent = self.d
+                self.d.parent = self.c
+
+        def add():
+            with sortedone2many.batch():
+                self.c.children.add(self.d)
+                self.d.children.add(self.a)
+        self.assertRaises(ValueError, assign)
+        self.assertRaises(ValueError, add)
+        self.assertEqual(self.field_ancestors(self.c), [self.b, self.a])
+        self.assertIsNone(Node.objects.get(pk=self.d.pk).parent)
+        # reversing a branch in one batch is fine
+        with sortedone2many.batch():
+            self.b.parent = None
+            self.a.parent = self.b
+        self.assertEqual(self.field_ancestors(self.a), [self.b])
+
+    def field_ancestors(self, node):
+        return Node._meta.get_field('children').ancestors(node)
+
+
+class LoggingRouter(object):
+    'route everything to the default database, logging the decisions'
+    log = []
+
+    def db_for_read(self, model, **hints):
+        self.log.append(('read', model))
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        self.log.append(('write', model))
+        return 'default'
+
+
+class ShardRouter(object):
+    '''
+    Keep the intermediary rows on the database of their owner (or of the
+    instance), logging the relation hints.
+    '''
+    hints = []
+
+    def db_for_read(self, model, **hints):
+        self.hints.append(sorted(key for key in hints if key in ('owner', 'item')))
+        instance = hints.get('owner', hints.get('instance'))
+        return getattr(instance, '_state', None) and instance._state.db
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+class ReplicaRouter(object):
+    'read from the replica (``shard2``), write to the primary'
+
+    def db_for_read(self, model, **hints):
+        return 'shard2'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+
+@override_settings(DATABASE_ROUTERS=['tests.tests.ReplicaRouter'])
+class TestReplicaRouting(TestCase):
+    multi_db = True
+
+    def test_assignment_never_writes_to_replica(self):
+        cat = Category.objects.create(name='cat')
+        item = Item.objects.create(name='item')
+        # a stale row, only on the replica
+        old = Category.objects.using('shard2').create(name='old')
+        Item.objects.using('shard2').create(pk=item.pk, name=item.name)
+        old.items.through.objects.using('shard2').create(category=old, item_id=item.pk, sort_value=1)
+
+        with self.assertNumQueries(1, using='shard2'):  # the current owner
+            item.category = cat
+        through = Category.items.through
+        self.assertEqual(list(through.objects.using('shard2').values_list('category', 'item')),
+                         [(old.pk, item.pk)])
+        self.assertEqual(list(through.objects.using('default').values_list('category', 'item')),
+                         [(cat.pk, item.pk)])
+
+
+@override_settings(DATABASE_ROUTERS=['tests.tests.ShardRouter'])
+class TestSharding(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.cats = [CategoryCounted.objects.using(db).create(name=db) for db in ('default', 'shard2')]
+        # the items are replicated on both shards
+        self.items = [ItemCounted.objects.create(name="item%s" % i) for i in range(3)]
+        for item in self.items:
+            ItemCounted.objects.using('shard2').create(pk=item.pk, name=item.name)
+        self.through = CategoryCounted.items.through
+
+    def rows(self, db):
+        return sorted(self.through.objects.using(db).values_list('categorycounted_id', 'itemcounted_id'))
+
+    def counts(self):
+        return [CategoryCounted.objects.using(cat._state.db).get(pk=cat.pk).items_count for cat in self.cats]
+
+    def test_rows_follow_owner(self):
+        self.cats[1].items.add(self.items[0])
+        self.cats[1].items.set([self.items[1], self.items[0]])
+        self.assertEqual(self.rows('default'), [])
+        self.assertEqual(self.rows('shard2'), [(self.cats[1].pk, self.items[0].pk),
+                                               (self.cats[1].pk, self.items[1].pk)])
+        self.assertEqual([item.name for item in self.cats[1].items.all()], ['item1', 'item0'])
+        item = ItemCounted.objects.using('shard2').get(pk=self.items[0].pk)
+        self.assertEqual(item.category, self.cats[1])
+        self.assertEqual(item.category_id, self.cats[1].pk)
+
+    def test_cross_shard_move(self):
+        self.cats[0].items = self.items[:2]
+        self.items[0].category = self.cats[1]
+        self.assertEqual(self.rows('default'), [(self.cats[0].pk, self.items[1].pk)])
+        self.assertEqual(self.rows('shard2'), [(self.cats[1].pk, self.items[0].pk)])
+        self.assertEqual(self.items[0].category, self.cats[1])
+        self.assertEqual([item.name for item in self.cats[1].items.all()], ['item0'])
+        self.assertEqual(self.counts(), [1, 1])
+        # same shard
+        self.items[1].category = CategoryCounted.objects.create(name='other')
+        self.assertEqual(self.rows('default'), [(self.items[1].category.pk, self.items[1].pk)])
+
+    def test_move_back_to_item_shard(self):
+        # cached owner
+        self.items[0].category = self.cats[1]
+        self.items[0].category = self.cats[0]
+        self.assertEqual(self.rows('default'), [(self.cats[0].pk, self.items[0].pk)])
+        self.assertEqual(self.rows('shard2'), [])
+        # the item is loaded from the shard of its row
+        self.cats[1].items = self.items[1:2]
+        item = ItemCounted.objects.using('shard2').get(pk=self.items[1].pk)
+        item.category = self.cats[0]
+        self.assertEqual(self.rows('default'), [(self.cats[0].pk, self.items[0].pk),
+                                                (self.cats[0].pk, self.items[1].pk)])
+        self.assertEqual(self.rows('shard2'), [])
+        self.assertEqual(self.counts(), [2, 0])
+
+    def test_move_within_other_shard(self):
+        other = CategoryCounted.objects.using('shard2').create(name='other')
+        item = self.items[0]
+        item.category = self.cats[1]
+        # the item is on the default database, its cached owner on the other one
+        item.category = other
+        self.assertEqual(self.rows('default'), [])
+        self.assertEqual(self.rows('shard2'), [(other.pk, item.pk)])
+        item.category = None
+        self.assertEqual(self.rows('shard2'), [])
+
+    def test_bulk_moves_across_shards(self):
+        self.cats[0].items = self.items[:2]
+        self.assertRaises(ValueError, self.cats[0].items.merge_into, self.cats[1])
+        self.assertRaises(ValueError, self.cats[0].items.split, 1, self.cats[1])
+        with self.assertRaises(ValueError):
+            with sortedone2many.batch():
+                self.items[0].category = self.cats[1]
+                self.cats[0].items.remove(self.items[1])
+        self.assertEqual(self.rows('default'), [(self.cats[0].pk, self.items[0].pk),
+                                                (self.cats[0].pk, self.items[1].pk)])
+        self.assertEqual(self.rows('shard2'), [])
+
+    def test_batch_using(self):
+        item = ItemCounted.objects.using('shard2').get(pk=self.items[0].pk)
+        with sortedone2many.batch(using='shard2'):
+            # a bare pk gives no hint to the router
+            item.category_id = self.cats[1].pk
+        self.assertEqual(self.rows('default'), [])
+        self.assertEqual(self.rows('shard2'), [(self.cats[1].pk, item.pk)])
+        self.assertEqual(self.counts(), [0, 1])
+
+    def test_batch_atomic_on_owner_shard(self):
+        shard = connections['shard2']
+        depth = len(shard.savepoint_ids)
+        depths = []
+
+        def receiver(action, **kwargs):
+            depths.append(len(shard.savepoint_ids))
+        signals.m2m_changed.connect(receiver, sender=self.through)
+        try:
+            with sortedone2many.batch():
+                self.cats[1].items.add(self.items[0])
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=self.through)
+        # the block of the flush is opened on the database written
+        self.assertEqual(depths, [depth + 1, depth + 1])
+        self.assertEqual(self.rows('shard2'), [(self.cats[1].pk, self.items[0].pk)])
+
+    def test_hints(self):
+        self.cats[0].items = self.items[:1]
+        item = ItemCounted.objects.get(pk=self.items[0].pk)
+        del ShardRouter.hints[:]
+        item.category_id
+        self.assertIn(['item'], ShardRouter.hints)
+        del ShardRouter.hints[:]
+        list(self.cats[0].items.all())
+        self.assertIn(['owner'], ShardRouter.hints)
+        del ShardRouter.hints[:]
+        self.cats[0].items.move(self.items[0], 0)
+        self.assertIn(['owner'], ShardRouter.hints)
+
+
+@override_settings(DATABASE_ROUTERS=['tests.tests.LoggingRouter'])
+class TestReadRouting(TestCase):
+
+    def setUp(self):
+        self.cat = Category.objects.create(name='cat')
+        self.items = [Item.objects.create(name='item%s' % i) for i in range(2)]
+        self.cat.items = self.items
+        del LoggingRouter.log[:]
+
+    def reads(self):
+        item = Item.objects.get(pk=self.items[0].pk)
+        del LoggingRouter.log[:]
+        self.assertEqual(item.category, self.cat)
+        self.assertEqual(list(self.cat.items.all()), self.items)
+        self.assertEqual(list(Item.objects.prefetch_related('category')), self.items)
+        return LoggingRouter.log
+
+    def test_reads_use_db_for_read(self):
+        log = self.reads()
+        self.assertIn(('read', Category), log)
+        self.assertIn(('read', Item), log)
+        self.assertNotIn(('write', Category), log)
+        with sticky_reads():
+            # nothing written yet
+            self.assertNotIn(('write', Category), self.reads())
+
+    def test_sticky_reads_after_write(self):
+        with sticky_reads():
+            self.items[1].category = None
+            self.cat.items.add(self.items[1])
+            log = self.reads()
+        self.assertIn(('write', Category), log)
+        self.assertIn(('write', Item), log)
+        self.assertNotIn(('read', Category), log)
+        self.assertNotIn(('write', Category), self.reads())
+
+    def test_window(self):
+        with sticky_reads(window=0):
+            self.cat.items.clear()
+            self.cat.items.add(*self.items)
+            self.assertNotIn(('write', Category), self.reads())
+
+    def test_middleware(self):
+        middleware = StickyReadsMiddleware()
+        middleware.process_request(None)
+        self.cat.items.remove(self.items[1])
+        self.cat.items.add(self.items[1])
+        self.assertIn(('write', Category), self.reads())
+        middleware.process_response(None, None)
+        self.assertNotIn(('write', Category), self.reads())
+
+
+class TestDeletion(TestCase):
+
+    def setUp(self):
+        self.field = Category._meta.get_field('items')
+        self.cats = [Category.objects.create(name="cat%s" % i) for i in range(3)]
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(9)]
+        for i, cat in enumerate(self.cats):
+            cat.items = self.items[i * 3:i * 3 + 3]
+
+    def assertDetached(self, deleted):
+        self.assertEqual(deleted, 6)
+        self.assertEqual(list(self.cats[0].items.all()), [])
+        self.assertEqual(list(self.cats[1].items.all()), [])
+        self.assertEqual(list(self.cats[2].items.all()), self.items[6:])
+        self.assertEqual(Item.objects.count(), 9)
+
+    def test_detach_raw(self):
+        with self.assertNumQueries(3):  # savepoint, DELETE, release
+            deleted = detach(self.field, Category.objects.filter(pk__in=[c.pk for c in self.cats[:2]]))
+        self.assertDetached(deleted)
+
+    def test_detach_with_delete_receivers(self):
+        # never sent for auto-created through models, so no need to load the rows
+        def receiver(sender, **kwargs):
+            pass
+        signals.post_delete.connect(receiver)
+        try:
+            with self.assertNumQueries(3):
+                deleted = detach(self.field, self.cats[:2])
+        finally:
+            signals.post_delete.disconnect(receiver)
+        self.assertDetached(deleted)
+
+    def test_detach_with_m2m_changed_receivers(self):
+        actions = []
+
+        def receiver(sender, instance, action, **kwargs):
+            actions.append((instance, action))
+        signals.m2m_changed.connect(receiver, sender=self.field.rel.through)
+        try:
+            self.assertDetached(detach(self.field, [cat.pk for cat in self.cats[:2]]))
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=self.field.rel.through)
+        self.assertEqual(sorted(actions, key=lambda action: (action[0].pk, action[1])), [
+            (self.cats[0], 'post_clear'), (self.cats[0], 'pre_clear'),
+            (self.cats[1], 'post_clear'), (self.cats[1], 'pre_clear')])
+
+    def test_delete_owners(self):
+        queryset = Category.objects.filter(pk__in=[c.pk for c in self.cats[:2]])
+        delete_owners(queryset)
+        self.assertEqual(list(Category.objects.all()), self.cats[2:])
+        self.assertEqual(Item.objects.count(), 9)
+        self.assertEqual(self.field.rel.through.objects.count(), 3)
+        self.assertIsNone(Item.objects.get(pk=self.items[0].pk).category)
+
+    def test_delete_owners_in_batch(self):
+        actions = []
+
+        def receiver(sender, instance, action, **kwargs):
+            actions.append(action)
+        signals.m2m_changed.connect(receiver, sender=self.field.rel.through)
+        try:
+            with sortedone2many.batch():
+                self.cats[0].items.add(Item.objects.create(name='item9'))
+                delete_owners(Category.objects.filter(pk__in=[c.pk for c in self.cats[:2]]))
+                # written right away
+                self.assertEqual(self.field.rel.through.objects.count(), 3)
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=self.field.rel.through)
+        self.assertEqual(actions, ['pre_add', 'post_add'] + ['pre_clear', 'post_clear'] * 2)
+        self.assertEqual(list(Category.objects.all()), self.cats[2:])
+        self.assertEqual(self.field.rel.through.objects.count(), 3)
+
+
+class TestOne2ManyChanged(TransactionTestCase):
+
+    def setUp(self):
+        self.through = Category._meta.get_field('items').rel.through
+        self.cats = [Category.objects.create(name="cat%s" % i) for i in range(2)]
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(4)]
+        self.cats[0].items = self.items[:3]
+        self.sent = []
+        one2many_changed.connect(self.receiver, sender=self.through)
+
+    def tearDown(self):
+        one2many_changed.disconnect(self.receiver, sender=self.through)
+
+    def receiver(self, sender, changes, using, **kwargs):
+        self.sent.append(sorted(changes))
+
+    def test_move(self):
+        cat0, cat1 = [cat.pk for cat in self.cats]
+        self.items[1].category = self.cats[1]
+        # the reverse accessor inserts the row with the default sort value
+        self.assertEqual(self.sent, [[Change(self.items[1].pk, cat0, cat1, 0)]])
+
+    def test_manager_operations(self):
+        cat0 = self.cats[0].pk
+        item0, item1, item2, item3 = [item.pk for item in self.items]
+        self.cats[0].items.remove(self.items[0])
+        self.cats[0].items.add(self.items[3])
+        self.cats[0].items.set([self.items[3], self.items[1]])
+        self.cats[0].items.clear()
+        self.assertEqual(self.sent, [
+            [Change(item0, cat0, None, None)],
+            [Change(item3, None, cat0, 4)],
+            [Change(item2, cat0, None, None), Change(item3, cat0, cat0, 1)],
+            [Change(item1, cat0, None, None), Change(item3, cat0, None, None)],
+        ])
+        # no change, nothing sent
+        self.cats[0].items.clear()
+        self.assertEqual(len(self.sent), 4)
+
+    def test_move_and_merge(self):
+        cat0, cat1 = [cat.pk for cat in self.cats]
+        item0, item1, item2, _ = [item.pk for item in self.items]
+        self.cats[0].items.move(self.items[2], 0)
+        self.cats[0].items.merge_into(self.cats[1])
+        self.assertEqual(self.sent, [
+            [Change(item2, cat0, cat0, 0)],
+            [Change(item0, cat0, cat1, 1), Change(item1, cat0, cat1, 2), Change(item2, cat0, cat1, 0)],
+        ])
+
+    def test_once_per_transaction(self):
+        cat0, cat1 = [cat.pk for cat in self.cats]
+        with transaction.atomic():
+            self.items[0].category = self.cats[1]
+            self.items[0].category = None
+            self.cats[1].items.add(self.items[3])
+            self.assertEqual(self.sent, [])
+        self.assertEqual(self.sent, [[Change(self.items[0].pk, cat0, None, None),
+                                      Change(self.items[3].pk, None, cat1, 1)]])
+
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                self.cats[0].items.clear()
+                raise ValueError
+        except ValueError:
+            pass
+        self.cats[1].items.add(self.items[3])
+        self.assertEqual(self.sent, [[Change(self.items[3].pk, None, self.cats[1].pk, 1)]])
+
+    def test_savepoints(self):
+        cat0, cat1 = [cat.pk for cat in self.cats]
+        with transaction.atomic():
+            self.cats[1].items.add(self.items[3])
+            try:
+                with transaction.atomic():
+                    self.items[0].category = self.cats[1]
+                    raise ValueError
+            except ValueError:
+                pass
+            with transaction.atomic():
+                self.items[1].category = None
+            self.items[2].category = None
+            self.assertEqual(self.sent, [])
+        # the changes of the rolled back savepoint are discarded
+        self.assertEqual(self.sent, [[
+            Change(self.items[1].pk, cat0, None, None),
+            Change(self.items[2].pk, cat0, None, None),
+            Change(self.items[3].pk, None, cat1, 1),
+        ]])
+        self.assertEqual(Item.objects.get(pk=self.items[0].pk).category, self.cats[0])
+
+    def test_savepoint_rollback_only(self):
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    self.cats[0].items.clear()
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(self.sent, [])
+
+    def test_batch(self):
+        with sortedone2many.batch():
+            for item in self.items:
+                item.category = self.cats[1]
+        self.assertEqual(self.sent, [[
+            Change(item.pk, self.cats[0].pk if i < 3 else None, self.cats[1].pk, i + 1)
+            for i, item in enumerate(self.items)]])
+
+    def test_detach(self):
+        detach(Category._meta.get_field('items'), self.cats)
+        self.assertEqual(self.sent, [[Change(item.pk, self.cats[0].pk, None, None)
+                                      for item in self.items[:3]]])
+
+
+class TestFormField(TestCase):
+
+    def test_formfield(self):
+        from sortedone2many.forms import SortedMultipleChoiceWithDisabledField
+        formfield = Category._meta.get_field('items').formfield()
+        self.assertIsInstance(formfield, SortedMultipleChoiceWithDisabledField)
+        self.assertEqual(list(formfield.widget.disabled_value), [])
+
+
+    def category_form(self, *args, **kwargs):
+        from sortedone2many.admin import One2ManyModelForm
+
+        class CategoryForm(One2ManyModelForm):
+            class Meta:
+                model = Category
+                fields = ['name', 'items']
+        return CategoryForm(*args, **kwargs)
+
+    def test_clean(self):
+        cats = [Category.objects.create(name='cat%s' % i) for i in range(2)]
+        items = [Item.objects.create(name='item%s' % i) for i in range(4)]
+        cats[0].items = items[:2]
+        cats[1].items = items[2:3]
+        data = {'name': 'cat0', 'items': ','.join(str(item.pk) for item in [items[3], items[1]])}
+
+        form = self.category_form(data, instance=cats[0])
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['items'], [items[3], items[1]])
+        form.save()
+        self.assertEqual(list(cats[0].items.all()), [items[3], items[1]])
+        with self.assertNumQueries(0):
+            self.assertEqual(form.cleaned_data['items'][0].category, cats[0])
+
+        # owned by another category
+        form = self.category_form(dict(data, items='%s,%s' % (items[1].pk, items[2].pk)),
+                                  instance=cats[0])
+        self.assertFalse(form.is_valid())
+        self.assertIn('already belongs', form.errors['items'][0])
+        form = self.category_form(dict(data, items=str(items[1].pk)))
+        self.assertFalse(form.is_valid())
+
+        for value in ['%s,0' % items[0].pk, 'abc']:
+            form = self.category_form(dict(data, items=value), instance=cats[0])
+            self.assertFalse(form.is_valid())
+
+
+class TestVersionField(TestCase):
+
+    def setUp(self):
+        self.cats = [CategoryCounted.objects.create(name="cat%s" % i) for i in range(3)]
+        self.items = [ItemCounted.objects.create(name="item%s" % i) for i in range(4)]
+        self.field = CategoryCounted._meta.get_field('items')
+
+    def versions(self):
+        return [CategoryCounted.objects.get(pk=cat.pk).items_version for cat in self.cats]
+
+    def test_versions(self):
+        self.cats[0].items = self.items[:3]
+        self.assertEqual(self.versions(), [1, 0, 0])
+        self.cats[0].items.set(self.items[:3])  # unchanged
+        self.assertEqual(self.versions(), [1, 0, 0])
+        self.cats[0].items.move(self.items[2], 0)
+        self.assertEqual(self.versions(), [2, 0, 0])
+        self.items[0].category = self.cats[1]
+        self.assertEqual(self.versions(), [3, 1, 0])
+        with sortedone2many.batch():
+            self.items[3].category = self.cats[2]
+            self.cats[0].items.clear()
+        self.assertEqual(self.versions(), [4, 1, 1])
+
+    def test_etags(self):
+        self.cats[1].items = self.items[:2]
+        with self.assertNumQueries(1):
+            etags = self.field.get_etags(CategoryCounted.objects.filter(pk__in=[self.cats[0].pk, self.cats[1].pk]))
+        self.assertEqual(etags, {self.cats[0].pk: 'items-%s-0' % self.cats[0].pk,
+                                 self.cats[1].pk: 'items-%s-1' % self.cats[1].pk})
+        self.assertEqual(self.field.get_etag(self.cats[1]), etags[self.cats[1].pk])
+        self.cats[1].items.remove(self.items[0])
+        self.assertNotEqual(self.field.get_etag(self.cats[1].pk), etags[self.cats[1].pk])
+        self.assertEqual(self.field.get_etag(0), None)
+        self.assertRaises(ValueError, Category._meta.get_field('items').get_etag, 1)
+
+    def test_conditional_get(self):
+        from django.test import RequestFactory
+        from django.http import HttpResponse
+        from django.views.decorators.http import etag
+        from sortedone2many.versions import etag_func
+
+        @etag(etag_func(self.field))
+        def view(request, pk):
+            return HttpResponse('items')
+
+        response = view(RequestFactory().get('/'), pk=self.cats[0].pk)
+        self.assertEqual(response.status_code, 200)
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(view(request, pk=self.cats[0].pk).status_code, 304)
+        self.cats[0].items.add(self.items[0])
+        self.assertEqual(view(request, pk=self.cats[0].pk).status_code, 200)
+
+    def test_check(self):
+        field = SortedOneToManyField(ItemCounted, version_field='name')
+        field.model = CategoryCounted
+        self.assertEqual([error.id for error in field._check_version_field()], ['sortedone2many.E002'])
+
+
+class TestPositions(TestCase):
+
+    def setUp(self):
+        self.field = Category._meta.get_field('items')
+        self.cat = Category.objects.create(name='cat')
+        self.items = [Item.objects.create(name='item%s' % i) for i in range(5)]
+        self.cat.items = self.items[:4]
+        self.cat.items.set([self.items[3], self.items[0], self.items[1], self.items[2]])
+        self.ordered = list(self.cat.items.all())
+
+    def test_position(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.ordered[2].category_position, 3)
+        self.assertEqual([item.category_position for item in self.ordered], [1, 2, 3, 4])
+        self.assertIsNone(self.items[4].category_position)
+        self.assertIsNone(Item().category_position)
+
+    def test_neighbours(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.ordered[1].next_in_category(), self.ordered[2])
+        self.assertEqual(self.ordered[1].previous_in_category(), self.ordered[0])
+        self.assertIsNone(self.ordered[3].next_in_category())
+        self.assertIsNone(self.ordered[0].previous_in_category())
+        self.assertIsNone(self.items[4].next_in_category())
+
+    def test_ties(self):
+        through = self.field.rel.through
+        through.objects.filter(category=self.cat).update(sort_value=1)
+        # same order as `category.items.all()`
+        ordered = list(self.cat.items.all())
+        self.assertEqual([item.category_position for item in ordered], [1, 2, 3, 4])
+        self.assertEqual([item.next_in_category() for item in ordered], ordered[1:] + [None])
+
+    def test_with_position(self):
+        with self.assertNumQueries(1):
+            items = list(self.field.with_position(Item.objects.order_by('pk')))
+            self.assertEqual([item.category_position for item in items], [2, 3, 4, 1, None])
+        items = self.field.with_position(Item.objects.all(), 'position')
+        self.assertEqual(items.get(pk=self.items[3].pk).position, 1)
+
+    def test_self_reference(self):
+        cat = CategorySelf.objects.create(name='cat')
+        child = CategorySelf.objects.create(name='child')
+        cat.items.add(child)
+        self.assertEqual(child.category_position, 1)
+        self.assertIsNone(child.next_in_category())
+
+
+    def test_model_attributes_not_overwritten(self):
+        cat = CategoryCustomPosition.objects.create()
+        item = ItemCustomPosition.objects.create(name='item', category_position=7, category_id=3)
+        cat.items.add(item)
+        item = ItemCustomPosition.objects.get(pk=item.pk)
+        self.assertEqual((item.category_position, item.category_id), (7, 3))
+        self.assertEqual(item.next_in_category(), 'custom')
+        self.assertEqual(item.previous_in_category(), None)
+        self.assertEqual(item.category, cat)
+
+
+class TestCountField(TestCase):
+
+    def setUp(self):
+        self.cats = [CategoryCounted.objects.create(name="cat%s" % i) for i in range(2)]
+        self.items = [ItemCounted.objects.create(name="item%s" % i) for i in range(5)]
+
+    def counts(self):
+        return [CategoryCounted.objects.get(pk=cat.pk).items_count for cat in self.cats]
+
+    def test_manager(self):
+        cat = self.cats[0]
+        cat.items.add(*self.items[:3])
+        self.assertEqual(self.counts(), [3, 0])
+        cat.items.add(self.items[0])
+        cat.items.remove(self.items[1], self.items[4])
+        self.assertEqual(self.counts(), [2, 0])
+        cat.items.set([self.items[2], self.items[3], self.items[4]])
+        self.assertEqual(self.counts(), [3, 0])
+        cat.items.clear()
+        self.assertEqual(self.counts(), [0, 0])
+
+    def test_owner_lists_not_read(self):
+        self.cats[0].items = self.items[:3]
+        self.cats[1].items = self.items[3:]
+        # savepoint, bounds, update, 2 counters (-3 and +3), versions, release
+        with self.assertNumQueries(7):
+            self.cats[0].items.merge_into(self.cats[1])
+        self.assertEqual(self.counts(), [0, 5])
+        # count, delete, counter, version
+        with self.assertNumQueries(4):
+            self.cats[1].items.clear()
+        # rows, insert, counter, version
+        with self.assertNumQueries(4):
+            self.cats[0].items.set(self.items[1:3])
+        self.assertEqual(self.counts(), [2, 0])
+
+    def test_reverse_assignment(self):
+        self.cats[0].items = self.items[:2]
+        self.items[0].category = self.cats[1]
+        self.items[2].category = self.cats[1]
+        self.items[1].category = None
+        self.assertEqual(self.counts(), [0, 2])
+
+    def test_batch_and_detach(self):
+        with sortedone2many.batch():
+            self.cats[0].items.add(*self.items[:3])
+            self.items[2].category = self.cats[1]
+            self.items[3].category = self.cats[1]
+        self.assertEqual(self.counts(), [2, 2])
+        detach(CategoryCounted._meta.get_field('items'), self.cats[1:])
+        self.assertEqual(self.counts(), [2, 0])
+
+    def test_recount(self):
+        self.cats[0].items = self.items[:3]
+        CategoryCounted.objects.update(items_count=7)
+        out = six.StringIO()
+        call_command('recount_sortedone2many', 'tests', stdout=out)
+        self.assertIn('tests.CategoryCounted.items: recounted 2 owners', out.getvalue())
+        self.assertEqual(self.counts(), [3, 0])
+
+    def test_check(self):
+        self.assertEqual(CategoryCounted._meta.get_field('items')._check_count_field(), [])
+        for count_field in ('name', 'missing'):
+            field = SortedOneToManyField(ItemCounted, count_field=count_field)
+            field.model = CategoryCounted
+            self.assertEqual([error.id for error in field._check_count_field()],
+                             ['sortedone2many.E001'])
+
+
+class TestCountFieldTransaction(TransactionTestCase):
+
+    def setUp(self):
+        self.field = CategoryCounted._meta.get_field('items')
+        self.cat = CategoryCounted.objects.create(name='cat')
+        self.items = [ItemCounted.objects.create(name="item%s" % i) for i in range(2)]
+        self.cat.items.add(self.items[0])
+
+    def failing_counters(self, operation, *args):
+        # the rows are written, then the counters fail to update
+        self.field.count_field = 'missing'
+        try:
+            self.assertRaises(FieldDoesNotExist, operation, *args)
+        finally:
+            self.field.count_field = 'items_count'
+
+    def test_rows_and_counters_in_one_transaction(self):
+        self.failing_counters(self.cat.items.add, self.items[1])
+        self.failing_counters(self.cat.items.remove, self.items[0])
+        self.failing_counters(self.cat.items.clear)
+        self.assertEqual(list(self.cat.items.all()), self.items[:1])
+        self.assertEqual(CategoryCounted.objects.get(pk=self.cat.pk).items_count, 1)
+
+
+class TestMove(TestCase):
+
+    def setUp(self):
+        self.cat = Category.objects.create(name="cat")
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(5)]
+        self.cat.items = self.items[:4]
+
+    def names(self):
+        return [item.name for item in self.cat.items.all()]
+
+    def test_move(self):
+        with self.assertNumQueries(4):  # savepoint, rows, update, release
+            self.cat.items.move(self.items[3], 1)
+        self.assertEqual(self.names(), ['item0', 'item3', 'item1', 'item2'])
+        # only the moved row is written when its neighbours leave room
+        self.assertEqual(self.cat.items.move(self.items[2], 0), 1)
+        self.assertEqual(self.names(), ['item2', 'item0', 'item3', 'item1'])
+        self.cat.items.move(self.items[0].pk, 10)
+        self.assertEqual(self.names(), ['item2', 'item3', 'item1', 'item0'])
+        self.assertRaises(ValueError, self.cat.items.move, self.items[4], 0)
+
+    def test_move_many(self):
+        self.cat.items.move_many([(self.items[0], 3), (self.items[2], 0)])
+        self.assertEqual(self.names(), ['item2', 'item1', 'item3', 'item0'])
+
+
+class TestAdminMove(TestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        from test_app.models import Category, Item
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.cat = Category.objects.create(name="cat")
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(3)]
+        self.cat.items = self.items
+        self.url = '/admin/test_app/category/%s/move/items/' % self.cat.pk
+
+    def names(self):
+        return [item.name for item in self.cat.items.all()]
+
+    def test_single_move(self):
+        response = self.client.post(self.url, {'item': self.items[2].pk, 'index': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {'updated': 1})
+        self.assertEqual(self.names(), ['item2', 'item0', 'item1'])
+
+    def test_batch(self):
+        moves = [[self.items[0].pk, 2], [self.items[1].pk, 2]]
+        response = self.client.post(self.url, json.dumps({'moves': moves}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names(), ['item2', 'item0', 'item1'])
+
+    def test_errors(self):
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        self.assertEqual(self.client.post(self.url, {'item': 'x', 'index': 0}).status_code, 400)
+        self.assertEqual(self.client.post(self.url, {'index': 0}).status_code, 400)
+        self.assertEqual(self.client.post(self.url.replace('items', 'name'), {}).status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.post(self.url, {'item': 1, 'index': 0}).status_code, 302)
+        self.assertEqual(self.names(), ['item0', 'item1', 'item2'])
+
+    def test_widget_url(self):
+        response = self.client.get('/admin/test_app/category/%s/change/' % self.cat.pk)
+        self.assertContains(response, 'data-move-url="%s"' % self.url)
+        self.assertContains(response, 'sortedone2many/widget.js')
+
+
+class TestMergeSplit(TestCase):
+
+    def setUp(self):
+        self.cats = [CategoryCounted.objects.create(name="cat%s" % i) for i in range(3)]
+        self.items = [ItemCounted.objects.create(name="item%s" % i) for i in range(6)]
+        self.cats[0].items = [self.items[2], self.items[0], self.items[1]]
+        self.cats[1].items = [self.items[4], self.items[3]]
+
+    def names(self, cat):
+        return [item.name for item in cat.items.all()]
+
+    def counts(self):
+        return [CategoryCounted.objects.get(pk=cat.pk).items_count for cat in self.cats]
+
+    def test_merge_into_end(self):
+        self.assertEqual(self.cats[0].items.merge_into(self.cats[1]), 3)
+        self.assertEqual(self.names(self.cats[0]), [])
+        self.assertEqual(self.names(self.cats[1]), ['item4', 'item3', 'item2', 'item0', 'item1'])
+        self.assertEqual(self.counts(), [0, 5, 0])
+        self.assertEqual(self.cats[0].items.merge_into(self.cats[1]), 0)
+
+    def test_merge_into_start(self):
+        self.cats[0].items.merge_into(self.cats[1].pk, position='start')
+        self.assertEqual(self.names(self.cats[1]), ['item2', 'item0', 'item1', 'item4', 'item3'])
+        self.cats[1].items.merge_into(self.cats[2], position='start')
+        self.assertEqual(self.names(self.cats[2]), ['item2', 'item0', 'item1', 'item4', 'item3'])
+        self.assertEqual(self.counts(), [0, 0, 5])
+        self.assertRaises(ValueError, self.cats[2].items.merge_into, self.cats[0], 'middle')
+
+    def test_merge_into_queries(self):
+        cats = [Category.objects.create(name="cat%s" % i) for i in range(2)]
+        cats[0].items = [Item.objects.create(name="item%s" % i) for i in range(50)]
+        cats[1].items = [Item.objects.create(name="other")]
+        with self.assertNumQueries(4):  # savepoint, bounds, update, release
+            cats[0].items.merge_into(cats[1])
+        self.assertEqual([item.name for item in cats[1].items.all()],
+                         ['other'] + ['item%s' % i for i in range(50)])
+
+    def test_split(self):
+        self.assertEqual(self.cats[0].items.split(1, self.cats[1]), 2)
+        self.assertEqual(self.names(self.cats[0]), ['item2'])
+        self.assertEqual(self.names(self.cats[1]), ['item4', 'item3', 'item0', 'item1'])
+        self.assertEqual(self.counts(), [1, 4, 0])
+        self.assertEqual(self.cats[0].items.split(1, self.cats[2]), 0)
+        self.cats[1].items.split(0, self.cats[2])
+        self.assertEqual(self.names(self.cats[2]), ['item4', 'item3', 'item0', 'item1'])
+        self.assertRaises(ValueError, self.cats[2].items.split, -1, self.cats[0])
+
+    def test_split_in_batch(self):
+        item6 = ItemCounted.objects.create(name='item6')
+        with sortedone2many.batch():
+            self.cats[2].items.add(self.items[5], item6)
+            self.assertEqual(self.cats[2].items.split(1, self.cats[1]), 1)
+        self.assertEqual(self.names(self.cats[1]), ['item4', 'item3', 'item6'])
+        self.assertEqual(self.names(self.cats[2]), ['item5'])
+        self.assertEqual(self.counts(), [3, 3, 1])
+
+    def test_m2m_changed(self):
+        sent = []
+
+        def receiver(sender, action, instance, pk_set, **kwargs):
+            sent.append((action, instance.pk, pk_set))
+        signals.m2m_changed.connect(receiver, sender=CategoryCounted.items.through)
+        try:
+            self.cats[1].items.merge_into(self.cats[2].pk)
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=CategoryCounted.items.through)
+        pk_set = set([self.items[3].pk, self.items[4].pk])
+        self.assertEqual(sent, [
+            ('pre_remove', self.cats[1].pk, pk_set), ('pre_add', self.cats[2].pk, pk_set),
+            ('post_remove', self.cats[1].pk, pk_set), ('post_add', self.cats[2].pk, pk_set)])
+
+
+class TestPrefetchTop(TestCase):
+
+    def setUp(self):
+        self.cats = [Category.objects.create(name="cat%s" % i) for i in range(3)]
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(7)]
+        self.cats[0].items = [self.items[3], self.items[0], self.items[5], self.items[6]]
+        self.cats[1].items = [self.items[1], self.items[4]]
+        self.cats[0].items.set([self.items[6], self.items[3], self.items[0], self.items[5]])
+        self.field = Category._meta.get_field('items')
+
+    def test_prefetch_top(self):
+        with self.assertNumQueries(2):
+            categories = list(Category.objects.order_by('pk').prefetch_related(self.field.prefetch_top(2)))
+            self.assertEqual([list(cat.items.all()) for cat in categories], [
+                [self.items[6], self.items[3]], [self.items[1], self.items[4]], []])
+
+    def test_to_attr_and_queryset(self):
+        prefetch = self.field.prefetch_top(
+            2, Item.objects.exclude(pk=self.items[3].pk), to_attr='first_items')
+        categories = list(Category.objects.order_by('pk').prefetch_related(prefetch))
+        self.assertEqual(categories[0].first_items, [self.items[6], self.items[0]])
+        self.assertEqual(categories[1].first_items, [self.items[1], self.items[4]])
+        self.assertEqual(len(categories[0].items.all()), 4)
+        self.assertRaises(ValueError, self.field.prefetch_top, -1)
+
+
+class TestRelatedValues(TestCase):
+
+    def setUp(self):
+        self.cats = [Category.objects.create(name="cat%s" % i) for i in range(3)]
+        self.items = [Item.objects.create(name="item%s" % i) for i in range(5)]
+        self.cats[0].items = [self.items[3], self.items[0]]
+        self.cats[1].items = [self.items[1], self.items[4], self.items[2]]
+        self.field = Category._meta.get_field('items')
+
+    def test_pks(self):
+        with self.assertNumQueries(1):
+            categories = list(self.field.with_related_values(Category.objects.order_by('pk')))
+        self.assertEqual([cat.items_values for cat in categories], [
+            [self.items[3].pk, self.items[0].pk],
+            [self.items[1].pk, self.items[4].pk, self.items[2].pk],
+            [],
+        ])
+
+    def test_fields(self):
+        self.cats[1].items.set([self.items[2], self.items[1], self.items[4]])
+        queryset = self.field.with_related_values(
+            Category.objects.filter(pk=self.cats[1].pk), ['pk', 'name'], name='rows')
+        self.assertEqual(queryset.get().rows, [
+            (self.items[2].pk, 'item2'), (self.items[1].pk, 'item1'), (self.items[4].pk, 'item4')])
+        self.assertEqual(list(queryset.values_list('rows', flat=True)), [
+            [(self.items[2].pk, 'item2'), (self.items[1].pk, 'item1'), (self.items[4].pk, 'item4')]])
+
+
+class TestAssignOwner(TestCase):
+
+    def setUp(self):
+        self.cats = [CategoryCounted.objects.create(name="cat%s" % i) for i in range(2)]
+        self.items = [ItemCounted.objects.create(name="item%s" % i) for i in range(6)]
+        self.cats[0].items = self.items[:3]
+        self.cats[1].items = self.items[3:5]
+
+    def names(self, cat):
+        return [item.name for item in cat.items.all()]
+
+    def counts(self):
+        return [CategoryCounted.objects.get(pk=cat.pk).items_count for cat in self.cats]
+
+    def test_end(self):
+        queryset = ItemCounted.objects.filter(name__in=['item5', 'item0', 'item4', 'item2'])
+        # savepoint, count, bounds, owners, update, insert, 2 counters, versions, release
+        with self.assertNumQueries(10):
+            moved = queryset.order_by('-name').assign_owner('category', self.cats[1])
+        self.assertEqual(moved, 4)
+        self.assertEqual(self.names(self.cats[0]), ['item1'])
+        self.assertEqual(self.names(self.cats[1]), ['item3', 'item4', 'item5', 'item2', 'item0'])
+        self.assertEqual(self.counts(), [1, 5])
+
+    def test_start(self):
+        field = CategoryCounted._meta.get_field('items')
+        field.assign_owner(ItemCounted.objects.filter(name__in=['item5', 'item1', 'item3']),
+                           self.cats[1], position='start')
+        self.assertEqual(self.names(self.cats[0]), ['item0', 'item2'])
+        self.assertEqual(self.names(self.cats[1]), ['item1', 'item5', 'item3', 'item4'])
+        self.assertEqual(self.counts(), [2, 4])
+        self.assertRaises(ValueError, field.assign_owner, ItemCounted.objects.all(),
+                          self.cats[0], 'middle')
+
+    def test_detach(self):
+        ItemCounted.objects.filter(name__in=['item0', 'item3']).assign_owner('category', None)
+        self.assertEqual(self.names(self.cats[0]), ['item1', 'item2'])
+        self.assertEqual(self.names(self.cats[1]), ['item4'])
+        self.assertEqual(self.counts(), [2, 1])
+
+    def test_queries_independent_of_size(self):
+        items = [ItemCounted.objects.create(name='many%03d' % i) for i in range(300)]
+        self.cats[0].items.add(*items[:150])
+        with self.assertNumQueries(10):
+            moved = ItemCounted.objects.filter(name__startswith='many').order_by('-name').assign_owner(
+                'category', self.cats[1], position='start')
+        self.assertEqual(moved, 300)
+        self.assertEqual(self.names(self.cats[1]),
+                         ['many%03d' % i for i in reversed(range(300))] + ['item3', 'item4'])
+        self.assertEqual(self.counts(), [3, 302])
+        with self.assertNumQueries(7):  # savepoint, count, owners, delete, counter, versions, release
+            ItemCounted.objects.filter(name__startswith='many').assign_owner('category', None)
+        self.assertEqual(self.counts(), [3, 2])
+
+    def test_ordered_by_related_and_annotation(self):
+        queryset = (ItemCounted.objects.filter(name__in=['item0', 'item5', 'item3'])
+                    .annotate(length=models.Count('category')).order_by('-length', '-name'))
+        queryset.assign_owner('category', self.cats[1])
+        # item3 keeps its place
+        self.assertEqual(self.names(self.cats[1]), ['item3', 'item4', 'item0', 'item5'])
+
+    def test_changes_sent(self):
+        sent = []
+
+        def receiver(sender, action, instance, pk_set, **kwargs):
+            sent.append((action, instance.pk, pk_set))
+        signals.m2m_changed.connect(receiver, sender=CategoryCounted.items.through)
+        try:
+            ItemCounted.objects.filter(name__in=['item5', 'item0', 'item4']).assign_owner(
+                'category', self.cats[1])
+        finally:
+            signals.m2m_changed.disconnect(receiver, sender=CategoryCounted.items.through)
+        self.assertEqual(self.names(self.cats[1]), ['item3', 'item4', 'item0', 'item5'])
+        self.assertEqual(sorted(sent), [
+            ('post_add', self.cats[1].pk, set([self.items[0].pk, self.items[5].pk])),
+            ('post_remove', self.cats[0].pk, set([self.items[0].pk])),
+            ('pre_add', self.cats[1].pk, set([self.items[0].pk, self.items[5].pk])),
+            ('pre_remove', self.cats[0].pk, set([self.items[0].pk]))])
+        self.assertEqual(self.counts(), [2, 4])